@@ -1,11 +1,12 @@
 import yaml
+import argparse
 import time
 import imageio
 import glob
 import os
 import numpy as np
 
-from src import vrt, stitch
+from src import vrt, stitch, store, preprocess
 
 np.set_printoptions(precision=4)
 
@@ -31,6 +32,8 @@ def run(cfg):
         wld_suffix=cfg['wld_suffix'],
         crs=cfg['crs'],
         index_cols=['index'])
+    if cfg['segment_swaths'] and 'swath_id' not in v.df.columns:
+        v.segment_swaths(heading_col=cfg['heading_col'])
 
     # step 2: build stitcher
     print("Step 2")
@@ -38,32 +41,75 @@ def run(cfg):
         scales=cfg['scales'],
         crop=cfg['stitch_crop'],
         cache_dir=cfg['out_dir_cache'],
+        detector=cfg['detector'],
         hessian_threshold=cfg['hessian_threshold'],
+        n_features=cfg['n_features'],
+        max_keypoints=cfg['max_keypoints'],
+        guided_radius=cfg['guided_radius'],
         min_inliers=cfg['min_inliers'],
-        ransac_reproj_threshold=cfg['ransac_reproj_threshold'])
+        ransac_reproj_threshold=cfg['ransac_reproj_threshold'],
+        estimator=cfg['estimator'],
+        max_iters=cfg['max_iters'],
+        confidence=cfg['confidence'],
+        refine_iters=cfg['refine_iters'],
+        coarse_to_fine=cfg['coarse_to_fine'],
+        refine_reproj_threshold=cfg['refine_reproj_threshold'],
+        phase_correlation_scale=cfg['phase_correlation_scale'],
+        phase_correlation_threshold=cfg['phase_correlation_threshold'],
+        memory_cache_bytes=cfg['memory_cache_bytes'],
+        persist_index=cfg['persist_index'])
 
     # step 3: build links
     print("Step 3")
+    # links are recorded on disk, so that interrupted runs can be resumed
+    link_store = store.LinkStore(
+        os.path.join(cfg['out_dir_cache'], 'links.sqlite'),
+        params={**s.params, 'max_dist': cfg['max_dist'],
+                'overlap_dilation': cfg['overlap_dilation'],
+                'guided_matching': cfg['guided_matching']})
     v.build_graph_links(
         f=s.stitch_pair,
-        method='all',
+        method=cfg['graph_method'],
+        neighbor_retrieval=cfg['neighbor_retrieval'],
+        retrieval_words=cfg['retrieval_words'],
+        descriptor_fn=s.get_descriptors,
+        min_overlap=cfg['min_overlap'],
+        n_neighbors=cfg['n_neighbors'],
+        n_links=cfg['n_links'],
+        budget=cfg['link_budget'],
         show_file=cfg["show_file"],
         verbose=True,
-        max_dist = cfg["max_dist"])
+        max_dist = cfg["max_dist"],
+        n_workers=cfg['n_workers'],
+        store=link_store,
+        order=cfg['pair_order'],
+        overlap_dilation=cfg['overlap_dilation'],
+        guided=cfg['guided_matching'])
+    link_store.close()
 
     print(v.links)
 
     # step 4: globally optimize
     print("Step 4")
-    v.global_optimize(
-        n_iter=cfg['optim_n_iter'],
-        lr_theta=cfg['optim_lr_theta'],
-        lr_scale=cfg['optim_lr_scale'],
-        lr_xy=cfg['optim_lr_xy'],
-        lr_scheduler_milestones=cfg['optim_lr_scheduler_milestones'],
-        logging=True,
-        logdir=cfg["logs_dir"],
-        output_iter=cfg['output_iter'])
+    if cfg['optim_solver'] == 'trf':
+        v.global_optimize(
+            solver='trf',
+            max_nfev=cfg['optim_max_nfev'])
+    else:
+        v.global_optimize(
+            n_iter=cfg['optim_n_iter'],
+            lr_theta=cfg['optim_lr_theta'],
+            lr_scale=cfg['optim_lr_scale'],
+            lr_xy=cfg['optim_lr_xy'],
+            lr_scheduler_milestones=cfg['optim_lr_scheduler_milestones'],
+            rtol=cfg['optim_rtol'],
+            grad_tol=cfg['optim_grad_tol'],
+            step_tol=cfg['optim_step_tol'],
+            patience=cfg['optim_patience'],
+            logging=True,
+            logdir=cfg["logs_dir"],
+            output_iter=cfg['output_iter'])
+    print('Stopped at iter {} ({})'.format(*v.optim_stop))
     
 
 
@@ -98,10 +144,68 @@ def run(cfg):
     return v
 
 
+def warm_cache(cfg, img_dir=None, n_workers=None):
+    """Precomputes the preprocessing cache used for stitching.
+
+    Args:
+        cfg (dict): all configurations
+        img_dir (str): if not None, all images in this directory (and
+            subdirectories) are cached, instead of images in cfg['in_dir_csv']
+        n_workers (int): number of worker processes,
+            defaults to cfg['n_workers']
+
+    Returns:
+        dict: summary of the cache written
+    """
+    tic = time.time()
+    if img_dir is None:
+        v = vrt.VirtualRaster.from_csv(
+            file=cfg['in_dir_csv'],
+            img_dir=cfg['in_dir_images'],
+            wld_dir=cfg['out_dir_meta'],
+            img_suffix=cfg['img_suffix'],
+            wld_suffix=cfg['wld_suffix'],
+            crs=cfg['crs'],
+            index_cols=['index'])
+        files = v.df.loc[:, 'img_file'].tolist()
+    else:
+        files = sorted(glob.glob(
+            os.path.join(img_dir, '**/*' + cfg['img_suffix']),
+            recursive=True))
+    summary = preprocess.warm_cache(
+        files,
+        scales=cfg['scales'],
+        crop=cfg['stitch_crop'],
+        cache_dir=cfg['out_dir_cache'],
+        n_workers=cfg['n_workers'] if n_workers is None else n_workers)
+    toc = time.time()
+    print('Wrote {} cache file(s), skipped {} valid one(s), '
+          '{:.1f} MB written in {:.1f}s'
+          .format(summary['n_written'], summary['n_skipped'],
+                  summary['bytes_written'] / 2 ** 20, toc - tic))
+    return summary
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', nargs='?', default='run',
+                        choices=['run', 'warm-cache'],
+                        help='run: run through all the steps; '
+                             'warm-cache: precompute preprocessed images')
+    parser.add_argument('--config', default='config.yaml')
+    parser.add_argument('--img-dir', default=None,
+                        help='warm-cache: cache all images in a directory '
+                             'instead of the images listed in the csv')
+    parser.add_argument('--n-workers', type=int, default=None,
+                        help='warm-cache: number of worker processes')
+    args = parser.parse_args()
+
     # parse config file
-    with open('config.yaml', 'r') as f:
+    with open(args.config, 'r') as f:
         cfg = yaml.safe_load(f)
 
-    # run through all the steps
-    v = run(cfg)
\ No newline at end of file
+    if args.command == 'warm-cache':
+        warm_cache(cfg, img_dir=args.img_dir, n_workers=args.n_workers)
+    else:
+        # run through all the steps
+        v = run(cfg)
\ No newline at end of file
@@ -0,0 +1,82 @@
+import sys
+import collections
+import numpy as np
+
+
+def get_nbytes(value):
+    """Estimates the memory footprint of a cached value.
+
+    Args:
+        value: numpy arrays, or (nested) tuples/lists of them, other
+            objects are measured with sys.getsizeof
+
+    Returns:
+        int: size in bytes
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(get_nbytes(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache(object):
+    """In-memory least recently used cache bounded by size in bytes.
+
+    Args:
+        max_bytes (int): maximum total size of cached values, the least
+            recently used values are evicted when exceeded, values larger
+            than max_bytes are not cached, 0 disables caching
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        """Looks up a value and marks it as most recently used.
+
+        Args:
+            key (hashable): key
+            default: returned if the key is not cached
+
+        Returns:
+            cached value or default
+        """
+        if key not in self._data:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._data.move_to_end(key)
+        return self._data[key][0]
+
+    def put(self, key, value):
+        """Caches a value, evicting least recently used values if necessary.
+
+        Args:
+            key (hashable): key
+            value: value to be cached, see get_nbytes()
+        """
+        n_bytes = get_nbytes(value)
+        if key in self._data:
+            self.n_bytes -= self._data.pop(key)[1]
+        if n_bytes > self.max_bytes:
+            return
+        self._data[key] = (value, n_bytes)
+        self.n_bytes += n_bytes
+        while self.n_bytes > self.max_bytes:
+            _, (_, evicted_bytes) = self._data.popitem(last=False)
+            self.n_bytes -= evicted_bytes
+
+    def clear(self):
+        self._data.clear()
+        self.n_bytes = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
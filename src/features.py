@@ -0,0 +1,220 @@
+import os
+import json
+import hashlib
+import functools
+import tempfile
+import numpy as np
+import cv2 as cv
+import rasterio.transform
+
+
+@functools.lru_cache(maxsize=None)
+def _hash_file(file, size, mtime):
+    """Hashes file content, memoized on (path, size, modification time)."""
+    h = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_hash(file):
+    """Computes the content hash of a file.
+
+    The hash is only recomputed if the file size or modification time
+    changes, so repeated calls on the same file are cheap.
+
+    Args:
+        file (str): file path
+
+    Returns:
+        str: sha1 hex digest of file content
+    """
+    stat = os.stat(file)
+    return _hash_file(os.path.abspath(file), stat.st_size, stat.st_mtime_ns)
+
+
+def keypoints_to_array(kps):
+    """Converts a list of cv.KeyPoint to an array.
+
+    Args:
+        kps (list of cv.KeyPoint): keypoints
+
+    Returns:
+        numpy.ndarray [N, 7]: x, y, size, angle, response, octave, class_id
+    """
+    return np.array([[kp.pt[0], kp.pt[1], kp.size, kp.angle,
+                      kp.response, kp.octave, kp.class_id]
+                     for kp in kps], dtype=np.float32).reshape((-1, 7))
+
+
+def array_to_keypoints(array):
+    """Converts an array to a list of cv.KeyPoint.
+
+    Args:
+        array (numpy.ndarray [N, 7]): x, y, size, angle, response,
+            octave, class_id
+
+    Returns:
+        list of cv.KeyPoint: keypoints
+    """
+    return [cv.KeyPoint(x=float(x), y=float(y), size=float(size),
+                        angle=float(angle), response=float(response),
+                        octave=int(octave), class_id=int(class_id))
+            for x, y, size, angle, response, octave, class_id in array]
+
+
+def get_feature_cache_file(cache_dir, file, **params):
+    """Generates the cache file path for the features of an image.
+
+    The file name is derived from the image path, its content hash and
+    all the parameters that affect feature extraction, so that changing
+    any of them results in a different cache file.
+
+    Args:
+        cache_dir (str): directory for storing cached features
+        file (str): image file path
+        **params: json serializable parameters that affect feature
+            extraction (e.g., scale, crop, detector settings)
+
+    Returns:
+        str: path to the .npz cache file
+    """
+    key = json.dumps({'file': os.path.abspath(file),
+                      'hash': file_hash(file),
+                      **params}, sort_keys=True)
+    key = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(
+        cache_dir,
+        '{}_{}.npz'.format(os.path.splitext(os.path.basename(file))[0], key))
+
+
+def save_features(cache_file, kps, des, trans):
+    """Saves keypoints and descriptors to a compressed .npz file.
+
+    The file is written to a temporary file first and then moved in place,
+    so concurrent readers never see a partially written cache.
+
+    Args:
+        cache_file (str): path to the .npz cache file
+        kps (numpy.ndarray [N, 7]): keypoints, see keypoints_to_array()
+        des (numpy.ndarray [N, D] or NoneType): descriptors
+        trans (affine.Affine): transform from the preprocessed image to the
+            original image
+    """
+    fd, tmp_file = tempfile.mkstemp(
+        dir=os.path.dirname(cache_file), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.savez_compressed(
+            f, kps=kps,
+            des=np.zeros((0, 0), np.float32) if des is None else des,
+            trans=np.array(trans[:6]))
+    os.replace(tmp_file, cache_file)
+
+
+def load_features(cache_file):
+    """Loads keypoints and descriptors saved by save_features().
+
+    Args:
+        cache_file (str): path to the .npz cache file
+
+    Returns:
+        tuple (numpy.ndarray, numpy.ndarray, affine.Affine) or NoneType:
+            keypoints, descriptors and transform, None if there is no
+            valid cache
+    """
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with np.load(cache_file) as data:
+            kps, des, trans = data['kps'], data['des'], data['trans']
+    except (OSError, ValueError, KeyError):
+        return None
+    des = None if des.size == 0 else des
+    return kps, des, rasterio.transform.Affine(*trans)
+
+
+# FLANN index algorithms
+FLANN_INDEX_KDTREE = 1
+FLANN_INDEX_LSH = 6
+
+# feature detectors, binary ones are matched with LSH on Hamming distance
+DETECTORS = {
+    'surf': ('SURF_create', False),
+    'sift': ('SIFT_create', False),
+    'orb': ('ORB_create', True),
+    'akaze': ('AKAZE_create', True),
+    'brisk': ('BRISK_create', True),
+}
+
+
+def create_detector(detector='surf', hessian_threshold=100, n_features=5000):
+    """Creates a feature detector and the params of its matcher index.
+
+    Args:
+        detector (str): one of DETECTORS, 'surf' requires the non-free
+            opencv-contrib build
+        hessian_threshold (float): threshold for feature extraction,
+            only used by 'surf'
+        n_features (int): maximum number of features, only used by 'orb'
+
+    Returns:
+        cv.Feature2D: feature detector and descriptor extractor
+        dict: FLANN index params, KD-tree for float descriptors and LSH for
+            binary descriptors
+    """
+    if detector not in DETECTORS:
+        raise ValueError('Unknown detector: {}, expected one of {}'.format(
+            detector, sorted(DETECTORS)))
+    name, binary = DETECTORS[detector]
+    # some detectors live in xfeatures2d depending on the opencv version
+    create = getattr(cv, name, None)
+    if create is None:
+        create = getattr(cv.xfeatures2d, name)
+    if detector == 'surf':
+        fd = create(hessianThreshold=hessian_threshold)
+    elif detector == 'orb':
+        fd = create(nfeatures=n_features)
+    else:
+        fd = create()
+    if binary:
+        index_params = {'algorithm': FLANN_INDEX_LSH, 'table_number': 6,
+                        'key_size': 12, 'multi_probe_level': 1}
+    else:
+        index_params = {'algorithm': FLANN_INDEX_KDTREE, 'trees': 4}
+    return fd, index_params
+
+
+def select_keypoints(kps, shape, max_keypoints, grid=8):
+    """Selects a bounded, spatially well spread subset of keypoints.
+
+    The image is divided into grid x grid cells, keypoints are ranked by
+    response within each cell and selected round-robin across cells (the
+    strongest keypoint of every cell first, then the second strongest, etc.),
+    so that textured regions do not consume the whole budget.
+
+    Args:
+        kps (numpy.ndarray [N, 7]): keypoints, see keypoints_to_array()
+        shape (tuple): (height, width) of the image
+        max_keypoints (int): maximum number of selected keypoints
+        grid (int): number of cells along each image dimension
+
+    Returns:
+        numpy.ndarray [M,]: indices of selected keypoints, M <= max_keypoints
+    """
+    if len(kps) <= max_keypoints:
+        return np.arange(len(kps))
+    height, width = shape
+    col = np.clip((kps[:, 0] * grid / width).astype(int), 0, grid - 1)
+    row = np.clip((kps[:, 1] * grid / height).astype(int), 0, grid - 1)
+    cell = row * grid + col
+    response = kps[:, 4]
+    # sort by cell, then by decreasing response
+    order = np.lexsort((-response, cell))
+    # rank of each keypoint within its cell
+    cell_sorted = cell[order]
+    is_first = np.r_[True, cell_sorted[1:] != cell_sorted[:-1]]
+    first = np.maximum.accumulate(np.where(is_first, np.arange(len(order)), 0))
+    rank = np.empty(len(kps), dtype=int)
+    rank[order] = np.arange(len(order)) - first
+    return np.lexsort((-response, rank))[0:max_keypoints]
@@ -1,7 +1,14 @@
 import collections
+import collections.abc
 import numpy as np
 import scipy
+import scipy.sparse
+import scipy.sparse.csgraph
 import scipy.spatial
+import shapely
+
+from .retrieval import RetrievalIndex
+from .utils import get_overlap_fraction
 
 
 def make_symmetric(graph):
@@ -11,39 +18,281 @@ def make_symmetric(graph):
         graph (collections.defaultdict(list)): {k: [v0, v1, ...]}
             with v0, v1, ... being neighbors of k
     """
-    for k, vs in graph.copy().items():
+    # neighbor sets for constant time membership tests
+    neighbors = {k: set(vs) for k, vs in graph.items()}
+    for k, vs in list(graph.items()):
         for v in vs:
-            if k not in graph[v]:
+            if k not in neighbors.setdefault(v, set()):
                 graph[v].append(k)
+                neighbors[v].add(k)
+
+
+class Graph(collections.abc.Mapping):
+    """Undirected graph stored as a CSR adjacency matrix.
+
+    Nodes (e.g., (idx0, idx1) tuples) are mapped to integer ids, edges are
+    stored in a symmetric scipy.sparse.csr_matrix. The graph is read only and
+    behaves like a dict {node: [neighbor0, neighbor1, ...]}, it compares
+    equal to dicts with the same nodes and neighbors (in any order).
+
+    Args:
+        nodes (list): node names, the position of a node is its id
+        edges (numpy.ndarray [M, 2] of int): pairs of node ids, duplicates
+            and self loops are dropped
+    """
+
+    def __init__(self, nodes=(), edges=None):
+        self.nodes = list(nodes)
+        self.node_ids = {node: i for i, node in enumerate(self.nodes)}
+        assert len(self.node_ids) == len(self.nodes), 'Duplicated nodes.'
+        n = len(self.nodes)
+        edges = np.zeros((0, 2), dtype=int) if edges is None else edges
+        edges = np.asarray(edges, dtype=int).reshape(-1, 2)
+        edges = edges[edges[:, 0] != edges[:, 1]]
+        adjacency = scipy.sparse.coo_matrix(
+            (np.ones(edges.shape[0] * 2, dtype=np.int8),
+             (np.concatenate([edges[:, 0], edges[:, 1]]),
+              np.concatenate([edges[:, 1], edges[:, 0]]))),
+            shape=(n, n)).tocsr()
+        # duplicates are summed
+        adjacency.data[:] = 1
+        adjacency.sort_indices()
+        self.adjacency = adjacency
+
+    @classmethod
+    def from_dict(cls, graph):
+        """Builds a graph from a dict, made symmetric.
+
+        Args:
+            graph (dict of list or Graph): {k: [v0, v1, ...]}
+                with v0, v1, ... being neighbors of k, returned as is if
+                already a Graph
+
+        Returns:
+            Graph
+        """
+        if isinstance(graph, cls):
+            return graph
+        nodes = list(graph.keys())
+        node_ids = {node: i for i, node in enumerate(nodes)}
+        for vs in graph.values():
+            for v in vs:
+                if v not in node_ids:
+                    node_ids[v] = len(nodes)
+                    nodes.append(v)
+        edges = [(node_ids[k], node_ids[v])
+                 for k, vs in graph.items() for v in vs]
+        return cls(nodes, edges)
+
+    @classmethod
+    def from_edges(cls, nodes, edges):
+        """Builds a graph from edges, dropping nodes without edges.
+
+        Args:
+            nodes (list): node names, indexed by edges
+            edges (numpy.ndarray [M, 2] of int): pairs of positions in nodes
+
+        Returns:
+            Graph
+        """
+        edges = np.asarray(edges, dtype=int).reshape(-1, 2)
+        used = np.unique(edges)
+        return cls([nodes[k] for k in used], np.searchsorted(used, edges))
+
+    @property
+    def indptr(self):
+        return self.adjacency.indptr
+
+    @property
+    def indices(self):
+        return self.adjacency.indices
+
+    def __getitem__(self, node):
+        i = self.node_ids[node]
+        return [self.nodes[k]
+                for k in self.indices[self.indptr[i]:self.indptr[i + 1]]]
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node):
+        return node in self.node_ids
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.abc.Mapping):
+            return NotImplemented
+        return (set(self.keys()) == set(other.keys()) and
+                all(set(self[k]) == set(other[k]) for k in self.nodes))
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Graph({})'.format(dict(self.items()))
+
+    def get_edges(self):
+        """Gets all edges.
+
+        Returns:
+            numpy.ndarray [M, 2] of int: pairs of node ids (i, j) with i < j
+        """
+        upper = scipy.sparse.triu(self.adjacency, k=1).tocoo()
+        return np.stack([upper.row, upper.col], axis=1).astype(int)
+
+    def subgraph(self, nodes):
+        """Gets the subgraph induced by a subset of nodes.
+
+        Args:
+            nodes (iterable): node names, the ones not in the graph are
+                ignored
+
+        Returns:
+            Graph
+        """
+        ids = [self.node_ids[node] for node in nodes if node in self.node_ids]
+        edges = self.get_edges()
+        # map old ids to new ids, -1 for dropped nodes
+        new_ids = np.full(len(self.nodes), -1)
+        new_ids[ids] = np.arange(len(ids))
+        edges = new_ids[edges]
+        return Graph([self.nodes[i] for i in ids],
+                     edges[np.all(edges >= 0, axis=1)])
+
+    def union(self, other):
+        """Gets the union of two graphs.
+
+        Args:
+            other (dict of list or Graph)
+
+        Returns:
+            Graph
+        """
+        other = Graph.from_dict(other)
+        nodes = self.nodes + [node for node in other.nodes
+                              if node not in self.node_ids]
+        node_ids = {node: i for i, node in enumerate(nodes)}
+        other_ids = np.array([node_ids[node] for node in other.nodes],
+                             dtype=int)
+        edges = np.vstack([self.get_edges(),
+                           other_ids[other.get_edges()].reshape(-1, 2)])
+        return Graph(nodes, edges)
+
+    def connected_components(self):
+        """Gets all the connected components.
+
+        Returns:
+            list of set: each component is a set of node names
+        """
+        n_components, labels = scipy.sparse.csgraph.connected_components(
+            self.adjacency, directed=False)
+        components = [set() for _ in range(n_components)]
+        for node, label in zip(self.nodes, labels):
+            components[label].add(node)
+        return components
+
+
+def get_knn_edges(positions, k, max_dist=None):
+    """Gets edges between each point and its k nearest neighbors.
+
+    Args:
+        positions (numpy.ndarray [N, 2]): points
+        k (int): number of neighbors of each point
+        max_dist (float): max distance between neighbors, if None, unbounded
+
+    Returns:
+        numpy.ndarray [M, 2] of int: edges (i, j) with i < j
+    """
+    k = min(k, len(positions) - 1)
+    if k <= 0:
+        return np.zeros((0, 2), dtype=int)
+    tree = scipy.spatial.cKDTree(positions)
+    # query all points at once, the nearest neighbor is the point itself
+    dist, nn = tree.query(
+        positions, k=k + 1,
+        distance_upper_bound=np.inf if max_dist is None else max_dist)
+    rows = np.repeat(np.arange(len(positions)), k)
+    dist, nn = dist[:, 1:].ravel(), nn[:, 1:].ravel()
+    keep = np.isfinite(dist) & (nn != rows)
+    edges = np.sort(np.stack([rows[keep], nn[keep]], axis=1), axis=1)
+    return np.unique(edges, axis=0)
+
+
+def get_radius_edges(positions, max_dist):
+    """Gets edges between all pairs of points within a distance.
+
+    Args:
+        positions (numpy.ndarray [N, 2]): points
+        max_dist (float): max distance between neighbors
+
+    Returns:
+        numpy.ndarray [M, 2] of int: edges (i, j) with i < j
+    """
+    tree = scipy.spatial.cKDTree(positions)
+    edges = tree.query_pairs(max_dist, output_type='ndarray')
+    # sort for a deterministic order
+    return edges[np.lexsort((edges[:, 1], edges[:, 0]))]
 
 
 def build_graph(indices, method,
                 neighbor_within_swath=None,
                 positions=None, neighbor_across_swath=None,
-                verbose=False):
+                max_dist=None, n_neighbors=None,
+                descriptors=None, neighbor_retrieval=None,
+                retrieval_words=1000, footprints=None, min_overlap=0,
+                ordered=False, verbose=False):
     """Builds an undirected graph that describes an image's neighbors.
 
     Args:
         indices (list of list of tuples): each tuple corresponds to an image
-            identifier, each element in the outer list corresponds to a swath
-        method (str): in ['within', 'across', 'all']
+            identifier, each element in the outer list corresponds to a swath,
+            for non tuple identifiers, images are in the order of capture
+        method (str): in ['within', 'across', 'all', 'retrieval', 'overlap',
+            'knn', 'radius']
             within: make links only between neighbors in the swath
             across: make links only between nearest neighbors across swaths
             all: make links across all pairs of images
+            retrieval: make links between the most similar images, based on
+                a bag of visual words index of their local descriptors
+            overlap: make links between images with overlapping footprints
+            knn: make links between nearest neighbors, regardless of swaths
+            radius: make links between all images within max_dist,
+                regardless of swaths
         neighbor_within_swath (int): number of links made between an image
             and images on its own swath, cannot be None if method = 'within'
         positions (list of numpy.ndarray [N, 2]): each element in the list
             corresponds to a swath, each row in the ndarray corresponds to the
-            centroid of an image, cannot be None if method = 'across'
+            centroid of an image, cannot be None if method in
+            ['across', 'knn', 'radius']
         neighbor_across_swath (int): number of links made between an image
             and images on each swath (different from its own),
             cannot be None if method = 'across'
         max_dist (float): max distance between images in order for
-            a link to be made, cannot be None if method = 'across'
+            a link to be made, cannot be None if method in
+            ['across', 'radius']
+        n_neighbors (int): number of links made between an image and its
+            nearest neighbors, cannot be None if method = 'knn'
+        descriptors (list of list of numpy.ndarray [N_i, D]): local
+            descriptors of each image, nested like indices,
+            cannot be None if method = 'retrieval'
+        neighbor_retrieval (int): number of most similar images linked to
+            an image, cannot be None if method = 'retrieval'
+        retrieval_words (int): approximate size of the visual vocabulary,
+            see src.retrieval.RetrievalIndex
+        footprints (list of list of shapely.geometry.Polygon): predicted
+            footprint of each image (in world crs), nested like indices,
+            cannot be None if method = 'overlap'
+        min_overlap (float): min overlap fraction (intersection area over
+            the area of the smaller footprint) in order for a link to be made
+        ordered (bool): whether images in each swath are in swath order, if
+            True, method = 'within' links images to the next ones in the
+            list for tuple identifiers too, instead of to the next image
+            numbers
         verbose (bool)
 
     Returns:
-        collections.defaultdict(list): symmetric graph
+        Graph: symmetric graph
     """
 
     # initialize the graph
@@ -51,7 +300,15 @@ def build_graph(indices, method,
     if method == 'within':
         for swath_idx in indices:
             # iterate over every node/image
-            for (idx0, idx1) in swath_idx:
+            for k, idx in enumerate(swath_idx):
+                if ordered or not isinstance(idx, tuple):
+                    # link to the next images in the swath order
+                    neighbors = swath_idx[
+                        (k + 1):(k + 1 + neighbor_within_swath)]
+                    if len(neighbors) > 0:
+                        graph[idx] += neighbors
+                    continue
+                idx0, idx1 = idx
                 # for images on the same swath
                 for i in range(neighbor_within_swath):
                     if (idx0, idx1 + i + 1) in swath_idx:
@@ -81,16 +338,50 @@ def build_graph(indices, method,
                     graph[(idx0, idx1)] += neighbors
     elif method == 'all':
         # unnest the list to be a list of image indices
-        all_indices = set([idx
-                           for swath_idx in indices
-                           for idx in swath_idx])
-        # iterate over every node/image
-        for idx in all_indices:
-            graph[idx] = list(all_indices - set([idx]))
+        all_indices = [idx for swath_idx in indices for idx in swath_idx]
+        # all pairs of images, keeping images on their own
+        graph = Graph(all_indices,
+                      np.stack(np.triu_indices(len(all_indices), k=1),
+                               axis=1))
+    elif method == 'retrieval':
+        # unnest the lists to be aligned lists of images
+        all_indices = [idx for swath_idx in indices for idx in swath_idx]
+        all_descriptors = [des for swath_des in descriptors
+                           for des in swath_des]
+        index = RetrievalIndex(n_words=retrieval_words)
+        index.fit(all_descriptors)
+        pairs, _ = index.query(k=neighbor_retrieval)
+        if len(pairs) == 0:
+            raise ValueError('No similar images retrieved, use another '
+                             'graph method.')
+        graph = Graph.from_edges(all_indices, pairs)
+    elif method == 'overlap':
+        # unnest the lists to be aligned lists of images
+        all_indices = [idx for swath_idx in indices for idx in swath_idx]
+        geoms = np.array([fp for swath_fp in footprints for fp in swath_fp])
+        # bulk query a spatial index for intersecting footprints
+        tree = shapely.STRtree(geoms)
+        left, right = tree.query(geoms, predicate='intersects')
+        keep = left < right
+        left, right = left[keep], right[keep]
+        overlap = get_overlap_fraction(geoms[left], geoms[right])
+        keep = overlap > min_overlap
+        graph = Graph.from_edges(
+            all_indices, np.stack([left[keep], right[keep]], axis=1))
+    elif method in ['knn', 'radius']:
+        # unnest the lists to be aligned lists of images
+        all_indices = [idx for swath_idx in indices for idx in swath_idx]
+        all_positions = np.vstack(positions)
+        if method == 'knn':
+            edges = get_knn_edges(all_positions, n_neighbors, max_dist)
+        else:
+            edges = get_radius_edges(all_positions, max_dist)
+        graph = Graph.from_edges(all_indices, edges)
     else:
         raise NotImplementedError
 
-    make_symmetric(graph)
+    # symmetric graph
+    graph = Graph.from_dict(graph)
 
     if verbose:
         print('Graph: ', graph)
@@ -98,12 +389,70 @@ def build_graph(indices, method,
     return graph
 
 
+def get_spanning_tree(n_nodes, edges, weights):
+    """Gets the maximum spanning tree (forest) of a weighted graph.
+
+    Args:
+        n_nodes (int): number of nodes
+        edges (numpy.ndarray [M, 2] of int): pairs of node ids (i, j), i < j
+        weights (numpy.ndarray [M,]): edge weights, higher is preferred
+
+    Returns:
+        numpy.ndarray [M,] of bool: whether an edge is in the tree
+    """
+    edges = np.asarray(edges, dtype=int).reshape(-1, 2)
+    weights = np.asarray(weights, dtype=float)
+    in_tree = np.zeros(len(edges), dtype=bool)
+    if len(edges) == 0:
+        return in_tree
+    # positive costs, decreasing with weights (zero costs are not edges)
+    costs = weights.max() - weights + 1
+    tree = scipy.sparse.csgraph.minimum_spanning_tree(
+        scipy.sparse.coo_matrix((costs, (edges[:, 0], edges[:, 1])),
+                                shape=(n_nodes, n_nodes)).tocsr()).tocoo()
+    edge_ids = {(i, j): k for k, (i, j) in enumerate(edges.tolist())}
+    for i, j in zip(tree.row, tree.col):
+        in_tree[edge_ids[(min(i, j), max(i, j))]] = True
+    return in_tree
+
+
+def select_loop_closures(edges, weights, degrees, n_links, budget=None):
+    """Selects loop closure edges by priority.
+
+    An edge is selected if any of its nodes has less than n_links links,
+    counting the links of previously selected edges.
+
+    Args:
+        edges (numpy.ndarray [M, 2] of int): candidate pairs of node ids
+        weights (numpy.ndarray [M,]): edge weights, higher is preferred
+        degrees (numpy.ndarray [N,] of int): number of links of each node
+        n_links (int): number of links wanted for each node, if None,
+            all edges are selected (within the budget)
+        budget (int): max number of selected edges, if None, unbounded
+
+    Returns:
+        numpy.ndarray of int: positions of selected edges, by priority
+    """
+    degrees = np.array(degrees, dtype=int)
+    selected = []
+    for k in np.argsort(-np.asarray(weights), kind='stable'):
+        if budget is not None and len(selected) >= budget:
+            break
+        i, j = edges[k]
+        if n_links is None or min(degrees[i], degrees[j]) < n_links:
+            selected.append(k)
+            degrees[i] += 1
+            degrees[j] += 1
+    return np.array(selected, dtype=int)
+
+
 def get_links(graph, links, subset=None, symmetric=True):
     """Get all the links associated with a graph.
 
     Args:
-        graph (collections.defaultdict(list)): {k: [v0, v1, ...]}
-            the graph defining the universe of links to be considered
+        graph (Graph or dict of list): {k: [v0, v1, ...]}
+            the graph defining the universe of links to be considered,
+            made symmetric
         links (dict): containing all links, this is a super set of the
             returned links
         subset (list of tuple of int): list of indices of images to be
@@ -111,32 +460,63 @@ def get_links(graph, links, subset=None, symmetric=True):
         symmetric (bool): whether a link should be included twice
             (i to j and j to i), if False, return links with i < j
     """
-    if subset is None:
-        sub_graph = graph
-    else:
-        sub_graph = collections.defaultdict(list)
-        for i, js in graph.items():
-            if i in subset:
-                for j in js:
-                    if j in subset:
-                        sub_graph[i].append(j)
+    sub_graph = Graph.from_dict(graph)
+    if subset is not None:
+        sub_graph = sub_graph.subgraph(subset)
     sub_links = {}
-    for i, js in sub_graph.items():
-        for j in js:
-            if i < j:
-                sub_links[(i, j)] = links[(i, j)]
-            else:
-                if symmetric:
-                    sub_links[(i, j)] = links[(i, j)]
+    for i, j in sub_graph.get_edges():
+        i, j = sub_graph.nodes[i], sub_graph.nodes[j]
+        if j < i:
+            i, j = j, i
+        sub_links[(i, j)] = links[(i, j)]
+        if symmetric:
+            sub_links[(j, i)] = links[(j, i)]
     return sub_links
 
 
+def order_pairs(pairs, method=None):
+    """Orders pairs of nodes for processing.
+
+    Args:
+        pairs (list of tuple [2,]): pairs of nodes (i, j)
+        method (str): in [None, 'locality']
+            None: keep the original order
+            locality: nodes are ordered with the reverse Cuthill-McKee
+                algorithm, which keeps neighboring nodes close in the order,
+                pairs are then visited by (later node, earlier node), so that
+                consecutive pairs share images, maximizing cache hits
+
+    Returns:
+        list of int: positions of pairs in the new order
+    """
+    if method is None or len(pairs) == 0:
+        return list(range(len(pairs)))
+    elif method == 'locality':
+        nodes = sorted(set(k for pair in pairs for k in pair))
+        node_ids = {node: i for i, node in enumerate(nodes)}
+        ids = np.array([[node_ids[i], node_ids[j]] for i, j in pairs])
+        adjacency = scipy.sparse.coo_matrix(
+            (np.ones(ids.shape[0] * 2),
+             (np.concatenate([ids[:, 0], ids[:, 1]]),
+              np.concatenate([ids[:, 1], ids[:, 0]]))),
+            shape=(len(nodes), len(nodes))).tocsr()
+        perm = scipy.sparse.csgraph.reverse_cuthill_mckee(
+            adjacency, symmetric_mode=True)
+        rank = np.empty(len(nodes), dtype=int)
+        rank[perm] = np.arange(len(nodes))
+        ranks = rank[ids]
+        # sort by later node, then earlier node (last key is primary)
+        return np.lexsort((ranks.min(axis=1), ranks.max(axis=1))).tolist()
+    else:
+        raise NotImplementedError
+
+
 def traverse(graph, start_node, method):
     """Depth/breadth first search on a graph.
 
     Args:
-        graph (dict of list): keys are node names, values are neighbor
-            node names
+        graph (Graph or dict of list): keys are node names, values are
+            neighbor node names
         start_node (same as graph keys): name of the starting node, should
             be in graph keys
         method (str): in ['dfs', 'bfs'] depth/breadth first search
@@ -146,23 +526,23 @@ def traverse(graph, start_node, method):
     """
     assert method in ['dfs', 'bfs']
     path = collections.OrderedDict()
-    # visited is a list of tuples (node, parent), initialize with starting node
-    visited = [(start_node, None)]
+    # visited is a deque of tuples (node, parent),
+    # initialize with starting node
+    visited = collections.deque([(start_node, None)])
     while len(visited) > 0:
         if method == 'dfs':
             # pop from the right
             current, parent = visited.pop()
         elif method == 'bfs':
             # pop from the left
-            current, parent = visited.pop(0)
-        if current not in path.keys():
+            current, parent = visited.popleft()
+        if current not in path:
             path[current] = parent
             # reverse to maintain original priority for DFS
             order = -1 if method == 'dfs' else 1
             for neighbor in graph[current][::order]:
-                if neighbor not in path.keys():
+                if neighbor not in path:
                     visited.append((neighbor, current))
-            print(current)
     return path
 
 
@@ -170,18 +550,10 @@ def get_subgraphs(graph):
     """Gets all the connected subgraphs of the graphs.
 
     Args:
-        graph (dict of list): keys are node names, values are neighbor
-            node names
+        graph (Graph or dict of list): keys are node names, values are
+            neighbor node names
 
     Returns:
         list of set: each subgraph is a set of keys
     """
-    subgraphs = []
-    not_visited = set(graph.keys())
-    while len(not_visited) > 0:
-        subgraph = traverse(
-            graph=graph, start_node=not_visited.pop(), method='bfs')
-        subgraph = set(subgraph.keys())
-        not_visited = not_visited - subgraph
-        subgraphs.append(subgraph)
-    return subgraphs
+    return Graph.from_dict(graph).connected_components()
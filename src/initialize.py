@@ -59,6 +59,78 @@ def parse_sortie(sortie_dir, sortie_input_type):
     return df
 
 
+def get_angle_diff(a, b):
+    """Gets the absolute difference between angles (in radians), in [0, pi].
+    """
+    return np.abs(np.angle(np.exp(1j * (np.asarray(a) - np.asarray(b)))))
+
+
+def estimate_headings(positions, max_turn=np.pi / 4):
+    """Estimates the heading of each image from a sequence of positions.
+
+    The heading of an image is the course to the next image, unless the
+    course turns right after (the image is at the end of a flight line),
+    then it is the course from the previous image.
+
+    Args:
+        positions (numpy.ndarray [N, 2]): x, y of images, in capture order
+        max_turn (float): max change of course (in radians) within a line
+
+    Returns:
+        numpy.ndarray [N,]: headings (in radians)
+    """
+    positions = np.asarray(positions, dtype=float)
+    if len(positions) < 2:
+        return np.zeros(len(positions))
+    diff = np.diff(positions, axis=0)
+    # course from image i to image i + 1
+    courses = np.arctan2(diff[:, 1], diff[:, 0])
+    headings = np.append(courses, courses[-1])
+    # the course from image i + 1 to image i + 2 (for the last images,
+    # the course itself, i.e., no turn)
+    next_courses = np.append(courses[1:], courses[-1])
+    prev_courses = np.insert(courses, 0, courses[0])[:-1]
+    turn = get_angle_diff(courses, next_courses) > max_turn
+    headings[:-1][turn] = prev_courses[turn]
+    return headings
+
+
+def segment_swaths(positions, headings=None, max_turn=np.pi / 4,
+                   max_gap=3):
+    """Segments a sequence of images into swaths (flight lines).
+
+    A new swath starts when the heading changes by more than max_turn, or
+    when the distance between consecutive images is more than max_gap times
+    the median distance.
+
+    Args:
+        positions (numpy.ndarray [N, 2]): x, y of images, in capture order
+        headings (numpy.ndarray [N,]): headings (yaw) of images (in radians),
+            if None, estimated from positions, see estimate_headings()
+        max_turn (float): max change of heading (in radians) within a swath
+        max_gap (float): max distance between consecutive images within a
+            swath, in multiples of the median distance
+
+    Returns:
+        numpy.ndarray [N,] of int: swath ids, increasing in capture order
+        numpy.ndarray [N,] of int: order of images within their swaths
+    """
+    positions = np.asarray(positions, dtype=float)
+    if len(positions) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    if headings is None:
+        headings = estimate_headings(positions, max_turn=max_turn)
+    dist = np.linalg.norm(np.diff(positions, axis=0), axis=1)
+    breaks = get_angle_diff(headings[1:], headings[:-1]) > max_turn
+    if len(dist) > 0 and max_gap is not None:
+        breaks |= dist > max_gap * np.median(dist)
+    swath_ids = np.concatenate([[0], np.cumsum(breaks)])
+    # position within swath: index minus the index of the swath start
+    starts = np.flatnonzero(np.concatenate([[True], breaks]))
+    orders = np.arange(len(positions)) - starts[swath_ids]
+    return swath_ids, orders
+
+
 def initialize_centroids(indices, links, widths, heights, x0, x1, y0, y1):
     """Within a swath, initialize centroids with relative transforms.
 
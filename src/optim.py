@@ -2,6 +2,10 @@ import os
 import shutil
 import warnings
 import numpy as np
+import scipy
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.optimize
 import rasterio.transform
 import matplotlib
 import matplotlib.cm
@@ -17,6 +21,11 @@ with warnings.catch_warnings():
 torch.manual_seed(0)
 np.set_printoptions(precision=4)
 
+# stopping reasons of optimize_least_squares() by the status of
+# scipy.optimize.least_squares
+STOP_REASONS = {-1: 'improper_input', 0: 'max_nfev', 1: 'gtol', 2: 'ftol',
+                3: 'xtol', 4: 'ftol_xtol'}
+
 
 def get_distribution(tensor, k=1):
     """Generates a dict of informative summary stats for tensor.
@@ -45,7 +54,9 @@ def optimize(nodes, links, width, height,
              thetas_init, scales_init, xs_init, ys_init,
              n_iter=1, lr_theta=0, lr_scale=0, lr_xy=0,
              lr_scheduler_milestones=None,
-             output_iter=None, logging=False, logdir=None, verbose=True):
+             output_iter=None, logging=False, logdir=None, verbose=True,
+             rtol=None, grad_tol=None, step_tol=None, patience=1,
+             return_stop=False):
     """Globally minimize loss by adjusting affine transforms.
 
     The loss function is the mean of distance between true relative
@@ -54,6 +65,9 @@ def optimize(nodes, links, width, height,
     as calculated from parameterized affine transformations that are
     optimized over.
 
+    Optimization stops early once a stopping criterion (rtol, grad_tol or
+    step_tol) is met for patience consecutive iterations.
+
     Args:
         nodes (list of (int, int)): ids of images in the graph
         links (dict): {((int, int), (int, int)): affine.Affine} "true"
@@ -79,11 +93,24 @@ def optimize(nodes, links, width, height,
         logging (bool): whether to turn on TensorBoard logging
         logdir (str): where to store tf events files
         verbose (bool)
+        rtol (float): min relative change of loss between iterations,
+            disabled if None
+        grad_tol (float): min absolute value of gradients (max over all
+            parameters), disabled if None
+        step_tol (float): min absolute change of parameters in an iteration
+            (max over all parameters), disabled if None
+        patience (int): number of consecutive iterations a criterion must be
+            met before stopping
+        return_stop (bool): whether to also return the stopping iteration
+            and reason
 
     Returns:
         tuple (list of int, list of float, list of list of affine.Affine):
-            iterations, losses at those iterations,
-            transforms estimated at those iterations
+            iterations (in output_iter, and the stopping iteration), losses
+            at those iterations, transforms estimated at those iterations,
+            followed (if return_stop) by a tuple (int, str) of the stopping
+            iteration and reason (in ['n_iter', 'rtol', 'grad_tol',
+            'step_tol'])
     """
     if logging:
         if os.path.isdir(logdir):
@@ -175,8 +202,13 @@ def optimize(nodes, links, width, height,
 
     # prepare to collect output
     assert (n_iter - 1) in output_iter, 'Last iteration not saved!'
+    output_iters = []
     output_loss = []
     output_affines = []
+    # prepare for early stopping
+    stop_iter, stop_reason = n_iter - 1, 'n_iter'
+    prev_loss = None
+    n_converged = 0
 
     # iterate n_iter times
     for k in range(n_iter):
@@ -278,15 +310,19 @@ def optimize(nodes, links, width, height,
         if verbose:
             if (k + 1) % 200 == 0:
                 print('Iter: {}; Loss: {:.3f}'.format(k, loss.item()))
-        # output affines and loss
-        if k in output_iter:
-            output_loss.append(loss.item())
-            output_affine = [
-                rasterio.transform.Affine(*img_affine[0:2, :].flatten())
-                for img_affine in affines.detach().numpy()]
-            output_affines.append(output_affine)
         # back propagate
         loss.backward()
+        # check stopping criteria
+        converged = None
+        if (rtol is not None and prev_loss is not None and
+                abs(prev_loss - loss.item()) <= rtol * abs(prev_loss)):
+            converged = 'rtol'
+        prev_loss = loss.item()
+        params = [thetas, scales, xs, ys]
+        if grad_tol is not None and max(
+                p.grad.abs().max().item() for p in params) <= grad_tol:
+            converged = 'grad_tol'
+        params_prev = [p.detach().clone() for p in params]
         optimizer_theta.step()
         optimizer_scale.step()
         optimizer_xy.step()
@@ -295,11 +331,166 @@ def optimize(nodes, links, width, height,
             lr_scheduler_theta.step()
             lr_scheduler_scale.step()
             lr_scheduler_xy.step()
+        if step_tol is not None and max(
+                (p.detach() - p_prev).abs().max().item()
+                for p, p_prev in zip(params, params_prev)) <= step_tol:
+            converged = 'step_tol'
+        n_converged = 0 if converged is None else n_converged + 1
+        stop = n_converged >= patience
+        # output affines and loss (before this iteration's update)
+        if k in output_iter or stop:
+            output_iters.append(k)
+            output_loss.append(loss.item())
+            output_affine = [
+                rasterio.transform.Affine(*img_affine[0:2, :].flatten())
+                for img_affine in affines.detach().numpy()]
+            output_affines.append(output_affine)
+        if stop:
+            stop_iter, stop_reason = k, converged
+            if verbose:
+                print('Stopping at iter {} ({}); Loss: {:.3f}'.format(
+                    k, converged, loss.item()))
+            break
 
     if logging:
         writer.close()
         
     print("Thetas: ", str(thetas))
-    
-    return output_iter, output_loss, output_affines
 
+    if return_stop:
+        return (output_iters, output_loss, output_affines,
+                (stop_iter, stop_reason))
+    return output_iters, output_loss, output_affines
+
+
+def get_affines(thetas, scales, xs, ys, width, height):
+    """Computes affine transforms from parameters, see optimize().
+
+    Args:
+        thetas, scales, xs, ys (numpy.ndarray [N,]): parameters of images
+        width, height (numpy.ndarray [N,]): (width, height) of images
+
+    Returns:
+        numpy.ndarray [N, 3, 3]: affine transforms
+    """
+    cos, sin = np.cos(thetas) * scales, np.sin(thetas) * scales
+    affines = np.zeros((len(thetas), 3, 3))
+    affines[:, 0, 0] = cos
+    affines[:, 0, 1] = - sin
+    affines[:, 0, 2] = xs - width / 2 * cos + height / 2 * sin
+    affines[:, 1, 0] = sin
+    affines[:, 1, 1] = cos
+    affines[:, 1, 2] = ys - width / 2 * sin - height / 2 * cos
+    affines[:, 2, 2] = 1
+    return affines
+
+
+def optimize_least_squares(nodes, links, width, height,
+                           thetas_init, scales_init, xs_init, ys_init,
+                           max_nfev=None, ftol=1e-10, xtol=1e-10,
+                           verbose=True, return_stop=False):
+    """Globally minimize loss by sparse nonlinear least squares.
+
+    Minimizes the same loss as optimize(), with the trust region reflective
+    solver of scipy.optimize.least_squares. Each link only depends on the
+    parameters of its two images, so the Jacobian is block sparse and is
+    estimated by finite differences over groups of independent parameters.
+    Parameters are scaled by the norms of the Jacobian columns, so that no
+    learning rate is needed.
+
+    Links only constrain relative transforms, so the first image of each
+    connected component (and images without links) is kept at its initial
+    values.
+
+    Args:
+        nodes, links, width, height, thetas_init, scales_init, xs_init,
+            ys_init: see optimize()
+        max_nfev (int): max number of function evaluations, if None,
+            defaults to scipy's default
+        ftol, xtol (float): tolerances for termination by the change of
+            loss and parameters, passed to scipy.optimize.least_squares
+        verbose (bool)
+        return_stop (bool): whether to also return the number of function
+            evaluations and the stopping reason (see STOP_REASONS)
+
+    Returns:
+        tuple (list of int, list of float, list of list of affine.Affine):
+            number of function evaluations, loss and transforms at the end
+            of optimization, same format as optimize()
+    """
+    node_ids = {node: k for k, node in enumerate(nodes)}
+    i_idx, j_idx, rel_true = [], [], []
+    for (i, j), trans in links.items():
+        if trans is not None:
+            i_idx.append(node_ids[i])
+            j_idx.append(node_ids[j])
+            rel_true.append(np.array(trans).reshape(3, 3))
+    if len(rel_true) == 0:
+        raise ValueError('No links available for optimization.')
+    i_idx, j_idx = np.array(i_idx), np.array(j_idx)
+    rel_true = np.stack(rel_true)  # [n_links, 3, 3]
+    width = np.asarray(width, dtype=float)
+    height = np.asarray(height, dtype=float)
+    n_nodes, n_links = len(nodes), len(rel_true)
+    # points: four corners of the j image, [n_links, 3, n_pts]
+    w, h = width[j_idx], height[j_idx]
+    pts = np.stack([
+        np.stack([np.zeros(n_links), np.zeros(n_links), w, w]),
+        np.stack([np.zeros(n_links), h, np.zeros(n_links), h]),
+        np.ones((4, n_links))]).transpose(2, 0, 1)
+    pts_true = np.matmul(rel_true, pts)[:, 0:2, :]
+
+    # fix the first image of each connected component
+    _, labels = scipy.sparse.csgraph.connected_components(
+        scipy.sparse.coo_matrix(
+            (np.ones(n_links), (i_idx, j_idx)), shape=(n_nodes, n_nodes)),
+        directed=False)
+    linked = np.zeros(n_nodes, dtype=bool)
+    linked[i_idx] = linked[j_idx] = True
+    _, anchors = np.unique(labels, return_index=True)
+    free_nodes = linked.copy()
+    free_nodes[anchors] = False
+    # parameters are ordered as thetas, scales, xs, ys
+    free = np.tile(free_nodes, 4)
+    params_init = np.concatenate([
+        np.asarray(v, dtype=float)
+        for v in (thetas_init, scales_init, xs_init, ys_init)])
+
+    def get_params(free_params):
+        params = params_init.copy()
+        params[free] = free_params
+        return params
+
+    def residuals(free_params):
+        params = get_params(free_params)
+        affines = get_affines(*params.reshape(4, n_nodes), width, height)
+        rel_est = np.matmul(np.linalg.inv(affines[i_idx]), affines[j_idx])
+        return (np.matmul(rel_est, pts)[:, 0:2, :] - pts_true).ravel()
+
+    # residuals of a link depend on the 4 parameters of images i and j
+    rows = np.arange(n_links * 8).reshape(n_links, 8, 1)
+    cols = (np.arange(4)[np.newaxis, :, np.newaxis] * n_nodes +
+            np.stack([i_idx, j_idx], axis=1)[:, np.newaxis, :])
+    rows, cols = np.broadcast_arrays(rows, cols.reshape(n_links, 1, 8))
+    sparsity = scipy.sparse.coo_matrix(
+        (np.ones(rows.size, dtype=int), (rows.ravel(), cols.ravel())),
+        shape=(n_links * 8, n_nodes * 4)).tocsc()[:, free]
+
+    result = scipy.optimize.least_squares(
+        residuals, params_init[free], jac_sparsity=sparsity, method='trf',
+        x_scale='jac', max_nfev=max_nfev, ftol=ftol, xtol=xtol,
+        verbose=1 if verbose else 0)
+    # loss as in optimize(): mean squared distance over points and links
+    loss = float((result.fun ** 2).sum() / (n_links * 4))
+    if verbose:
+        print('Evals: {}; Loss: {:.3f}'.format(result.nfev, loss))
+    affines = get_affines(*get_params(result.x).reshape(4, n_nodes),
+                          width, height)
+    output_affines = [
+        rasterio.transform.Affine(*affine[0:2, :].flatten())
+        for affine in affines]
+    if return_stop:
+        stop_reason = STOP_REASONS.get(result.status, result.message)
+        return ([result.nfev], [loss], [output_affines],
+                (result.nfev, stop_reason))
+    return [result.nfev], [loss], [output_affines]
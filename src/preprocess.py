@@ -1,13 +1,126 @@
 import os
+import tempfile
 import warnings
+import itertools
+import concurrent.futures
+import tqdm
 import cv2 as cv
 import rasterio
 import rasterio.transform
+import rasterio.windows
+import rasterio.enums
 import numpy as np
 
 
-def preprocess(file, scale=None, crop=None, cache=False, cache_dir=None):
-    """Loads the aerial photo. Cache to reduce loading time.
+def get_cache_file(cache_dir, file, scale=None, crop=None, multiband=False):
+    """Generates the cache file path for a preprocessed image.
+
+    Every combination of scale and crop is cached in a separate file, so
+    that a pyramid of resolutions can be cached for the same image.
+
+    Args:
+        cache_dir (str): directory for storing cache images
+        file (str): file path to the original image
+        scale (float): scaling factor, None is equivalent to 1
+        crop (dict): 4 keys: 'top', 'bottom', 'left', 'right'
+            if None, no cropping
+        multiband (bool): whether all bands are cached (instead of grayscale)
+
+    Returns:
+        str: path to the cached GeoTIFF file
+    """
+    name = [os.path.splitext(os.path.basename(file))[0],
+            's{:g}'.format(1 if scale is None else scale)]
+    if crop is not None:
+        name.append('c{:g}-{:g}-{:g}-{:g}'.format(
+            crop['top'], crop['bottom'], crop['left'], crop['right']))
+    if multiband:
+        name.append('multiband')
+    return os.path.join(cache_dir, '_'.join(name) + '.tif')
+
+
+def is_cache_valid(cache_file, file):
+    """Checks whether a cached image exists and is up to date.
+
+    Args:
+        cache_file (str): path to the cached GeoTIFF file
+        file (str): file path to the original image, the cache is considered
+            stale if the original image has been modified since caching
+
+    Returns:
+        bool
+    """
+    return (os.path.isfile(cache_file) and
+            os.path.getmtime(cache_file) >= os.path.getmtime(file))
+
+
+def load_cache(cache_file, file):
+    """Loads a cached image, the original image is not opened.
+
+    Args:
+        cache_file (str): path to the cached GeoTIFF file
+        file (str): file path to the original image, the cache is considered
+            stale if the original image has been modified since caching
+
+    Returns:
+        tuple (numpy.ndarray [bands, height, width], affine.Affine) or
+            NoneType: cached image and transform, None if no valid cache
+    """
+    if not is_cache_valid(cache_file, file):
+        return None
+    with rasterio.open(cache_file) as cache_ds:
+        return cache_ds.read(), cache_ds.transform
+
+
+def save_cache(cache_file, img, trans):
+    """Saves an image to the cache.
+
+    The image is written to a temporary file first and then moved in place,
+    so concurrent readers never see a partially written cache.
+
+    Args:
+        cache_file (str): path to the cached GeoTIFF file
+        img (numpy.ndarray [height, width] or [bands, height, width]): image
+        trans (affine.Affine): the geo transform from the image to the
+            original image
+    """
+    img = img[np.newaxis, ...] if img.ndim == 2 else img
+    count, height, width = img.shape
+    fd, tmp_file = tempfile.mkstemp(
+        dir=os.path.dirname(cache_file), suffix='.tif')
+    os.close(fd)
+    with rasterio.open(tmp_file, 'w', driver='GTiff',
+                       height=height, width=width, count=count,
+                       dtype=rasterio.uint8,
+                       transform=trans) as out_ds:
+        out_ds.write(img)
+    os.replace(tmp_file, cache_file)
+
+
+def read_size(file):
+    """Reads the size of an image from its metadata.
+
+    Args:
+        file (str): file path
+
+    Returns:
+        tuple of int: width, height (in pixels)
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter(
+            action='ignore',
+            category=rasterio.errors.NotGeoreferencedWarning)
+        with rasterio.open(file) as ds:
+            return ds.width, ds.height
+
+
+def read_window(file, scale=None, crop=None):
+    """Reads the cropped and scaled image, all bands are kept.
+
+    Only the crop window is decoded. When scaling, a resampled read at the
+    output resolution is requested, so that reduced resolution decoding
+    (e.g., JPEG DCT scaling exposed as overviews by GDAL) can be used and
+    the full resolution array is never materialized.
 
     Args:
         file (str): file path
@@ -16,12 +129,9 @@ def preprocess(file, scale=None, crop=None, cache=False, cache_dir=None):
         crop (dict): 4 keys: 'top', 'bottom', 'left', 'right'
             each value is a float in (0, 1), representing the proportion
             of image width/height; if None, no cropping
-        cache (bool): whether to cache images to speed up processing
-        cache_dir (str): cannot be None if cache is True, NOTE: ALL CACHED
-            IMAGES NEED TO HAVE A UNIQUE NAME
 
     Returns:
-        numpy.ndarray [height, width]: loaded grayscale image
+        numpy.ndarray [bands, height, width]: loaded image
         affine.Affine: the geo transform from the loaded image to the
             original image, NOT to crs units
     """
@@ -31,63 +141,106 @@ def preprocess(file, scale=None, crop=None, cache=False, cache_dir=None):
     else:
         skip_scale = False
     if crop is None:
-        skip_crop = True
         crop = {'top': 0, 'bottom': 1, 'left': 0, 'right': 1}
-    else:
-        skip_crop = False
-    # read original image metadata
     with warnings.catch_warnings():
         warnings.simplefilter(
             action='ignore',
             category=rasterio.errors.NotGeoreferencedWarning)
-        raw_ds = rasterio.open(file)
-        raw_width, raw_height = raw_ds.width, raw_ds.height
-    # compute transform and output size
-    out_trans = rasterio.transform.Affine(
-        1 / scale, 0., int(round(crop['left'] * raw_width)),
-        0., 1 / scale, int(round(crop['top'] * raw_height)))
-    out_width = int(round((crop['right'] - crop['left']) *
-                          raw_width * scale))
-    out_height = int(round((crop['bottom'] - crop['top']) *
-                           raw_height * scale))
+        with rasterio.open(file) as raw_ds:
+            raw_width, raw_height = raw_ds.width, raw_ds.height
+            # compute transform and output size
+            out_trans = rasterio.transform.Affine(
+                1 / scale, 0., int(round(crop['left'] * raw_width)),
+                0., 1 / scale, int(round(crop['top'] * raw_height)))
+            out_width = int(round((crop['right'] - crop['left']) *
+                                  raw_width * scale))
+            out_height = int(round((crop['bottom'] - crop['top']) *
+                                   raw_height * scale))
+            # crop black border
+            window = rasterio.windows.Window.from_slices(
+                (int(crop['top'] * raw_height),
+                 int(crop['bottom'] * raw_height)),
+                (int(crop['left'] * raw_width),
+                 int(crop['right'] * raw_width)))
+            if skip_scale:
+                img = raw_ds.read(window=window)
+            else:
+                # resize while reading, area averaging for down-resolutioning
+                img = raw_ds.read(
+                    window=window,
+                    out_shape=(raw_ds.count, out_height, out_width),
+                    resampling=(rasterio.enums.Resampling.average
+                                if scale < 1 else
+                                rasterio.enums.Resampling.bilinear))
+    return img, out_trans
+
+
+def to_grayscale(img):
+    """Converts an image to grayscale without floating point temporaries.
+
+    RGB(A) images are converted with the weighted integer conversion in
+    OpenCV (ITU-R BT.601 luma), other multi-band images are averaged with
+    integer arithmetic. The dtype of the input (e.g., uint8, uint16) is kept.
+
+    Args:
+        img (numpy.ndarray [bands, height, width]): input image
+
+    Returns:
+        numpy.ndarray [height, width]: grayscale image
+    """
+    count = img.shape[0]
+    if count == 1:
+        return img[0]
+    if count in (3, 4):
+        # interleave bands for OpenCV, same dtype as input
+        return cv.cvtColor(cv.merge(list(img[0:3])), cv.COLOR_RGB2GRAY)
+    # integer mean with rounding, accumulated in a wider integer type
+    total = img.sum(axis=0, dtype=np.uint64 if img.itemsize > 2
+                    else np.uint32)
+    return ((total + count // 2) // count).astype(img.dtype)
+
+
+def preprocess(file, scale=None, crop=None, cache=False, cache_dir=None):
+    """Loads the aerial photo. Cache to reduce loading time.
+
+    Args:
+        file (str): file path
+        scale (float): scaling factor, <1 means down-resolutioning
+            if None, no scaling
+        crop (dict): 4 keys: 'top', 'bottom', 'left', 'right'
+            each value is a float in (0, 1), representing the proportion
+            of image width/height; if None, no cropping
+        cache (bool): whether to cache images to speed up processing
+        cache_dir (str): cannot be None if cache is True, NOTE: ALL CACHED
+            IMAGES NEED TO HAVE A UNIQUE NAME
+            each combination of scale and crop is cached separately, cached
+            images are loaded without opening the original image
+
+    Returns:
+        numpy.ndarray [height, width]: loaded grayscale image
+        affine.Affine: the geo transform from the loaded image to the
+            original image, NOT to crs units
+    """
     # determine if cached images would be used
     if cache:
         assert cache_dir is not None
         # generate cache file path
-        cache_file = os.path.join(
-            cache_dir, os.path.splitext(os.path.basename(file))[0] + '.tif')
-        if os.path.isfile(cache_file):
-            # load cached file if it exists
-            cache_ds = rasterio.open(cache_file)
-            if (out_trans.almost_equals(cache_ds.transform) and
-                    out_width == cache_ds.width and
-                    out_height == cache_ds.height):
-                return cache_ds.read().squeeze(0), cache_ds.transform
+        cache_file = get_cache_file(cache_dir, file, scale=scale, crop=crop)
+        output = load_cache(cache_file, file)
+        if output is not None:
+            img, trans = output
+            return img.squeeze(0), trans
     # otherwise, process the raw file
-    if raw_ds.count > 1:
-        img = raw_ds.read().mean(0)
-        img = img.astype(np.uint8)  # convert from float64 to uint8
-    else:
-        img = raw_ds.read().squeeze(0)
-    if not skip_crop:
-        # crop black border
-        img = img[
-            int(crop['top'] * raw_height):int(crop['bottom'] * raw_height),
-            int(crop['left'] * raw_width):int(crop['right'] * raw_width)]
-    if not skip_scale:
-        # resize
-        img = cv.resize(img, dsize=(out_width, out_height))
+    img, out_trans = read_window(file, scale=scale, crop=crop)
+    img = to_grayscale(img).astype(np.uint8, copy=False)
     # save if caching
     if cache:
-        with rasterio.open(cache_file, 'w', driver='GTiff',
-                           height=out_height, width=out_width, count=1,
-                           dtype=rasterio.uint8,
-                           transform=out_trans) as out_ds:
-            out_ds.write(img, 1)
+        save_cache(cache_file, img, out_trans)
     return img, out_trans
 
+
 def show_preprocess(file, scale=None, crop=None, cache=False, cache_dir=None):
-    """Loads the aerial photo. Cache to reduce loading time.
+    """Loads the aerial photo with all bands. Cache to reduce loading time.
 
     Args:
         file (str): file path
@@ -99,68 +252,75 @@ def show_preprocess(file, scale=None, crop=None, cache=False, cache_dir=None):
         cache (bool): whether to cache images to speed up processing
         cache_dir (str): cannot be None if cache is True, NOTE: ALL CACHED
             IMAGES NEED TO HAVE A UNIQUE NAME
+            each combination of scale and crop is cached separately, cached
+            images are loaded without opening the original image
 
     Returns:
-        numpy.ndarray [height, width]: loaded grayscale image
+        numpy.ndarray [bands, height, width]: loaded image
         affine.Affine: the geo transform from the loaded image to the
             original image, NOT to crs units
     """
-    if scale is None:
-        skip_scale = True
-        scale = 1
-    else:
-        skip_scale = False
-    if crop is None:
-        skip_crop = True
-        crop = {'top': 0, 'bottom': 1, 'left': 0, 'right': 1}
-    else:
-        skip_crop = False
-    # read original image metadata
-    with warnings.catch_warnings():
-        warnings.simplefilter(
-            action='ignore',
-            category=rasterio.errors.NotGeoreferencedWarning)
-        raw_ds = rasterio.open(file)
-        raw_width, raw_height = raw_ds.width, raw_ds.height
-    # compute transform and output size
-    out_trans = rasterio.transform.Affine(
-        1 / scale, 0., int(round(crop['left'] * raw_width)),
-        0., 1 / scale, int(round(crop['top'] * raw_height)))
-    out_width = int(round((crop['right'] - crop['left']) *
-                          raw_width * scale))
-    out_height = int(round((crop['bottom'] - crop['top']) *
-                           raw_height * scale))
     # determine if cached images would be used
     if cache:
         assert cache_dir is not None
         # generate cache file path
-        cache_file = os.path.join(
-            cache_dir, os.path.splitext(os.path.basename(file))[0] + '.tif')
-        if os.path.isfile(cache_file):
-            # load cached file if it exists
-            cache_ds = rasterio.open(cache_file)
-            if (out_trans.almost_equals(cache_ds.transform) and
-                    out_width == cache_ds.width and
-                    out_height == cache_ds.height):
-                return cache_ds.read().squeeze(0), cache_ds.transform
+        cache_file = get_cache_file(
+            cache_dir, file, scale=scale, crop=crop, multiband=True)
+        output = load_cache(cache_file, file)
+        if output is not None:
+            return output
     # otherwise, process the raw file
-    
-    img = raw_ds.read()
-    img = img.astype(np.uint8)  # convert from float64 to uint8
-
-    if not skip_crop:
-        # crop black border
-        img = img[:, 
-            int(crop['top'] * raw_height):int(crop['bottom'] * raw_height),
-            int(crop['left'] * raw_width):int(crop['right'] * raw_width)]
-    if not skip_scale:
-        # resize
-        img = cv.resize(img, dsize=(out_width, out_height))
+    img, out_trans = read_window(file, scale=scale, crop=crop)
+    img = img.astype(np.uint8)
     # save if caching
     if cache:
-        with rasterio.open(cache_file, 'w', driver='GTiff',
-                           height=out_height, width=out_width, count=1,
-                           dtype=rasterio.uint8,
-                           transform=out_trans) as out_ds:
-            out_ds.write(img, 1)
-    return img, out_trans
\ No newline at end of file
+        save_cache(cache_file, img, out_trans)
+    return img, out_trans
+
+
+def _warm(file, scale, crop, cache_dir):
+    """Fills the cache for one image and setting, used by warm_cache()."""
+    cache_file = get_cache_file(cache_dir, file, scale=scale, crop=crop)
+    if is_cache_valid(cache_file, file):
+        return 0
+    preprocess(file, scale=scale, crop=crop, cache=True, cache_dir=cache_dir)
+    return os.path.getsize(cache_file)
+
+
+def warm_cache(files, scales, crop, cache_dir, n_workers=None):
+    """Precomputes the preprocessing cache for many images.
+
+    This separates I/O heavy decoding from matching. Valid cache entries
+    are skipped.
+
+    Args:
+        files (list of str): file paths
+        scales (list of float): scaling factors, every scale is cached
+        crop (dict): 4 keys: 'top', 'bottom', 'left', 'right'
+            if None, no cropping
+        cache_dir (str): directory for storing cache images
+        n_workers (int): number of worker processes, if None or 1,
+            images are processed serially
+
+    Returns:
+        dict: summary with keys 'n_written', 'n_skipped', 'bytes_written'
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    tasks = list(itertools.product(files, scales))
+    args = ([f for f, _ in tasks], [s for _, s in tasks],
+            itertools.repeat(crop), itertools.repeat(cache_dir))
+    if n_workers is None or n_workers <= 1:
+        results = map(_warm, *args)
+        results = list(tqdm.tqdm(results, total=len(tasks),
+                                 desc='Warming cache.'))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(n_workers) as pool:
+            results = pool.map(
+                _warm, *args,
+                chunksize=max(1, len(tasks) // (n_workers * 4)))
+            results = list(tqdm.tqdm(results, total=len(tasks),
+                                     desc='Warming cache.'))
+    n_written = sum(1 for r in results if r > 0)
+    return {'n_written': n_written,
+            'n_skipped': len(results) - n_written,
+            'bytes_written': sum(results)}
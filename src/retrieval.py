@@ -0,0 +1,287 @@
+import warnings
+import numpy as np
+import scipy
+import scipy.sparse
+import scipy.spatial
+import scipy.cluster.vq
+
+
+def to_float(des):
+    """Converts descriptors to float vectors.
+
+    Binary descriptors (uint8) are unpacked to bits, so that euclidean
+    distances between them are hamming distances.
+
+    Args:
+        des (numpy.ndarray [N, D]): descriptors
+
+    Returns:
+        numpy.ndarray [N, D'] of float32: float descriptors
+    """
+    if des.dtype == np.uint8:
+        return np.unpackbits(des, axis=1).astype(np.float32)
+    return des.astype(np.float32, copy=False)
+
+
+def top_per_row(matrix, k):
+    """Keeps the k largest entries of each row of a sparse matrix.
+
+    Args:
+        matrix (scipy.sparse matrix [M, N]): input matrix
+        k (int): number of entries kept per row
+
+    Returns:
+        scipy.sparse.csr_matrix [M, N]: matrix with at most k stored entries
+            per row
+    """
+    matrix = scipy.sparse.csr_matrix(matrix)
+    keep = np.zeros(matrix.nnz, dtype=bool)
+    for start, stop in zip(matrix.indptr[:-1], matrix.indptr[1:]):
+        if stop - start <= k:
+            keep[start:stop] = True
+        else:
+            top = np.argpartition(-matrix.data[start:stop], k - 1)[0:k]
+            keep[start + top] = True
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    return scipy.sparse.csr_matrix(
+        (matrix.data[keep], (rows[keep], matrix.indices[keep])),
+        shape=matrix.shape)
+
+
+class VocabularyTree(object):
+    """Hierarchical k-means quantizer of local descriptors.
+
+    Descriptors are recursively clustered into branching clusters, down to
+    depth levels, the leaves are the visual words. Quantizing a descriptor
+    only compares it to branching centroids per level, so that large
+    vocabularies (branching ** depth words) are cheap to build and to use.
+
+    Args:
+        branching (int): number of children of each node
+        depth (int): number of levels
+        seed (int): random seed for k-means
+    """
+
+    def __init__(self, branching=10, depth=4, seed=0):
+        self.branching = branching
+        self.depth = depth
+        self.seed = seed
+        # centroids of the children of each node, per level,
+        # [branching ** level, branching, D]
+        self.centroids = None
+
+    @property
+    def n_words(self):
+        """int: size of the vocabulary."""
+        return self.branching ** self.depth
+
+    def fit(self, des):
+        """Builds the tree by k-means in every node.
+
+        Args:
+            des (numpy.ndarray [N, D] of float32): sample of descriptors
+
+        Returns:
+            VocabularyTree: self
+        """
+        rng = np.random.RandomState(self.seed)
+        self.centroids = []
+        nodes = np.zeros(len(des), dtype=int)
+        parents = des.mean(axis=0)[np.newaxis, np.newaxis, :]
+        for level in range(self.depth):
+            n_nodes = self.branching ** level
+            centroids = np.empty(
+                (n_nodes, self.branching, des.shape[1]), dtype=np.float32)
+            order = np.argsort(nodes, kind='stable')
+            bounds = np.concatenate(
+                [[0], np.cumsum(np.bincount(nodes, minlength=n_nodes))])
+            for node in range(n_nodes):
+                x = des[order[bounds[node]:bounds[node + 1]]]
+                parent = parents[node // self.branching,
+                                 node % self.branching]
+                centroids[node] = self._cluster(x, parent, rng)
+            self.centroids.append(centroids)
+            nodes = nodes * self.branching + self._assign(
+                des, nodes, centroids)
+            parents = centroids
+        return self
+
+    def _cluster(self, x, parent, rng):
+        """Clusters the descriptors of a node into branching centroids."""
+        unique = np.unique(x, axis=0)
+        if len(unique) <= self.branching:
+            # too few distinct descriptors, leaves are duplicated (and
+            # unused)
+            unique = unique if len(unique) > 0 else parent[np.newaxis, :]
+            return unique[np.arange(self.branching) % len(unique)]
+        with warnings.catch_warnings():
+            # empty clusters are left unused
+            warnings.filterwarnings('ignore', category=UserWarning)
+            centroids, _ = scipy.cluster.vq.kmeans2(
+                x, self.branching, minit='++', seed=rng)
+        return centroids
+
+    def _assign(self, des, nodes, centroids, batch_size=4096):
+        """Finds the nearest child of the node of each descriptor."""
+        children = np.zeros(len(des), dtype=int)
+        for start in range(0, len(des), batch_size):
+            x = des[start:(start + batch_size)]
+            c = centroids[nodes[start:(start + batch_size)]]
+            dist = (np.einsum('nbd,nbd->nb', c, c) -
+                    2 * np.einsum('nd,nbd->nb', x, c))
+            children[start:(start + batch_size)] = dist.argmin(axis=1)
+        return children
+
+    def quantize(self, des):
+        """Quantizes descriptors to visual words.
+
+        Args:
+            des (numpy.ndarray [N, D] of float32): descriptors
+
+        Returns:
+            numpy.ndarray [N,] of int: visual words, in [0, self.n_words)
+        """
+        nodes = np.zeros(len(des), dtype=int)
+        for centroids in self.centroids:
+            nodes = nodes * self.branching + self._assign(
+                des, nodes, centroids)
+        return nodes
+
+
+class RetrievalIndex(object):
+    """Bag of visual words index for retrieving similar images.
+
+    Local descriptors are quantized to visual words (leaves of a vocabulary
+    tree built on a sample of descriptors), each image is described by a
+    tf-idf weighted, L2 normalized histogram of visual words, stored as a
+    sparse matrix. The transposed matrix is the inverted index (word ->
+    images), so that similarities are computed by sparse products, whose
+    cost grows with the number of images sharing words rather than with all
+    pairs of images. Queries only use the top weighted words of each image,
+    which keeps the products sparse. The idf is smoothed, so that words seen
+    in every image still count, with a low weight.
+
+    Args:
+        n_words (int): approximate size of the visual vocabulary, rounded to
+            a power of branching
+        branching (int): branching factor of the vocabulary tree
+        max_samples (int): max number of descriptors sampled for building
+            the vocabulary
+        seed (int): random seed for sampling and k-means
+        query_words (int): number of top weighted words of each image used
+            for querying, all words if None
+    """
+
+    def __init__(self, n_words=10000, branching=10, max_samples=100000,
+                 seed=0, query_words=100):
+        self.n_words = n_words
+        self.branching = branching
+        self.max_samples = max_samples
+        self.seed = seed
+        self.query_words = query_words
+        self.vocabulary = None
+        self.idf = None
+        self.vectors = None
+
+    def fit(self, descriptors):
+        """Builds the vocabulary and indexes images.
+
+        Args:
+            descriptors (list of numpy.ndarray [N_i, D] or NoneType): local
+                descriptors of each image, None if no features are found
+
+        Returns:
+            RetrievalIndex: self
+        """
+        rng = np.random.RandomState(self.seed)
+        des = [to_float(d) for d in descriptors
+               if d is not None and len(d) > 0]
+        if len(des) == 0:
+            raise ValueError('No descriptors to build the vocabulary.')
+        des = np.vstack(des)
+        if len(des) > self.max_samples:
+            des = des[rng.choice(len(des), self.max_samples, replace=False)]
+        depth = max(1, int(round(np.log(self.n_words) /
+                                 np.log(self.branching))))
+        self.vocabulary = VocabularyTree(
+            branching=self.branching, depth=depth, seed=self.seed).fit(des)
+        # term frequencies, [images, words]
+        tf = self.get_histograms(descriptors)
+        n_images = tf.shape[0]
+        doc_freq = np.bincount(tf.indices, minlength=tf.shape[1])
+        # smoothed, words in every image are down weighted, not dropped
+        self.idf = np.log((1 + n_images) / (1 + doc_freq)) + 1
+        self.vectors = self.weight(tf)
+        return self
+
+    def get_histograms(self, descriptors):
+        """Quantizes descriptors to visual word histograms.
+
+        Args:
+            descriptors (list of numpy.ndarray [N_i, D] or NoneType): local
+                descriptors of each image
+
+        Returns:
+            scipy.sparse.csr_matrix [images, words]: normalized word counts
+        """
+        rows, cols = [], []
+        for i, d in enumerate(descriptors):
+            if d is None or len(d) == 0:
+                continue
+            words = self.vocabulary.quantize(to_float(d))
+            rows.append(np.full(len(words), i))
+            cols.append(words)
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=int)
+        cols = np.concatenate(cols) if cols else np.zeros(0, dtype=int)
+        counts = scipy.sparse.csr_matrix(
+            (np.ones(len(rows)), (rows, cols)),
+            shape=(len(descriptors), self.vocabulary.n_words))
+        counts.sum_duplicates()
+        n_words = np.asarray(counts.sum(axis=1)).ravel()
+        return scipy.sparse.diags(1 / np.maximum(n_words, 1)).dot(
+            counts).tocsr()
+
+    def weight(self, tf):
+        """Applies idf weights and L2 normalization to term frequencies."""
+        vectors = tf.dot(scipy.sparse.diags(self.idf)).tocsr()
+        norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)))
+        return scipy.sparse.diags(
+            1 / np.maximum(norms.ravel(), 1e-12)).dot(vectors).tocsr()
+
+    def query(self, k, batch_size=1024):
+        """Retrieves the most similar images for every indexed image.
+
+        Args:
+            k (int): number of retrieved images per image
+            batch_size (int): number of images scored at once
+
+        Returns:
+            numpy.ndarray [M, 2] of int: pairs (i, j) of indexed images with
+                i < j, j is in the top k of i or vice versa
+            numpy.ndarray [M,]: similarities of pairs, over the query words
+        """
+        n_images = self.vectors.shape[0]
+        k = min(k, n_images - 1)
+        if k <= 0:
+            return np.zeros((0, 2), dtype=int), np.zeros(0)
+        inverted = self.vectors.T.tocsr()  # [words, images]
+        queries = (self.vectors if self.query_words is None else
+                   top_per_row(self.vectors, self.query_words))
+        pairs, scores = [], []
+        for start in range(0, n_images, batch_size):
+            stop = min(start + batch_size, n_images)
+            # only images sharing words are scored
+            sim = queries[start:stop].dot(inverted).tocoo()
+            # exclude self
+            sim.data[sim.row + start == sim.col] = 0
+            sim.eliminate_zeros()
+            sim = top_per_row(sim, k).tocoo()
+            pairs.append(np.stack([sim.row + start, sim.col], axis=1))
+            scores.append(sim.data)
+        pairs = np.vstack(pairs)
+        scores = np.concatenate(scores)
+        # images sharing no words are not similar
+        keep = scores > 0
+        pairs, scores = np.sort(pairs[keep], axis=1), scores[keep]
+        pairs, idx = np.unique(pairs, axis=0, return_index=True)
+        return pairs, scores[idx]
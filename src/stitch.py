@@ -1,14 +1,39 @@
+import os
+import time
+import tempfile
+import collections
 import numpy as np
+import scipy.spatial
 import cv2 as cv
 import rasterio
 import rasterio.transform
+import shapely
+import shapely.affinity
 
-from .preprocess import preprocess
+from .preprocess import preprocess, read_size
+from .cache import LRUCache
+from .utils import get_overlap_polygons
+from .features import (keypoints_to_array, array_to_keypoints,
+                       get_feature_cache_file, save_features, load_features,
+                       create_detector, select_keypoints, FLANN_INDEX_LSH)
 
 
 # seeding
 cv.setRNGSeed(0)
 
+# robust estimators, USAC variants are only supported by OpenCV for full
+# affine transforms, see Stitcher.fit_affine(), and only shipped with
+# OpenCV >= 4.5 (None if unavailable)
+ESTIMATORS = {
+    'ransac': cv.RANSAC,
+    'lmeds': cv.LMEDS,
+    'usac_default': getattr(cv, 'USAC_DEFAULT', None),
+    'usac_parallel': getattr(cv, 'USAC_PARALLEL', None),
+    'usac_fast': getattr(cv, 'USAC_FAST', None),
+    'usac_accurate': getattr(cv, 'USAC_ACCURATE', None),
+    'usac_magsac': getattr(cv, 'USAC_MAGSAC', None),
+}
+
 
 class Stitcher(object):
     """Stitches images together. Params default to standard ones.
@@ -20,10 +45,23 @@ class Stitcher(object):
         crop (dict): 4 keys: 'top', 'bottom', 'left', 'right'
             each value is a float in (0, 1), representing the proportion
             of image width/height
-        cache_dir (str): directory for storing cache images, NOTE: ALL CACHED
-            IMAGES NEED TO HAVE A UNIQUE NAME
+        cache_dir (str): directory for storing cache images and features,
+            NOTE: ALL CACHED IMAGES NEED TO HAVE A UNIQUE NAME
+            keypoints and descriptors are cached per image (keyed by file
+            path, file content, scale, crop and detector settings) so that
+            features are computed once per image rather than once per pair
+        detector (str): feature detector, one of 'surf', 'sift', 'orb',
+            'akaze', 'brisk', binary descriptors (orb, akaze, brisk) are
+            matched on Hamming distance with LSH, defaults to 'surf'
         hessian_threshold (float): threshold for feature extraction (SURF)
             the higher, the fewer features get extracted, defaults to 100
+        n_features (int): maximum number of features extracted (ORB),
+            defaults to 5000
+        max_keypoints (int): maximum number of keypoints per image, the
+            strongest keypoints of each cell of a grid over the image are
+            kept so that keypoints are well spread, this bounds the matching
+            cost per pair and the size of cached features, defaults to None
+            (unbounded)
         lowe_ratio (float): Lowe's ratio for discarding false matches
             the lower, the more false matches are discarded, defaults to 0.7
         min_inliers (int): minimum number of matches to attempt
@@ -34,46 +72,492 @@ class Stitcher(object):
         ransac_reproj_threshold (float): max reprojection error in RANSAC
             to consider a point as an inlier, the higher, the more tolerant
             RANSAC is, defaults to 3.0
+        estimator (str): robust estimator, one of ESTIMATORS, defaults to
+            'ransac'
+        max_iters (int): maximum number of robust estimator iterations,
+            defaults to 2000
+        confidence (float): confidence level of the robust estimator,
+            iterations stop early once it is reached, defaults to 0.99
+        refine_iters (int): maximum number of Levenberg-Marquardt iterations
+            refining the transform on inliers, defaults to 10
+        coarse_to_fine (bool): if True, the transform found at a scale is
+            refined at all following (higher resolution) scales by
+            refine_pair(), otherwise it is returned as soon as it is found,
+            defaults to False
+        refine_reproj_threshold (float): max reprojection error in RANSAC
+            when refining transforms, defaults to 1.0
+        phase_correlation_scale (float): if not None, stitch_pair() first
+            estimates a translation by phase correlation on images at this
+            (low) scale. If the correlation peak is at least
+            phase_correlation_threshold, the translation seeds guided
+            matching at the first scale (see refine_pair()), otherwise or if
+            that yields fewer than min_inliers inliers, whole images are
+            matched, defaults to None
+        phase_correlation_threshold (float): minimum phase correlation
+            response for accepting the translation, defaults to 0.3
+        memory_cache_bytes (int): size limit (in bytes) of the in-memory
+            LRU cache of preprocessed images, features and matcher indices
+            shared across stitch_pair() calls, per process, defaults to 0
+            (disabled)
+        persist_index (bool): whether to save the matcher index of each
+            image to cache_dir, so that it is built once per image across
+            runs and processes, defaults to False
+        index_cache_size (int): number of images whose matcher index is
+            kept in memory independently of memory_cache_bytes, so that
+            consecutive pairs sharing img0 build its index once, defaults
+            to 8
     """
 
     def __init__(self,
                  scales=None, crop=None, cache_dir=None,
+                 detector='surf',
                  hessian_threshold=100,
+                 n_features=5000,
+                 max_keypoints=None,
+                 guided_radius=20.0,
                  lowe_ratio=0.7,
                  min_inliers=200,
-                 ransac_reproj_threshold=3.0):
+                 ransac_reproj_threshold=3.0,
+                 estimator='ransac',
+                 max_iters=2000,
+                 confidence=0.99,
+                 refine_iters=10,
+                 coarse_to_fine=False,
+                 refine_reproj_threshold=1.0,
+                 phase_correlation_scale=None,
+                 phase_correlation_threshold=0.3,
+                 memory_cache_bytes=0,
+                 persist_index=False,
+                 index_cache_size=8):
         # record preprocessing params
         self.scales = [1] if scales is None else scales
         self.crop = crop
         self.cache_dir = cache_dir
-        # create feature detector
-        self.fd = cv.xfeatures2d.SURF_create(
-            hessianThreshold=hessian_threshold)
-        # feature matcher
-        FLANN_INDEX_KDTREE = 1
-        self.mt = cv.FlannBasedMatcher({'algorithm': FLANN_INDEX_KDTREE})
+        # create feature detector and matcher
+        self.detector = detector
+        self.hessian_threshold = hessian_threshold
+        self.n_features = n_features
+        self.max_keypoints = max_keypoints
+        self._init_matching()
         # Lowe's ratio for discarding false matches
         self.lowe_ratio = lowe_ratio
         # minimum feature matches to attempt transform estimation
         # if RANSAC inliers < min_inliers, higher resolution images are used
         self.min_inliers = min_inliers
+        # search radius for guided matching
+        self.guided_radius = guided_radius
         # RANSAC reprojection threshold
         # maximum reprojection error in the RANSAC algorithm
         # to consider a point as an inlier
         self.ransac_reproj_threshold = ransac_reproj_threshold
+        # robust estimator and its stopping criteria
+        if estimator not in ESTIMATORS:
+            raise ValueError('Unknown estimator: {}, expected one of {}'
+                             .format(estimator, sorted(ESTIMATORS)))
+        if ESTIMATORS[estimator] is None:
+            raise ValueError(
+                'Estimator {} is not available in OpenCV {}, it requires '
+                'OpenCV >= 4.5'.format(estimator, cv.__version__))
+        self.estimator = estimator
+        self.max_iters = max_iters
+        self.confidence = confidence
+        self.refine_iters = refine_iters
+        # coarse to fine refinement
+        self.coarse_to_fine = coarse_to_fine
+        self.refine_reproj_threshold = refine_reproj_threshold
+        # translation only pre-check by phase correlation
+        self.phase_correlation_scale = phase_correlation_scale
+        self.phase_correlation_threshold = phase_correlation_threshold
+        # in-memory cache of images, features and matcher indices, keyed by
+        # (type, file, scale, crop)
+        self.memory_cache = LRUCache(memory_cache_bytes)
+        self.persist_index = persist_index
+        # most recently used matcher indices, keyed as memory_cache
+        self.index_cache_size = index_cache_size
+        self._index_cache = collections.OrderedDict()
+
+    @property
+    def params(self):
+        """dict: params that affect the estimated transforms."""
+        return {'scales': self.scales,
+                'crop': self.crop,
+                'detector': self.detector,
+                'hessian_threshold': self.hessian_threshold,
+                'n_features': self.n_features,
+                'max_keypoints': self.max_keypoints,
+                'lowe_ratio': self.lowe_ratio,
+                'min_inliers': self.min_inliers,
+                'guided_radius': self.guided_radius,
+                'ransac_reproj_threshold': self.ransac_reproj_threshold,
+                'estimator': self.estimator,
+                'max_iters': self.max_iters,
+                'confidence': self.confidence,
+                'refine_iters': self.refine_iters,
+                'coarse_to_fine': self.coarse_to_fine,
+                'refine_reproj_threshold': self.refine_reproj_threshold,
+                'phase_correlation_scale': self.phase_correlation_scale,
+                'phase_correlation_threshold':
+                    self.phase_correlation_threshold}
+
+    def _init_matching(self):
+        """Creates the feature detector and matcher from recorded params."""
+        # feature detector and matcher (FLANN index params)
+        self.fd, self.index_params = create_detector(
+            self.detector, hessian_threshold=self.hessian_threshold,
+            n_features=self.n_features)
+
+    def __getstate__(self):
+        # OpenCV detectors cannot be pickled, drop them and rebuild them
+        # from params when unpickled (e.g., in worker processes)
+        state = self.__dict__.copy()
+        del state['fd']
+        # do not ship cached arrays to other processes
+        state['memory_cache'] = LRUCache(self.memory_cache.max_bytes)
+        # FLANN indices cannot be pickled
+        state['_index_cache'] = collections.OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_matching()
+
+    def _memory_cache_key(self, kind, file, scale):
+        crop = None if self.crop is None else tuple(sorted(self.crop.items()))
+        return kind, file, scale, crop
+
+    def _feature_cache_file(self, file, scale):
+        return get_feature_cache_file(
+            self.cache_dir, file, scale=scale, crop=self.crop,
+            detector=self.detector, hessian_threshold=self.hessian_threshold,
+            n_features=self.n_features, max_keypoints=self.max_keypoints)
+
+    def detect_and_compute(self, img, mask=None):
+        """Detects keypoints and computes their descriptors.
+
+        If self.max_keypoints is set, descriptors are only computed for the
+        selected keypoints (see select_keypoints()).
+
+        Args:
+            img (numpy.ndarray [height, width]): input image
+            mask (numpy.ndarray [height, width] of uint8): keypoints are only
+                detected where mask is nonzero, whole image if None
+
+        Returns:
+            numpy.ndarray [N, 7]: keypoints, see keypoints_to_array()
+            numpy.ndarray [N, D] or NoneType: descriptors
+        """
+        if self.max_keypoints is None:
+            kps, des = self.fd.detectAndCompute(img, mask=mask)
+            return keypoints_to_array(kps), des
+        kps = self.fd.detect(img, mask=mask)
+        idx = select_keypoints(
+            keypoints_to_array(kps), img.shape, self.max_keypoints)
+        kps, des = self.fd.compute(img, [kps[i] for i in idx])
+        return keypoints_to_array(kps), des
+
+    def load_image(self, file, scale):
+        """Loads a preprocessed image, cached in memory.
+
+        Args:
+            file (str): file path
+            scale (float): scaling factor, passed to preprocess()
+
+        Returns:
+            numpy.ndarray [height, width]: loaded grayscale image
+            affine.Affine: the transform from the preprocessed image to the
+                original image
+        """
+        key = self._memory_cache_key('image', file, scale)
+        output = self.memory_cache.get(key)
+        if output is None:
+            output = preprocess(
+                file, scale=scale, crop=self.crop,
+                cache=self.cache_dir is not None, cache_dir=self.cache_dir)
+            self.memory_cache.put(key, output)
+        return output
+
+    def get_features(self, file, scale):
+        """Loads or computes keypoints and descriptors of an image.
+
+        Features are loaded from the in-memory or on-disk cache if
+        available, otherwise the image is preprocessed, features are
+        extracted and cached.
+
+        Args:
+            file (str): file path
+            scale (float): scaling factor, passed to preprocess()
+
+        Returns:
+            numpy.ndarray [N, 7]: keypoints, see keypoints_to_array()
+            numpy.ndarray [N, D] or NoneType: descriptors
+            affine.Affine: the transform from the preprocessed image to the
+                original image
+        """
+        key = self._memory_cache_key('features', file, scale)
+        output = self.memory_cache.get(key)
+        if output is not None:
+            return output
+        if self.cache_dir is not None:
+            cache_file = self._feature_cache_file(file, scale)
+            output = load_features(cache_file)
+        if output is None:
+            img, trans = self.load_image(file, scale=scale)
+            kps, des = self.detect_and_compute(img)
+            if self.cache_dir is not None:
+                save_features(cache_file, kps, des, trans)
+            output = kps, des, trans
+        self.memory_cache.put(key, output)
+        return output
+
+    def get_descriptors(self, file):
+        """Gets the descriptors of an image at the coarsest scale.
+
+        Used for image retrieval, features are shared with stitching
+        through the caches.
+
+        Args:
+            file (str): file path
+
+        Returns:
+            numpy.ndarray [N, D] or NoneType: descriptors
+        """
+        _, des, _ = self.get_features(file, scale=min(self.scales))
+        return des
+
+    def get_index(self, file, scale, des=None):
+        """Loads or builds the matcher index over the descriptors of an image.
+
+        The index is cached in memory (and on disk if self.persist_index),
+        so that it is built once per image and reused for all its pairs.
+        The last self.index_cache_size indices are kept even if the memory
+        cache is disabled.
+
+        Args:
+            file (str): file path
+            scale (float): scaling factor, passed to preprocess()
+            des (numpy.ndarray [N, D]): descriptors of the image at scale,
+                from get_features() if None
+
+        Returns:
+            cv.flann_Index or NoneType: trained index, None if the image has
+                fewer than 2 descriptors
+        """
+        key = self._memory_cache_key('index', file, scale)
+        output = self.memory_cache.get(key, self._index_cache.get(key))
+        if output is not None:
+            self._put_index(key, output)
+            return output[0]
+        if des is None:
+            _, des, _ = self.get_features(file, scale=scale)
+        if des is None or len(des) < 2:
+            return None
+        index = None
+        if self.persist_index and self.cache_dir is not None:
+            index_file = os.path.splitext(
+                self._feature_cache_file(file, scale))[0] + '.flann'
+            if os.path.isfile(index_file):
+                index = cv.flann_Index()
+                if not index.load(des, index_file):
+                    index = None
+        if index is None:
+            index = cv.flann_Index(des, self.index_params)
+            if self.persist_index and self.cache_dir is not None:
+                fd, tmp_file = tempfile.mkstemp(
+                    dir=self.cache_dir, suffix='.tmp')
+                os.close(fd)
+                index.save(tmp_file)
+                os.replace(tmp_file, index_file)
+        # keep the descriptors alive with the index, this also accounts for
+        # the memory footprint of the index
+        self.memory_cache.put(key, (index, des))
+        self._put_index(key, (index, des))
+        return index
+
+    def _put_index(self, key, value):
+        """Marks an index as most recently used in self._index_cache."""
+        self._index_cache[key] = value
+        self._index_cache.move_to_end(key)
+        while len(self._index_cache) > self.index_cache_size:
+            self._index_cache.popitem(last=False)
+
+    def match_descriptors(self, des0, des1, index=None,
+                          mask0=None, mask1=None):
+        """Matches descriptors and applies Lowe's ratio test.
+
+        The two nearest neighbors of each query descriptor are searched in
+        one call and filtered in a vectorized manner.
+
+        Args:
+            des0 (numpy.ndarray [N0, D] or NoneType): query descriptors
+            des1 (numpy.ndarray [N1, D] or NoneType): train descriptors
+            index (cv.flann_Index): index trained on des1, built if None
+            mask0 (numpy.ndarray [N0,] of bool): query descriptors to be
+                matched, all if None
+            mask1 (numpy.ndarray [N1,] of bool): matches to train descriptors
+                outside of mask1 are discarded (after the ratio test, so that
+                a prebuilt index over all of des1 can be reused)
+
+        Returns:
+            numpy.ndarray [M,]: indices of matched query descriptors
+            numpy.ndarray [M,]: indices of matched train descriptors
+        """
+        empty = np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        if des0 is None or des1 is None or len(des0) == 0 or len(des1) < 2:
+            return empty
+        if mask0 is None:
+            query = np.arange(len(des0))
+        else:
+            query = np.flatnonzero(mask0)
+            if len(query) == 0:
+                return empty
+            des0 = des0[query]
+        if index is None:
+            index = cv.flann_Index(des1, self.index_params)
+        nn_idx, nn_dist = index.knnSearch(des0, 2, params={})
+        if self.index_params['algorithm'] == FLANN_INDEX_LSH:
+            # hamming distances, LSH returns -1 if fewer than 2 neighbors
+            # are found in the hash buckets of a query
+            good = ((nn_idx[:, 1] >= 0) &
+                    (nn_dist[:, 0] < self.lowe_ratio * nn_dist[:, 1]))
+        else:
+            # kd tree distances are squared euclidean distances
+            good = nn_dist[:, 0] < self.lowe_ratio ** 2 * nn_dist[:, 1]
+        if mask1 is not None:
+            good &= mask1[np.maximum(nn_idx[:, 0], 0)]
+        return query[good], nn_idx[good, 0].astype(int)
+
+    def match_guided(self, kp0, des0, kp1, des1, prior, radius=None,
+                     mask0=None, mask1=None):
+        """Matches descriptors around locations predicted by a prior.
+
+        Only train keypoints within a radius of the predicted location of a
+        query keypoint are candidates, candidates are found with KD trees on
+        keypoint positions, and Lowe's ratio test is applied among them.
+        Queries with a single candidate are kept.
+
+        Args:
+            kp0, kp1 (numpy.ndarray [N0/N1, 7]): query/train keypoints
+            des0, des1 (numpy.ndarray [N0/N1, D] or NoneType): query/train
+                descriptors
+            prior (affine.Affine): transform from query keypoint positions
+                to predicted train keypoint positions
+            radius (float): search radius, defaults to self.guided_radius
+            mask0, mask1 (numpy.ndarray [N0/N1,] of bool): query/train
+                descriptors to be matched, all if None
+
+        Returns:
+            numpy.ndarray [M,]: indices of matched query descriptors
+            numpy.ndarray [M,]: indices of matched train descriptors
+        """
+        radius = self.guided_radius if radius is None else radius
+        empty = np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        if des0 is None or des1 is None or len(des0) == 0 or len(des1) == 0:
+            return empty
+        query = (np.arange(len(des0)) if mask0 is None
+                 else np.flatnonzero(mask0))
+        train = (np.arange(len(des1)) if mask1 is None
+                 else np.flatnonzero(mask1))
+        if len(query) == 0 or len(train) == 0:
+            return empty
+        # candidate pairs within radius of the predicted locations
+        t = np.array(prior).reshape((3, 3))[0:2, :]
+        pred = kp0[query, 0:2].dot(t[:, 0:2].T) + t[:, 2]
+        candidates = scipy.spatial.cKDTree(pred).sparse_distance_matrix(
+            scipy.spatial.cKDTree(kp1[train, 0:2]), radius,
+            output_type='ndarray')
+        if len(candidates) == 0:
+            return empty
+        i, j = query[candidates['i']], train[candidates['j']]
+        if self.index_params['algorithm'] == FLANN_INDEX_LSH:
+            # hamming distances
+            dist = np.unpackbits(des0[i] ^ des1[j], axis=1).sum(axis=1)
+            ratio = self.lowe_ratio
+        else:
+            # squared euclidean distances
+            dist = ((des0[i] - des1[j]) ** 2).sum(axis=1)
+            ratio = self.lowe_ratio ** 2
+        # nearest and second nearest candidates of each query
+        order = np.lexsort((dist, i))
+        i, j, dist = i[order], j[order], dist[order]
+        is_first = np.r_[True, i[1:] != i[:-1]]
+        best = np.flatnonzero(is_first)
+        second = np.full(len(best), np.inf)
+        # the next candidate belongs to the same query
+        has_second = ~np.r_[is_first[1:], True][best]
+        second[has_second] = dist[best[has_second] + 1]
+        good = dist[best] < ratio * second
+        return i[best[good]], j[best[good]]
+
+    def fit_affine(self, pts1, pts0, reproj_threshold):
+        """Robustly fits a partial affine transform with self.estimator.
+
+        The partial affine transform consists of rotation, uniform scaling
+        and translation. OpenCV only supports USAC estimators for full
+        affine transforms, so with USAC, inliers are found with a full affine
+        model and the partial affine transform is then fitted on them.
+
+        Args:
+            pts1, pts0 (numpy.ndarray [N, 2]): matched points in img1/img0
+            reproj_threshold (float): max reprojection error of inliers
+
+        Returns:
+            numpy.ndarray [2, 3] or NoneType: transform from pts1 to pts0,
+                None if estimation fails
+            numpy.ndarray [N,] of bool: inliers
+        """
+        method = ESTIMATORS[self.estimator]
+        kwargs = {'ransacReprojThreshold': reproj_threshold,
+                  'maxIters': self.max_iters,
+                  'confidence': self.confidence,
+                  'refineIters': self.refine_iters}
+        if self.estimator.startswith('usac'):
+            transform, inliers = cv.estimateAffine2D(
+                pts1, pts0, method=method, **kwargs)
+            if transform is None:
+                return None, np.zeros(len(pts0), dtype=bool)
+            inliers = inliers.ravel().astype(bool)
+            if inliers.sum() < 2:
+                return None, inliers
+            # few iterations are needed on inliers
+            partial, partial_inliers = cv.estimateAffinePartial2D(
+                pts1[inliers], pts0[inliers], method=cv.RANSAC, **kwargs)
+            if partial is None:
+                return None, np.zeros(len(pts0), dtype=bool)
+            inliers[inliers] = partial_inliers.ravel().astype(bool)
+            return partial, inliers
+        transform, inliers = cv.estimateAffinePartial2D(
+            pts1, pts0, method=method, **kwargs)
+        if transform is None:
+            return None, np.zeros(len(pts0), dtype=bool)
+        return transform, inliers.ravel().astype(bool)
 
     def estimate_affine(self, img0, img1, max_dist=None, dist=None,
-                        verbose=False, show=False, show_file=None):
+                        verbose=False, show=False, show_file=None,
+                        features=None, index0=None, masks=None,
+                        prior=None):
         """Estimates the affine transformation.
 
         Args:
-            img0, img1 (numpy.ndarray [height, width]): input images
+            img0, img1 (numpy.ndarray [height, width]): input images,
+                can be None if features are supplied and show is False
             verbose (bool): return additional diagnostic values
             show (bool): whether to produce visualizations
             show_file (str): file for storing visualizations, contains
                 directory but no suffix.
                 the viz files will be stored as show_file + '_match.png' and
                 show_file + '_overlay.png'
+            features (tuple): precomputed ((kp0, des0), (kp1, des1)),
+                with keypoints as arrays (see keypoints_to_array()),
+                if None, features are extracted from img0 and img1
+            index0 (cv.flann_Index): matcher index trained on the
+                descriptors of img0 (see get_index()), built if None
+            masks (tuple of numpy.ndarray of bool [2,]): keypoints of
+                img0/img1 that may be matched, e.g., those in the expected
+                overlap, all keypoints if None
+            prior (affine.Affine): predicted transform to fit img1 onto img0,
+                if not None, matching is guided by the prior (see
+                match_guided()), falling back to global matching if guided
+                matching fails to yield min_inliers inliers
 
         Returns:
             affine.Affine or NoneType: affine transform to fit
@@ -81,36 +565,59 @@ class Stitcher(object):
             dict: diagnostics (if verbose)
         """
         # detect features, compute descriptors
-        kp0, des0 = self.fd.detectAndCompute(img0, mask=None)
-        kp1, des1 = self.fd.detectAndCompute(img1, mask=None)
-        # match descriptors
-        matches = self.mt.knnMatch(des0, des1, k=2)  # query, train
-        # store all the good matches as per Lowe's ratio test
-        good = []
-        for m0, m1 in matches:
-            if m0.distance < self.lowe_ratio * m1.distance:
-                good.append(m0)
+        if features is None:
+            kp0, des0 = self.detect_and_compute(img0)
+            kp1, des1 = self.detect_and_compute(img1)
+        else:
+            (kp0, des0), (kp1, des1) = features
+        # match descriptors, keep good matches as per Lowe's ratio test
+        # img1 is the query, so that the index over img0 can be reused
+        mask0, mask1 = (None, None) if masks is None else masks
+        if prior is not None:
+            idx1, idx0 = self.match_guided(
+                kp1, des1, kp0, des0, prior, mask0=mask1, mask1=mask0)
+            if len(idx0) < self.min_inliers:
+                # prior failed, fall back to global matching
+                return self.estimate_affine(
+                    img0, img1, max_dist=max_dist, dist=dist,
+                    verbose=verbose, show=show, show_file=show_file,
+                    features=((kp0, des0), (kp1, des1)), index0=index0,
+                    masks=masks)
+        else:
+            idx1, idx0 = self.match_descriptors(
+                des1, des0, index=index0, mask0=mask1, mask1=mask0)
         if verbose:
-            diag = {'n_match': len(good)}
+            diag = {'n_match': len(idx0), 'guided': prior is not None}
         # visualize
         if show:
             color = (250, 128, 114)
             img_match = cv.drawMatches(
-                img0, kp0, img1, kp1, good, outImg=None,
-                matchColor=color, singlePointColor=color)
+                img0, array_to_keypoints(kp0), img1, array_to_keypoints(kp1),
+                [cv.DMatch(int(i), int(j), 0) for i, j in zip(idx0, idx1)],
+                outImg=None, matchColor=color, singlePointColor=color)
             cv.imwrite(show_file + '_match.png', img_match)
         # with all good matches, estimate affine transform w/ RANSAC
-        if (len(good) > self.min_inliers) or (max_dist == None) or (dist < max_dist):
+        if ((len(idx0) > self.min_inliers) or (max_dist == None)
+                or (dist < max_dist)):
             print("max_dist", max_dist, "dist", dist) 
-            pts0 = np.array([kp0[m.queryIdx].pt for m in good])
-            pts1 = np.array([kp1[m.trainIdx].pt for m in good])
-            transform, inliers = cv.estimateAffinePartial2D(
-                pts1, pts0,
-                method=cv.RANSAC,
-                ransacReprojThreshold=self.ransac_reproj_threshold)
+            pts0 = kp0[idx0, 0:2]
+            pts1 = kp1[idx1, 0:2]
+            if len(idx0) < 2:  # not enough points to estimate the transform
+                return (None, diag) if verbose else None
+            start = time.perf_counter()
+            transform, inliers = self.fit_affine(
+                pts1, pts0, self.ransac_reproj_threshold)
             if verbose:
                 diag['n_inlier'] = inliers.sum()
-            if inliers.sum() < self.min_inliers:
+                diag['t_estimate'] = time.perf_counter() - start
+            if transform is None or inliers.sum() < self.min_inliers:
+                if prior is not None:
+                    # prior failed, fall back to global matching
+                    return self.estimate_affine(
+                        img0, img1, max_dist=max_dist, dist=dist,
+                        verbose=verbose, show=show, show_file=show_file,
+                        features=((kp0, des0), (kp1, des1)), index0=index0,
+                        masks=masks)
                 return (None, diag) if verbose else None
             if show:
                 # fit img1 onto img0
@@ -126,12 +633,45 @@ class Stitcher(object):
         else:
             return (None, diag) if verbose else None
 
-    def stitch_pair(self, img0, img1, verbose=False, **kwargs):
+    def _in_overlap(self, kps, overlap, trans):
+        """Checks whether keypoints are in the expected overlap."""
+        t = ~trans  # from original image to preprocessed image
+        overlap = shapely.affinity.affine_transform(
+            overlap, [t.a, t.b, t.d, t.e, t.c, t.f])
+        return shapely.contains_xy(overlap, kps[:, 0], kps[:, 1])
+
+    def _overlap_mask(self, overlap, trans, shape):
+        """Rasterizes the expected overlap as a detection mask."""
+        t = ~trans  # from original image to preprocessed image
+        overlap = shapely.affinity.affine_transform(
+            overlap, [t.a, t.b, t.d, t.e, t.c, t.f])
+        mask = np.zeros(shape, dtype=np.uint8)
+        for poly in getattr(overlap, 'geoms', [overlap]):
+            if not poly.is_empty:
+                pts = np.round(np.array(poly.exterior.coords)).astype(np.int32)
+                cv.fillPoly(mask, [pts], 255)
+        return mask
+
+    def stitch_pair(self, img0, img1, verbose=False, overlaps=None,
+                    prior=None, reference=None, **kwargs):
         """Stitch images together using a pyramid of resolutions.
 
         Args:
             img0, img1 (str): file path
             verbose (bool)
+            overlaps (tuple of shapely.geometry.Polygon [2,]): expected
+                overlap in the pixel space of the original img0/img1 (see
+                src.utils.get_overlap_polygons()), only features in the
+                overlap are matched. If features are cached, cached features
+                are filtered, otherwise features are only detected in the
+                overlap. If None, whole images are matched
+            prior (affine.Affine): predicted transform to fit the original
+                img1 onto the original img0 (e.g., from initial positions),
+                used for guided matching, see estimate_affine()
+            reference (dict): features and matcher index of img0, keyed by
+                scale as (keypoints, descriptors, transform, index), missing
+                scales are computed and added, for sharing them between
+                pairs (see stitch_many())
             **kwargs: passed to estimate_affine()
 
         Returns:
@@ -140,15 +680,63 @@ class Stitcher(object):
                 the relative transform is in terms of the original images
             dict: diagnostics (if verbose)
         """
+        if self.phase_correlation_scale is not None:
+            # fast path for (mostly) translated images
+            trans, response = self.phase_correlate(img0, img1)
+            if response >= self.phase_correlation_threshold:
+                # the translation only seeds guided matching at the first
+                # scale, falls back to matching whole images if it fails
+                diag = {'phase_correlation': response, 'img0': img0,
+                        'img1': img1, 'scale': self.scales[0]}
+                trans = self.refine_pair(
+                    img0, img1, trans, scale=self.scales[0], diag=diag)
+                if trans is not None:
+                    if self.coarse_to_fine:
+                        trans = self._refine(
+                            img0, img1, trans, self.scales[1:], diag)
+                    return (trans, diag) if verbose else trans
         # iterate over resolutions
-        params = {'crop': self.crop,
-                  'cache': False if self.cache_dir is None else True,
-                  'cache_dir': self.cache_dir}
-        for scale in self.scales:
-            img0_array, trans0 = preprocess(img0, scale=scale, **params)
-            img1_array, trans1 = preprocess(img1, scale=scale, **params)
+        # features are cached, and shared with other pairs
+        cached = (self.cache_dir is not None or
+                  self.memory_cache.max_bytes > 0 or reference is not None)
+        for k, scale in enumerate(self.scales):
+            masks = None
+            if overlaps is None or cached:
+                if reference is not None and scale in reference:
+                    kp0, des0, trans0, index0 = reference[scale]
+                else:
+                    kp0, des0, trans0 = self.get_features(img0, scale=scale)
+                    index0 = self.get_index(img0, scale=scale, des=des0)
+                    if reference is not None:
+                        reference[scale] = kp0, des0, trans0, index0
+                kp1, des1, trans1 = self.get_features(img1, scale=scale)
+                if overlaps is not None:
+                    masks = (self._in_overlap(kp0, overlaps[0], trans0),
+                             self._in_overlap(kp1, overlaps[1], trans1))
+            else:
+                # only detect features in the expected overlap
+                img0_array, trans0 = self.load_image(img0, scale=scale)
+                img1_array, trans1 = self.load_image(img1, scale=scale)
+                kp0, des0 = self.detect_and_compute(
+                    img0_array, mask=self._overlap_mask(
+                        overlaps[0], trans0, img0_array.shape))
+                kp1, des1 = self.detect_and_compute(
+                    img1_array, mask=self._overlap_mask(
+                        overlaps[1], trans1, img1_array.shape))
+                index0 = None
+            # images are only loaded for visualizations
+            if kwargs.get('show', False):
+                img0_array, _ = self.load_image(img0, scale=scale)
+                img1_array, _ = self.load_image(img1, scale=scale)
+            else:
+                img0_array = img1_array = None
             output = self.estimate_affine(
-                img0_array, img1_array, verbose=verbose, **kwargs)
+                img0_array, img1_array, verbose=verbose,
+                features=((kp0, des0), (kp1, des1)),
+                index0=index0, masks=masks,
+                # prior in terms of the preprocessed images
+                prior=None if prior is None else ~trans0 * prior * trans1,
+                **kwargs)
             if verbose:
                 relative_trans, diag = output
                 diag['img0'] = img0
@@ -161,5 +749,140 @@ class Stitcher(object):
                 # take into account the transforms between the original images
                 # and the preprocessed images
                 trans = trans0 * relative_trans * (~trans1)
+                if self.coarse_to_fine:
+                    # seed the following scales with the transform found
+                    trans = self._refine(
+                        img0, img1, trans, self.scales[k + 1:],
+                        diag if verbose else {})
                 return (trans, diag) if verbose else trans
         return (None, diag) if verbose else None
+
+    def _refine(self, img0, img1, trans, scales, diag):
+        """Refines a transform successively at scales, see refine_pair()."""
+        for scale in scales:
+            refined = self.refine_pair(img0, img1, trans, scale=scale)
+            if refined is not None:
+                trans = refined
+                diag['refined_scale'] = scale
+        return trans
+
+    def phase_correlate(self, img0, img1):
+        """Estimates the translation between two images by phase correlation.
+
+        Images are loaded at self.phase_correlation_scale, padded to the same
+        size and correlated with a Hanning window. Rotation and scaling are
+        not estimated.
+
+        Args:
+            img0, img1 (str): file path
+
+        Returns:
+            affine.Affine: translation to fit the original img1 onto the
+                original img0
+            float: phase correlation response, the higher, the more reliable
+                the translation
+        """
+        arrays = []
+        transforms = []
+        for file in (img0, img1):
+            img, trans = self.load_image(
+                file, scale=self.phase_correlation_scale)
+            arrays.append(img.astype(np.float32))
+            transforms.append(trans)
+        height = max(img.shape[0] for img in arrays)
+        width = max(img.shape[1] for img in arrays)
+        # pad with mean values to avoid strong edges
+        arrays = [cv.copyMakeBorder(
+            img, 0, height - img.shape[0], 0, width - img.shape[1],
+            cv.BORDER_CONSTANT, value=float(img.mean())) for img in arrays]
+        window = cv.createHanningWindow((width, height), cv.CV_32F)
+        (dx, dy), response = cv.phaseCorrelate(arrays[0], arrays[1], window)
+        # img1 is shifted by (dx, dy) w.r.t. img0
+        trans0, trans1 = transforms
+        trans = (trans0 * rasterio.transform.Affine.translation(-dx, -dy) *
+                 ~trans1)
+        return trans, response
+
+    def refine_pair(self, img0, img1, trans, scale, dilation=0.02,
+                    diag=None):
+        """Refines the transform between two images at a given scale.
+
+        Only the overlap predicted by trans is read (and not cached), features
+        in the overlap are matched guided by trans (see match_guided()) and
+        the transform is re-estimated with self.refine_reproj_threshold.
+
+        Args:
+            img0, img1 (str): file path
+            trans (affine.Affine): transform to fit the original img1 onto
+                the original img0, e.g., found at a lower resolution
+            scale (float): scaling factor, passed to preprocess()
+            dilation (float): the predicted overlap is dilated by this
+                proportion of the image diagonal
+            diag (dict): if not None, the number of matches and inliers are
+                recorded as 'n_match' and 'n_inlier'
+
+        Returns:
+            affine.Affine or NoneType: refined transform (in terms of the
+                original images), None if refinement fails
+        """
+        widths, heights = zip(read_size(img0), read_size(img1))
+        overlaps = get_overlap_polygons(
+            (rasterio.transform.Affine.identity(), trans), widths, heights,
+            dilation=dilation)
+        if overlaps is None:
+            return None
+        features = []
+        for file, overlap, w, h in zip(
+                (img0, img1), overlaps, widths, heights):
+            # read the bounding box of the overlap within self.crop
+            crop = ({'top': 0, 'bottom': 1, 'left': 0, 'right': 1}
+                    if self.crop is None else self.crop)
+            left, top, right, bottom = overlap.bounds
+            left = int(np.floor(max(crop['left'] * w, left)))
+            top = int(np.floor(max(crop['top'] * h, top)))
+            right = int(np.ceil(min(crop['right'] * w, right)))
+            bottom = int(np.ceil(min(crop['bottom'] * h, bottom)))
+            if left >= right or top >= bottom:
+                return None
+            # snap to whole pixels, robust to rounding in preprocess()
+            crop = {'top': (top + 0.25) / h, 'bottom': (bottom + 0.25) / h,
+                    'left': (left + 0.25) / w, 'right': (right + 0.25) / w}
+            img, t = preprocess(file, scale=scale, crop=crop)
+            kp, des = self.detect_and_compute(img)
+            features.append((kp, des, t))
+        (kp0, des0, t0), (kp1, des1, t1) = features
+        # guided matching, img1 is the query
+        idx1, idx0 = self.match_guided(
+            kp1, des1, kp0, des0, prior=~t0 * trans * t1)
+        if diag is not None:
+            diag['n_match'] = len(idx0)
+        if len(idx0) < self.min_inliers:
+            return None
+        transform, inliers = self.fit_affine(
+            kp1[idx1, 0:2], kp0[idx0, 0:2], self.refine_reproj_threshold)
+        if diag is not None:
+            diag['n_inlier'] = 0 if transform is None else int(inliers.sum())
+        if transform is None or inliers.sum() < self.min_inliers:
+            return None
+        return t0 * rasterio.transform.Affine(*transform.flatten()) * ~t1
+
+    def stitch_many(self, img0, imgs1, verbose=False, **kwargs):
+        """Stitch images onto one image, e.g., all its graph neighbors.
+
+        The features and the matcher index of img0 are computed once and
+        passed to estimate_affine() for all images in imgs1, whether or not
+        the memory cache is enabled.
+
+        Args:
+            img0 (str): file path
+            imgs1 (list of str): file paths
+            verbose (bool)
+            **kwargs: passed to stitch_pair()
+
+        Returns:
+            list: outputs of stitch_pair() for (img0, img1) for every img1
+        """
+        reference = {}
+        return [self.stitch_pair(img0, img1, verbose=verbose,
+                                 reference=reference, **kwargs)
+                for img1 in imgs1]
@@ -0,0 +1,96 @@
+import os
+import json
+import time
+import sqlite3
+import rasterio.transform
+
+
+class LinkStore(object):
+    """Durable on-disk store of links between pairs of images.
+
+    Links are recorded in a SQLite database as soon as they are estimated,
+    so that an interrupted run can be resumed without re-estimating finished
+    pairs. Each record is keyed by the two image files and the matching
+    parameters, changing the parameters (e.g., hessian_threshold,
+    min_inliers or ransac_reproj_threshold) thus only invalidates records
+    estimated with different parameters, which are kept in the database.
+
+    Args:
+        file (str): path to the SQLite database, created if nonexistent
+        params (dict): json serializable parameters used for estimating
+            links (e.g., src.stitch.Stitcher.params)
+    """
+
+    def __init__(self, file, params=None):
+        self.file = file
+        self.params = json.dumps(
+            {} if params is None else params, sort_keys=True)
+        if os.path.dirname(file) != '':
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+        self.conn = sqlite3.connect(file)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS links ('
+            'img0 TEXT NOT NULL, img1 TEXT NOT NULL, params TEXT NOT NULL, '
+            'trans TEXT, n_match INTEGER, n_inlier INTEGER, scale REAL, '
+            'diag TEXT, created REAL, '
+            'PRIMARY KEY (img0, img1, params))')
+        self.conn.commit()
+
+    def get(self, img0, img1):
+        """Looks up the link between two images.
+
+        Args:
+            img0, img1 (str): file paths
+
+        Returns:
+            tuple (bool, affine.Affine or NoneType): whether a record is
+                found, and the recorded affine transform from img1 to img0
+                (None if no match was found)
+        """
+        row = self.conn.execute(
+            'SELECT trans FROM links '
+            'WHERE img0 = ? AND img1 = ? AND params = ?',
+            (img0, img1, self.params)).fetchone()
+        if row is None:
+            return False, None
+        trans, = row
+        if trans is None:
+            return True, None
+        return True, rasterio.transform.Affine(*json.loads(trans))
+
+    def put(self, img0, img1, trans, diag=None):
+        """Records the link between two images, committed immediately.
+
+        Args:
+            img0, img1 (str): file paths
+            trans (affine.Affine or NoneType): affine transform from img1 to
+                img0, None if no match is found
+            diag (dict): diagnostics returned by the stitcher (if verbose),
+                'n_match', 'n_inlier' and 'scale' are recorded in separate
+                columns
+        """
+        diag = {} if diag is None else diag
+        self.conn.execute(
+            'INSERT OR REPLACE INTO links VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (img0, img1, self.params,
+             None if trans is None else json.dumps(list(trans[:6])),
+             _to_int(diag.get('n_match')),
+             _to_int(diag.get('n_inlier')),
+             None if diag.get('scale') is None else float(diag['scale']),
+             json.dumps(diag, default=str),
+             time.time()))
+        self.conn.commit()
+
+    def __len__(self):
+        n, = self.conn.execute(
+            'SELECT COUNT(*) FROM links WHERE params = ?',
+            (self.params,)).fetchone()
+        return n
+
+    def close(self):
+        self.conn.close()
+
+
+def _to_int(value):
+    return None if value is None else int(value)
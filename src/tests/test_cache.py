@@ -0,0 +1,46 @@
+import pytest
+
+import numpy as np
+
+from ..cache import get_nbytes, LRUCache
+
+
+def test_get_nbytes():
+    a = np.zeros((10, 10), dtype=np.uint8)
+    b = np.zeros((5, 2), dtype=np.float32)
+    assert get_nbytes(a) == 100
+    assert get_nbytes((a, [b, b])) == 180
+
+
+@pytest.mark.parametrize(
+    'max_bytes,expected_keys',
+    [
+        pytest.param(300, ['a', 'c', 'd']),
+        pytest.param(200, ['c', 'd']),
+        pytest.param(50, []),
+        pytest.param(0, []),
+    ],
+)
+def test_lru_cache(max_bytes, expected_keys):
+    cache = LRUCache(max_bytes)
+    for key in ['a', 'b', 'c']:
+        cache.put(key, np.zeros(100, dtype=np.uint8))
+    # mark a as recently used, if still cached
+    cache.get('a')
+    cache.put('d', np.zeros(100, dtype=np.uint8))
+    assert sorted(k for k in ['a', 'b', 'c', 'd'] if k in cache) == (
+        expected_keys)
+    assert cache.n_bytes == 100 * len(expected_keys) <= max_bytes
+    assert len(cache) == len(expected_keys)
+    assert cache.get('b', 'missing') == 'missing'
+
+
+def test_lru_cache_replace():
+    cache = LRUCache(1000)
+    cache.put('a', np.zeros(100, dtype=np.uint8))
+    cache.put('a', np.zeros(300, dtype=np.uint8))
+    assert cache.n_bytes == 300
+    assert cache.get('a').shape == (300,)
+    assert (cache.hits, cache.misses) == (1, 0)
+    cache.clear()
+    assert len(cache) == 0 and cache.n_bytes == 0
@@ -0,0 +1,125 @@
+import pytest
+
+import os
+import numpy as np
+import cv2 as cv
+import rasterio.transform
+
+from ..features import (file_hash, keypoints_to_array, array_to_keypoints,
+                        get_feature_cache_file, save_features, load_features,
+                        create_detector, select_keypoints,
+                        FLANN_INDEX_KDTREE, FLANN_INDEX_LSH)
+
+
+@pytest.fixture
+def img_file(tmp_path):
+    f = str(tmp_path / 'test_features_img.png')
+    cv.imwrite(f, np.arange(100, dtype=np.uint8).reshape((10, 10)))
+    return f
+
+
+def test_file_hash(img_file):
+    h0 = file_hash(img_file)
+    assert h0 == file_hash(img_file)
+    # modify file content
+    cv.imwrite(img_file, np.zeros((10, 10), dtype=np.uint8))
+    os.utime(img_file, ns=(0, 0))
+    assert h0 != file_hash(img_file)
+
+
+def test_keypoints_roundtrip():
+    kps = [cv.KeyPoint(x=1.5, y=2.5, size=3, angle=45, response=0.5,
+                       octave=1, class_id=-1),
+           cv.KeyPoint(x=10, y=20, size=4, angle=90, response=0.1,
+                       octave=2, class_id=3)]
+    array = keypoints_to_array(kps)
+    assert array.shape == (2, 7)
+    np.testing.assert_allclose(array[:, 0:2], [[1.5, 2.5], [10, 20]])
+    output = array_to_keypoints(array)
+    for kp, expected in zip(output, kps):
+        assert kp.pt == pytest.approx(expected.pt)
+        assert kp.size == pytest.approx(expected.size)
+        assert kp.response == pytest.approx(expected.response)
+        assert kp.octave == expected.octave
+        assert kp.class_id == expected.class_id
+    # empty keypoints
+    assert keypoints_to_array([]).shape == (0, 7)
+
+
+def test_get_feature_cache_file(img_file, tmp_path):
+    f0 = get_feature_cache_file(str(tmp_path), img_file, scale=0.5,
+                                crop=None, hessian_threshold=100)
+    assert os.path.dirname(f0) == str(tmp_path)
+    assert os.path.basename(f0).startswith('test_features_img_')
+    assert f0.endswith('.npz')
+    # stable
+    assert f0 == get_feature_cache_file(str(tmp_path), img_file, scale=0.5,
+                                        crop=None, hessian_threshold=100)
+    # changes with params
+    assert f0 != get_feature_cache_file(str(tmp_path), img_file, scale=1,
+                                        crop=None, hessian_threshold=100)
+    assert f0 != get_feature_cache_file(str(tmp_path), img_file, scale=0.5,
+                                        crop=None, hessian_threshold=400)
+
+
+def test_save_load_features(tmp_path):
+    cache_file = str(tmp_path / 'test.npz')
+    assert load_features(cache_file) is None
+    kps = np.random.rand(5, 7).astype(np.float32)
+    des = np.random.rand(5, 64).astype(np.float32)
+    trans = rasterio.transform.Affine(2, 0, 10, 0, 2, 20)
+    save_features(cache_file, kps, des, trans)
+    kps_out, des_out, trans_out = load_features(cache_file)
+    np.testing.assert_array_equal(kps, kps_out)
+    np.testing.assert_array_equal(des, des_out)
+    assert trans_out == pytest.approx(trans)
+    # no descriptors found
+    save_features(cache_file, kps[0:0], None, trans)
+    kps_out, des_out, _ = load_features(cache_file)
+    assert kps_out.shape == (0, 7)
+    assert des_out is None
+    # corrupted cache
+    with open(cache_file, 'w') as f:
+        f.write('corrupted')
+    assert load_features(cache_file) is None
+
+
+@pytest.mark.parametrize(
+    'detector,algorithm,dtype',
+    [('sift', FLANN_INDEX_KDTREE, np.float32),
+     ('orb', FLANN_INDEX_LSH, np.uint8),
+     ('akaze', FLANN_INDEX_LSH, np.uint8),
+     ('brisk', FLANN_INDEX_LSH, np.uint8)])
+def test_create_detector(detector, algorithm, dtype):
+    fd, index_params = create_detector(detector, n_features=100)
+    assert index_params['algorithm'] == algorithm
+    img = (np.random.RandomState(0).rand(200, 200) * 255).astype(np.uint8)
+    img = cv.GaussianBlur(img, (5, 5), 0)
+    kps, des = fd.detectAndCompute(img, mask=None)
+    assert len(kps) == len(des) > 0
+    assert des.dtype == dtype
+    if detector == 'orb':
+        assert len(kps) <= 100
+    with pytest.raises(ValueError):
+        create_detector('unknown')
+
+
+def test_select_keypoints():
+    # dense strong keypoints in the top left cell, weak ones elsewhere
+    rng = np.random.RandomState(0)
+    dense = np.zeros((100, 7), dtype=np.float32)
+    dense[:, 0:2] = rng.rand(100, 2) * 10
+    dense[:, 4] = 1 + rng.rand(100)
+    sparse = np.zeros((15, 7), dtype=np.float32)
+    sparse[:, 0:2] = rng.rand(15, 2) * 60 + 20
+    sparse[:, 4] = rng.rand(15) * 0.1
+    kps = np.vstack([dense, sparse])
+    idx = select_keypoints(kps, (80, 80), max_keypoints=20, grid=4)
+    assert len(idx) == len(np.unique(idx)) == 20
+    # sparse keypoints are all kept, the strongest dense ones fill the rest
+    assert set(range(100, 115)) <= set(idx)
+    expected = np.argsort(-dense[:, 4])[0:5]
+    np.testing.assert_array_equal(np.sort(idx[idx < 100]), np.sort(expected))
+    # within budget
+    np.testing.assert_array_equal(
+        select_keypoints(kps, (80, 80), max_keypoints=200), np.arange(115))
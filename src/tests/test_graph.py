@@ -2,9 +2,12 @@ import pytest
 
 import collections
 import numpy as np
+import shapely.geometry
 
-from ..graph import (make_symmetric, build_graph,
-                     get_links, traverse, get_subgraphs)
+from ..graph import (make_symmetric, Graph, build_graph,
+                     get_knn_edges, get_radius_edges,
+                     get_spanning_tree, select_loop_closures,
+                     get_links, order_pairs, traverse, get_subgraphs)
 
 
 def test_make_symmetric():
@@ -14,6 +17,33 @@ def test_make_symmetric():
     assert g == {1: [2, 3], 4: [3], 2: [1], 3: [1, 4], 5: []}
 
 
+def test_graph():
+    g = Graph.from_dict({1: [2, 3], 4: [3], 5: [], 3: [1]})
+    assert g.nodes == [1, 4, 5, 3, 2]
+    assert g == {1: [2, 3], 4: [3], 2: [1], 3: [1, 4], 5: []}
+    assert g != {1: [2], 2: [1], 3: [4], 4: [3], 5: []}
+    assert g[3] == [1, 4]
+    assert 5 in g and 6 not in g
+    assert len(g) == 5
+    assert g.indptr.tolist() == [0, 2, 3, 3, 5, 6]
+    assert g.get_edges().tolist() == [[0, 3], [0, 4], [1, 3]]
+    assert Graph.from_dict(g) is g
+    # subgraph
+    assert g.subgraph([1, 3, 5, 6]) == {1: [3], 3: [1], 5: []}
+    # union
+    assert g.union({6: [5], 1: [4]}) == {
+        1: [2, 3, 4], 4: [3, 1], 2: [1], 3: [1, 4], 5: [6], 6: [5]}
+    # connected components
+    assert sorted(g.connected_components(), key=len) == [{5}, {1, 2, 3, 4}]
+
+
+def test_graph_from_edges():
+    g = Graph.from_edges(['a', 'b', 'c', 'd'], np.array([[3, 0], [0, 3]]))
+    assert g.nodes == ['a', 'd']
+    assert g == {'a': ['d'], 'd': ['a']}
+    assert Graph() == {}
+
+
 @pytest.mark.parametrize(
     'indices,method,neighbor_within_swath,'
     'positions,neighbor_across_swath,max_dist,expected',
@@ -64,6 +94,130 @@ def test_build_graph(indices, method,
         max_dist=max_dist) == expected
 
 
+def test_build_graph_within():
+    # images identified by their order of capture
+    indices = [[3, 1, 2], [0]]
+    graph = build_graph(indices=indices, method='within',
+                        neighbor_within_swath=1)
+    assert graph == {3: [1], 1: [3, 2], 2: [1]}
+    # tuple identifiers in swath order
+    indices = [[(0, 3), (0, 1), (0, 2)], [(1, 0)]]
+    graph = build_graph(indices=indices, method='within',
+                        neighbor_within_swath=1, ordered=True)
+    assert graph == {(0, 3): [(0, 1)], (0, 1): [(0, 3), (0, 2)],
+                     (0, 2): [(0, 1)]}
+
+
+def test_build_graph_retrieval():
+    rng = np.random.RandomState(0)
+    # images (0, k) and (1, k) see the same scene points across swaths
+    points = [rng.uniform(size=(40, 64)) for _ in range(3)]
+    indices = [[(0, 0), (0, 1), (0, 2)], [(1, 0), (1, 1), (1, 2)]]
+    descriptors = [[p[rng.choice(40, 30, replace=False)] for p in points]
+                   for _ in range(2)]
+    graph = build_graph(
+        indices=indices, method='retrieval', descriptors=descriptors,
+        neighbor_retrieval=1, retrieval_words=60)
+    assert graph == {(0, 0): [(1, 0)], (1, 0): [(0, 0)],
+                     (0, 1): [(1, 1)], (1, 1): [(0, 1)],
+                     (0, 2): [(1, 2)], (1, 2): [(0, 2)]}
+    # images sharing no visual words
+    descriptors = [[points[0]], [points[1] + 100]]
+    with pytest.raises(ValueError):
+        build_graph(indices=[[(0, 0)], [(1, 0)]], method='retrieval',
+                    descriptors=descriptors, neighbor_retrieval=1,
+                    retrieval_words=100)
+
+
+@pytest.mark.parametrize(
+    'k,max_dist,expected',
+    [
+        (1, None, [[0, 1], [2, 3]]),
+        (2, None, [[0, 1], [0, 2], [1, 2], [1, 3], [2, 3]]),
+        (2, 1.5, [[0, 1], [2, 3]]),
+        (10, None, [[0, 1], [0, 2], [0, 3], [1, 2], [1, 3], [2, 3]]),
+    ],
+)
+def test_get_knn_edges(k, max_dist, expected):
+    positions = np.array([[0, 0], [1, 0], [3, 0], [4, 0]])
+    assert get_knn_edges(positions, k, max_dist).tolist() == expected
+
+
+def test_get_radius_edges():
+    positions = np.array([[0, 0], [1, 0], [3, 0], [4, 0]])
+    assert get_radius_edges(positions, 2).tolist() == [[0, 1], [1, 2], [2, 3]]
+
+
+@pytest.mark.parametrize(
+    'method,n_neighbors,max_dist,expected',
+    [
+        ('knn', 1, None,
+         {(2, 3): [(2, 9)], (2, 9): [(2, 3)],
+          (13, 1): [(13, 2)], (13, 2): [(13, 1)]}),
+        ('radius', None, 7,
+         {(2, 3): [(2, 9)], (2, 9): [(2, 3)],
+          (13, 1): [(13, 2)], (13, 2): [(13, 1)]}),
+        ('radius', None, 9.5,
+         {(2, 3): [(2, 9), (13, 1)], (2, 9): [(2, 3)],
+          (13, 1): [(13, 2), (2, 3)], (13, 2): [(13, 1)]}),
+    ],
+)
+def test_build_graph_knn(method, n_neighbors, max_dist, expected):
+    indices = [[(2, 3), (2, 9)], [(13, 1), (13, 2)]]
+    positions = [np.array([[0, 0], [0, -4]]),
+                 np.array([[9, 0], [15, 0]])]
+    graph = build_graph(indices=indices, method=method, positions=positions,
+                        n_neighbors=n_neighbors, max_dist=max_dist)
+    assert graph == expected
+
+
+@pytest.mark.parametrize(
+    'min_overlap,expected',
+    [
+        (0, {(0, 0): [(0, 1), (1, 0)], (0, 1): [(0, 0)], (1, 0): [(0, 0)]}),
+        (0.2, {(0, 0): [(0, 1)], (0, 1): [(0, 0)]}),
+    ],
+)
+def test_build_graph_overlap(min_overlap, expected):
+    indices = [[(0, 0), (0, 1)], [(1, 0), (1, 1)]]
+    footprints = [
+        [shapely.geometry.box(0, 0, 10, 10),
+         shapely.geometry.box(5, 0, 15, 10)],
+        # overlaps (0, 0) by 10%, far from all others
+        [shapely.geometry.box(-5, 8, 5, 18),
+         shapely.geometry.box(100, 100, 110, 110)]]
+    graph = build_graph(indices=indices, method='overlap',
+                        footprints=footprints, min_overlap=min_overlap)
+    assert graph == expected
+
+
+def test_get_spanning_tree():
+    # a square with a diagonal, and a separate edge
+    edges = np.array([[0, 1], [1, 2], [2, 3], [0, 3], [0, 2], [4, 5]])
+    weights = np.array([0.9, 0.1, 0.8, 0.2, 0.5, 0.3])
+    in_tree = get_spanning_tree(6, edges, weights)
+    assert in_tree.tolist() == [True, False, True, False, True, True]
+    assert get_spanning_tree(2, np.zeros((0, 2)), np.zeros(0)).tolist() == []
+
+
+@pytest.mark.parametrize(
+    'n_links,budget,expected',
+    [
+        (None, None, [2, 0, 1]),
+        (None, 2, [2, 0]),
+        (2, None, [2, 0]),
+        (1, None, [2]),
+        (3, 1, [2]),
+    ],
+)
+def test_select_loop_closures(n_links, budget, expected):
+    edges = np.array([[0, 1], [1, 2], [0, 2]])
+    weights = np.array([0.5, 0.1, 0.9])
+    degrees = np.array([0, 1, 1])
+    assert select_loop_closures(
+        edges, weights, degrees, n_links, budget).tolist() == expected
+
+
 @pytest.mark.parametrize(
     'graph,links,subset,symmetric,expected',
     [
@@ -117,6 +271,24 @@ def test_get_links(graph, links, subset, symmetric, expected):
                      subset=subset, symmetric=symmetric) == expected
 
 
+def test_order_pairs():
+    # a chain of images, pairs listed in a scattered order
+    pairs = [(0, 1), (3, 4), (1, 2), (0, 2), (2, 3), (4, 5), (1, 3)]
+    assert order_pairs(pairs) == list(range(len(pairs)))
+    order = order_pairs(pairs, method='locality')
+    assert sorted(order) == list(range(len(pairs)))
+    ordered = [pairs[k] for k in order]
+    # every image is last used within a short window of its first use
+    first = {}
+    last = {}
+    for k, pair in enumerate(ordered):
+        for node in pair:
+            first.setdefault(node, k)
+            last[node] = k
+    assert max(last[n] - first[n] for n in first) <= 3
+    assert order_pairs([], method='locality') == []
+
+
 @pytest.mark.parametrize(
     'graph,start_node,method,expected',
     [
@@ -5,8 +5,8 @@ import pandas as pd
 import rasterio
 import rasterio.transform
 
-from ..initialize import (parse_sortie, initialize_centroids,
-                          initialize_theta_scale)
+from ..initialize import (parse_sortie, estimate_headings, segment_swaths,
+                          initialize_centroids, initialize_theta_scale)
 
 
 def test_parse_sortie_corners(tmp_path):
@@ -53,6 +53,43 @@ def test_parse_sortie_centroids(tmp_path):
     pd.testing.assert_frame_equal(out_df, out_df_true, check_dtype=False)
 
 
+def lawnmower():
+    # east along y = 0, then west along y = 1, then east along y = 2
+    return np.array([[0, 0], [1, 0], [2, 0], [3, 0],
+                     [3, 1], [2, 1], [1, 1], [0, 1],
+                     [0, 2], [1, 2], [2, 2]], dtype=float)
+
+
+def test_estimate_headings():
+    headings = estimate_headings(lawnmower())
+    east, west = 0, np.pi
+    np.testing.assert_allclose(
+        np.cos(headings), np.cos([east] * 4 + [west] * 4 + [east] * 3),
+        atol=1e-6)
+
+
+@pytest.mark.parametrize(
+    'positions,headings,expected_ids,expected_orders',
+    [
+        (lawnmower(), None,
+         [0, 0, 0, 0, 1, 1, 1, 1, 2, 2, 2],
+         [0, 1, 2, 3, 0, 1, 2, 3, 0, 1, 2]),
+        # yaw overrides positions
+        (lawnmower(), np.array([0.] * 6 + [np.pi] * 5),
+         [0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1],
+         [0, 1, 2, 3, 4, 5, 0, 1, 2, 3, 4]),
+        # gap along a straight line
+        (np.array([[0, 0], [1, 0], [2, 0], [10, 0], [11, 0]]), None,
+         [0, 0, 0, 1, 1], [0, 1, 2, 0, 1]),
+        (np.zeros((1, 2)), None, [0], [0]),
+    ],
+)
+def test_segment_swaths(positions, headings, expected_ids, expected_orders):
+    swath_ids, orders = segment_swaths(positions, headings=headings)
+    assert swath_ids.tolist() == expected_ids
+    assert orders.tolist() == expected_orders
+
+
 @pytest.mark.parametrize(
     'indices,links,widths,heights,x0,x1,y0,y1,expected_x,expected_y',
     [
@@ -5,7 +5,8 @@ import torch
 import rasterio
 import rasterio.transform
 
-from ..optim import get_distribution, optimize
+from ..optim import (get_distribution, optimize, get_affines,
+                     optimize_least_squares)
 
 
 @pytest.mark.parametrize(
@@ -274,3 +275,117 @@ def test_optimize(expected_loss, expected_affines,
                 output_affines_iter, expected_affines_iter):
             assert output_affine == pytest.approx(
                 expected_affine, rel=1e-4, abs=1e-2)
+
+
+@pytest.mark.parametrize(
+    'kwargs,expected_stop',
+    [
+        ({}, (999, 'n_iter')),
+        # gradients are zero, stops at once
+        ({'grad_tol': 1e-6}, (0, 'grad_tol')),
+        ({'step_tol': 1e-6}, (0, 'step_tol')),
+        ({'rtol': 1e-6, 'patience': 3}, (3, 'rtol')),
+    ],
+)
+def test_optimize_early_stopping_converged(kwargs, expected_stop):
+    output_iter, output_loss, _, stop = optimize(
+        nodes=[0, 1], links={(0, 1): rasterio.transform.Affine.identity()},
+        width=[20, 20], height=[30, 30], thetas_init=[0, 0],
+        scales_init=[1, 1], xs_init=[0, 0], ys_init=[0, 0],
+        n_iter=1000, lr_theta=0.01, lr_scale=0.01, lr_xy=0.1,
+        output_iter=[2, 999], verbose=False, return_stop=True, **kwargs)
+    assert stop == expected_stop
+    # outputs up to the stopping iteration
+    assert output_iter == sorted(set(
+        [k for k in [2, 999] if k <= stop[0]] + [stop[0]]))
+    assert output_loss == pytest.approx([0] * len(output_iter), abs=1e-8)
+
+
+def test_optimize_early_stopping():
+    # case 2 in test_optimize, converges long before n_iter
+    nodes = [(12, 4), (15, 3), (56, 1)]
+    links = {
+        ((12, 4), (15, 3)): rasterio.transform.Affine.translation(10, 0),
+        ((15, 3), (56, 1)): rasterio.transform.Affine.translation(15, 0),
+    }
+    _, output_loss, _, (stop_iter, stop_reason) = optimize(
+        nodes=nodes, links=links, width=[20] * 3, height=[30] * 3,
+        thetas_init=[0] * 3, scales_init=[1] * 3,
+        xs_init=[60, 70, 89], ys_init=[75, 75, 72],
+        n_iter=5000, lr_theta=0, lr_scale=0, lr_xy=0.5,
+        rtol=1e-4, patience=10, verbose=False, return_stop=True)
+    assert stop_iter < 4999
+    assert stop_reason == 'rtol'
+    assert output_loss[-1] < 1e-2
+
+
+def test_get_affines():
+    affines = get_affines(
+        thetas=np.array([0, np.pi / 2]), scales=np.array([1, 2]),
+        xs=np.array([10, 0]), ys=np.array([15, 0]),
+        width=np.array([20, 20]), height=np.array([30, 30]))
+    assert rasterio.transform.Affine(*affines[0, 0:2].flatten()) == (
+        rasterio.transform.Affine.translation(0, 0))
+    # center of the image is at (0, 0)
+    assert affines[1] @ np.array([10, 15, 1]) == pytest.approx([0, 0, 1])
+    np.testing.assert_allclose(
+        affines[1, 0:2, 0:2], [[0, -2], [2, 0]], atol=1e-12)
+
+
+@pytest.mark.parametrize(
+    'thetas_init,scales_init,xs_init,ys_init,expected_affines',
+    [
+        # translations only, the first image is fixed
+        ([0, 0, 0, 0], [1, 1, 1, 1], [60, 70, 89, 0], [75, 75, 72, 0],
+         [rasterio.transform.Affine.translation(50, 60),
+          rasterio.transform.Affine.translation(60, 60),
+          rasterio.transform.Affine.translation(75, 60),
+          # not linked, unchanged
+          rasterio.transform.Affine.translation(-10, -15)]),
+        # rotation and scaling of the first image carry over
+        ([np.pi / 2, 0.1, -0.2, 0], [2, 1.5, 2.5, 1], [60, 70, 89, 0],
+         [75, 75, 72, 0],
+         [rasterio.transform.Affine(0, -2, 90, 2, 0, 55),
+          rasterio.transform.Affine(0, -2, 90, 2, 0, 75),
+          rasterio.transform.Affine(0, -2, 90, 2, 0, 105),
+          rasterio.transform.Affine.translation(-10, -15)]),
+    ],
+)
+def test_optimize_least_squares(thetas_init, scales_init, xs_init, ys_init,
+                                expected_affines):
+    nodes = [(12, 4), (15, 3), (56, 1), (57, 1)]
+    links = {
+        ((12, 4), (15, 3)): rasterio.transform.Affine.translation(10, 0),
+        ((15, 3), (56, 1)): rasterio.transform.Affine.translation(15, 0),
+        ((12, 4), (56, 1)): None,
+    }
+    output_iter, output_loss, output_affines, stop = optimize_least_squares(
+        nodes=nodes, links=links, width=[20] * 4, height=[30] * 4,
+        thetas_init=thetas_init, scales_init=scales_init,
+        xs_init=xs_init, ys_init=ys_init, verbose=False, return_stop=True)
+    assert len(output_iter) == len(output_loss) == len(output_affines) == 1
+    assert output_iter[0] < 50
+    assert stop[0] == output_iter[0]
+    assert stop[1] in ['gtol', 'ftol', 'xtol', 'ftol_xtol']
+    assert output_loss[0] == pytest.approx(0, abs=1e-8)
+    for output_affine, expected_affine in zip(
+            output_affines[0], expected_affines):
+        assert output_affine == pytest.approx(
+            expected_affine, rel=1e-4, abs=1e-4)
+
+
+def test_optimize_least_squares_max_nfev():
+    _, _, _, stop = optimize_least_squares(
+        nodes=[0, 1], links={(0, 1): rasterio.transform.Affine.translation(
+            10, 0)}, width=[20, 20], height=[30, 30], thetas_init=[0, 0],
+        scales_init=[1, 1], xs_init=[0, 0], ys_init=[0, 0], max_nfev=1,
+        verbose=False, return_stop=True)
+    assert stop == (1, 'max_nfev')
+
+
+def test_optimize_least_squares_no_links():
+    with pytest.raises(ValueError):
+        optimize_least_squares(
+            nodes=[0, 1], links={(0, 1): None}, width=[1, 1],
+            height=[1, 1], thetas_init=[0, 0], scales_init=[1, 1],
+            xs_init=[0, 0], ys_init=[0, 0])
@@ -8,7 +8,8 @@ import rasterio
 import rasterio.transform
 import rasterio.warp
 
-from ..preprocess import preprocess
+from ..preprocess import (preprocess, show_preprocess, get_cache_file,
+                          to_grayscale, warm_cache, read_size)
 
 
 @pytest.fixture
@@ -34,8 +35,10 @@ def cache_dir(tmp_path):
 
 
 @pytest.fixture
-def cache_file(cache_dir):
-    return str(cache_dir / 'test_preprocess_main.tif')
+def cache_file(cache_dir, raw_file):
+    return get_cache_file(str(cache_dir), raw_file, scale=0.5,
+                          crop={'top': 0.5, 'bottom': 0.8,
+                                'left': 0.3, 'right': 1})
 
 
 def test_preprocess_output(raw_file, processed_file, reproj_file):
@@ -93,11 +96,103 @@ def test_preprocess_cache(raw_file, cache_dir, cache_file):
     assert trans0 == pytest.approx(trans1)
     assert size == os.path.getsize(cache_file)
 
-    # 3. check that cache file is overwritten w/ new settings
+    # 3. check that new settings are cached separately
     img2, trans2 = preprocess(file=raw_file, scale=0.1,
                               crop={'top': 0.2, 'bottom': 0.3,
                                     'left': 0.1, 'right': 1},
                               cache=True, cache_dir=str(cache_dir))
     # test for image shape
     assert img2.shape == (15, 117)  # height, width
-    assert size != os.path.getsize(cache_file)
+    assert size == os.path.getsize(cache_file)
+    assert len(list(cache_dir.glob('*.tif'))) == 2
+    # both cached images are loaded
+    img3, _ = preprocess(file=raw_file, scale=0.5,
+                         crop={'top': 0.5, 'bottom': 0.8,
+                               'left': 0.3, 'right': 1},
+                         cache=True, cache_dir=str(cache_dir))
+    np.testing.assert_array_equal(img0, img3)
+    img4, _ = preprocess(file=raw_file, scale=0.1,
+                         crop={'top': 0.2, 'bottom': 0.3,
+                               'left': 0.1, 'right': 1},
+                         cache=True, cache_dir=str(cache_dir))
+    np.testing.assert_array_equal(img2, img4)
+
+
+def test_get_cache_file(cache_dir, raw_file):
+    f0 = get_cache_file(str(cache_dir), raw_file, scale=0.5, crop=None)
+    f1 = get_cache_file(str(cache_dir), raw_file, scale=0.25, crop=None)
+    f2 = get_cache_file(str(cache_dir), raw_file, scale=0.5,
+                        crop={'top': 0, 'bottom': 1, 'left': 0.1, 'right': 1})
+    f3 = get_cache_file(str(cache_dir), raw_file, scale=0.5, crop=None,
+                        multiband=True)
+    assert len({f0, f1, f2, f3}) == 4
+    assert os.path.basename(f0) == 'test_preprocess_main_s0.5.tif'
+    assert get_cache_file(str(cache_dir), raw_file) == get_cache_file(
+        str(cache_dir), raw_file, scale=1)
+
+
+def test_read_size(raw_file):
+    img = cv.imread(raw_file)
+    assert read_size(raw_file) == (img.shape[1], img.shape[0])
+
+
+def test_show_preprocess(raw_file, cache_dir):
+    crop = {'top': 0.5, 'bottom': 0.8, 'left': 0.3, 'right': 1}
+    img, trans = show_preprocess(file=raw_file, scale=0.5, crop=crop,
+                                 cache=True, cache_dir=str(cache_dir))
+    # bands are kept, crop and scale are consistent with preprocess
+    assert img.shape == (1, 225, 455)  # bands, height, width
+    assert img.dtype == np.uint8
+    expected, expected_trans = preprocess(file=raw_file, scale=0.5,
+                                          crop=crop)
+    np.testing.assert_array_equal(img.squeeze(0), expected)
+    assert trans == pytest.approx(expected_trans)
+    # cached separately from grayscale images
+    assert os.path.isfile(get_cache_file(
+        str(cache_dir), raw_file, scale=0.5, crop=crop, multiband=True))
+    cached, _ = show_preprocess(file=raw_file, scale=0.5, crop=crop,
+                                cache=True, cache_dir=str(cache_dir))
+    np.testing.assert_array_equal(img, cached)
+
+
+def test_to_grayscale():
+    rgb = np.random.randint(0, 256, (3, 20, 30), dtype=np.uint8)
+    # single band
+    np.testing.assert_array_equal(to_grayscale(rgb[0:1]), rgb[0])
+    # rgb, weighted conversion
+    gray = to_grayscale(rgb)
+    assert gray.shape == (20, 30)
+    assert gray.dtype == np.uint8
+    np.testing.assert_array_equal(
+        gray, cv.cvtColor(rgb.transpose((1, 2, 0)), cv.COLOR_RGB2GRAY))
+    # rgba, alpha is ignored
+    rgba = np.concatenate([rgb, np.zeros((1, 20, 30), np.uint8)])
+    np.testing.assert_array_equal(to_grayscale(rgba), gray)
+    # other band counts are averaged w/o overflow
+    img = np.full((5, 2, 2), 255, dtype=np.uint8)
+    img[0] = 0
+    np.testing.assert_array_equal(to_grayscale(img), np.full((2, 2), 204))
+    assert to_grayscale(img.astype(np.uint16)).dtype == np.uint16
+
+
+@pytest.mark.parametrize('n_workers', [None, 2])
+def test_warm_cache(n_workers, raw_file, cache_dir):
+    crop = {'top': 0.5, 'bottom': 0.8, 'left': 0.3, 'right': 1}
+    summary = warm_cache([raw_file], scales=[0.25, 0.5], crop=crop,
+                         cache_dir=str(cache_dir), n_workers=n_workers)
+    cache_files = [get_cache_file(str(cache_dir), raw_file,
+                                  scale=scale, crop=crop)
+                   for scale in [0.25, 0.5]]
+    assert summary == {
+        'n_written': 2, 'n_skipped': 0,
+        'bytes_written': sum(os.path.getsize(f) for f in cache_files)}
+    # cached images are identical to preprocessed ones
+    img, _ = preprocess(file=raw_file, scale=0.5, crop=crop)
+    cached, _ = preprocess(file=raw_file, scale=0.5, crop=crop,
+                           cache=True, cache_dir=str(cache_dir))
+    np.testing.assert_array_equal(img, cached)
+    # valid cache is skipped
+    summary = warm_cache([raw_file], scales=[0.25, 0.5, 1], crop=crop,
+                         cache_dir=str(cache_dir), n_workers=n_workers)
+    assert summary['n_written'] == 1
+    assert summary['n_skipped'] == 2
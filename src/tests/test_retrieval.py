@@ -0,0 +1,122 @@
+import pytest
+
+import numpy as np
+import scipy.sparse
+import cv2 as cv
+
+from ..retrieval import to_float, top_per_row, VocabularyTree, RetrievalIndex
+
+
+def make_descriptors(binary, n_groups=3, n_images=4, n_points=50, seed=0):
+    """Images in the same group share a set of scene points."""
+    rng = np.random.RandomState(seed)
+    descriptors = []
+    for _ in range(n_groups):
+        if binary:
+            points = rng.randint(0, 256, size=(n_points, 32), dtype=np.uint8)
+        else:
+            points = rng.uniform(size=(n_points, 64)).astype(np.float32)
+        for _ in range(n_images):
+            des = points[rng.choice(n_points, n_points // 2, replace=False)]
+            if not binary:
+                des = des + rng.normal(scale=0.01, size=des.shape)
+            descriptors.append(des)
+    return descriptors
+
+
+def test_to_float():
+    des = np.array([[1, 255]], dtype=np.uint8)
+    out = to_float(des)
+    assert out.dtype == np.float32
+    assert out.tolist() == [[0] * 7 + [1] + [1] * 8]
+
+
+def test_top_per_row():
+    matrix = scipy.sparse.csr_matrix(
+        [[0, 3, 1, 2], [0, 0, 5, 0], [0, 0, 0, 0]])
+    output = top_per_row(matrix, 2)
+    assert output.toarray().tolist() == [[0, 3, 0, 2], [0, 0, 5, 0],
+                                         [0, 0, 0, 0]]
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_retrieval_index(binary):
+    descriptors = make_descriptors(binary)
+    index = RetrievalIndex(n_words=60).fit(descriptors)
+    # rounded to a power of the branching factor
+    assert index.vectors.shape == (12, 100)
+    np.testing.assert_allclose(
+        np.asarray(index.vectors.multiply(index.vectors).sum(axis=1)), 1)
+    pairs, scores = index.query(k=3)
+    # the top 3 images are the others in the same group
+    expected = [(i, j) for i in range(12) for j in range(i + 1, 12)
+                if i // 4 == j // 4]
+    assert sorted(map(tuple, pairs.tolist())) == expected
+    assert np.all(pairs[:, 0] < pairs[:, 1])
+    assert np.all(scores > 0)
+    # batching does not change the results
+    pairs_batch, scores_batch = index.query(k=3, batch_size=5)
+    np.testing.assert_array_equal(pairs, pairs_batch)
+    np.testing.assert_allclose(scores, scores_batch)
+
+
+def test_retrieval_index_missing():
+    descriptors = make_descriptors(False, n_groups=2)
+    descriptors[1] = None
+    index = RetrievalIndex(n_words=40).fit(descriptors)
+    pairs, _ = index.query(k=2)
+    # images without descriptors are never retrieved
+    assert 1 not in pairs
+
+
+def test_vocabulary_tree():
+    rng = np.random.RandomState(0)
+    centers = rng.uniform(size=(4, 8)) * 10
+    des = (centers[rng.randint(4, size=400)] +
+           rng.normal(scale=0.1, size=(400, 8))).astype(np.float32)
+    tree = VocabularyTree(branching=4, depth=2).fit(des)
+    assert tree.n_words == 16
+    words = tree.quantize(des)
+    assert words.min() >= 0 and words.max() < 16
+    # descriptors of the same cluster share the first level
+    _, first = np.unique(words // 4, return_inverse=True)
+    _, expected = np.unique(
+        np.argmin(((des[:, np.newaxis] - centers) ** 2).sum(axis=2), axis=1),
+        return_inverse=True)
+    assert len(np.unique(first)) == 4
+    assert len(set(zip(first, expected))) == 4
+    # duplicated descriptors do not break k-means
+    tree = VocabularyTree(branching=4, depth=2).fit(
+        np.repeat(des[0:2], 50, axis=0))
+    assert len(np.unique(tree.quantize(des[0:2]))) == 2
+
+
+def test_retrieval_index_common_words():
+    descriptors = make_descriptors(False)
+    # a scene point seen in every image
+    common = np.full((1, 64), 10, dtype=np.float32)
+    descriptors = [np.vstack([des, common]) for des in descriptors]
+    index = RetrievalIndex(n_words=100).fit(descriptors)
+    word = index.vocabulary.quantize(common)[0]
+    # down weighted, not dropped
+    assert 0 < index.idf[word] < index.idf.max()
+    assert index.vectors[:, word].nnz == 12
+
+
+@pytest.mark.parametrize('detector', ['sift', 'orb'])
+def test_retrieval_index_features(data_dir, detector):
+    # two strips of overlapping frames, with real feature counts
+    img = cv.imread(str(data_dir / 'test_stitch_main.jpg'),
+                    cv.IMREAD_GRAYSCALE)
+    fd = cv.SIFT_create() if detector == 'sift' else cv.ORB_create(3000)
+    descriptors = [fd.detectAndCompute(img[y:(y + 500), x:(x + 500)], None)[1]
+                   for y in [0, 800] for x in [0, 100, 200, 300, 400]]
+    assert min(len(des) for des in descriptors) > 1000
+    index = RetrievalIndex().fit(descriptors)
+    pairs, scores = index.query(k=2)
+    # frames are only paired with overlapping frames in their strip
+    pairs = set(map(tuple, pairs.tolist()))
+    assert all(i // 5 == j // 5 and j - i <= 2 for i, j in pairs)
+    # including every consecutive pair
+    assert {(i, i + 1) for i in range(10) if i % 5 < 4} <= pairs
+    assert np.all(scores > 0)
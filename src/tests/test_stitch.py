@@ -1,13 +1,17 @@
 import pytest
 
+import os
+import pickle
 import numpy as np
 import cv2 as cv
 import rasterio
 import rasterio.warp
 import rasterio.transform
 import skimage.metrics
+import shapely.geometry
 
-from ..stitch import Stitcher
+from ..stitch import ESTIMATORS, Stitcher
+from ..utils import get_overlap_polygons
 
 
 @pytest.fixture
@@ -158,3 +162,317 @@ def test_stitch_pair(transforms, widths, heights, match, scale,
         assert trans == pytest.approx(~trans0 * trans1, rel=0.02)
     else:
         assert trans is None
+
+
+def test_stitch_pair_feature_cache(raw_img, tmp_path, stitcher, cache_dir):
+    trans0 = rasterio.transform.Affine(0.9, 0, 0, 0, 0.9, 50)
+    trans1 = rasterio.transform.Affine(1.1, -0.1, 200, 0.1, 1.1, 10)
+    f0 = str(tmp_path / 'test_stitch_img0.png')
+    cv.imwrite(f0, sub_img(trans0, 500, 700, raw_img))
+    f1 = str(tmp_path / 'test_stitch_img1.png')
+    cv.imwrite(f1, sub_img(trans1, 400, 800, raw_img))
+
+    # features are cached once per image and scale
+    assert stitcher.stitch_pair(f0, f1) == pytest.approx(
+        ~trans0 * trans1, rel=0.02)
+    cache_files = sorted(cache_dir.glob('*.npz'))
+    assert len(cache_files) == 2
+    mtimes = [os.path.getmtime(f) for f in cache_files]
+    # cached features are reused and yield the same result
+    assert stitcher.stitch_pair(f0, f1) == pytest.approx(
+        ~trans0 * trans1, rel=0.02)
+    assert [os.path.getmtime(f) for f in sorted(
+        cache_dir.glob('*.npz'))] == mtimes
+
+
+@pytest.mark.parametrize('detector', ['sift', 'orb', 'akaze', 'brisk'])
+def test_stitch_pair_detector(raw_img, tmp_path, cache_dir, detector):
+    stitcher = Stitcher(scales=[1], cache_dir=str(cache_dir),
+                        detector=detector, min_inliers=50)
+    trans0 = rasterio.transform.Affine(0.9, 0, 0, 0, 0.9, 50)
+    trans1 = rasterio.transform.Affine(1.1, -0.1, 200, 0.1, 1.1, 10)
+    f0 = str(tmp_path / 'test_stitch_img0.png')
+    cv.imwrite(f0, sub_img(trans0, 500, 700, raw_img))
+    f1 = str(tmp_path / 'test_stitch_img1.png')
+    cv.imwrite(f1, sub_img(trans1, 400, 800, raw_img))
+    assert stitcher.stitch_pair(f0, f1) == pytest.approx(
+        ~trans0 * trans1, rel=0.02)
+    assert stitcher.params['detector'] == detector
+
+
+@pytest.mark.parametrize('cached', [False, True])
+def test_stitch_pair_overlaps(raw_img, tmp_path, cache_dir, cached):
+    stitcher = Stitcher(scales=[0.5], cache_dir=str(cache_dir) if cached
+                        else None, detector='sift', min_inliers=50)
+    trans0 = rasterio.transform.Affine(0.9, 0, 0, 0, 0.9, 50)
+    trans1 = rasterio.transform.Affine(1.1, -0.1, 200, 0.1, 1.1, 10)
+    f0 = str(tmp_path / 'test_stitch_img0.png')
+    cv.imwrite(f0, sub_img(trans0, 500, 700, raw_img))
+    f1 = str(tmp_path / 'test_stitch_img1.png')
+    cv.imwrite(f1, sub_img(trans1, 400, 800, raw_img))
+    overlaps = get_overlap_polygons(
+        (trans0, trans1), (500, 400), (700, 800), dilation=0.05)
+    assert stitcher.stitch_pair(f0, f1, overlaps=overlaps) == pytest.approx(
+        ~trans0 * trans1, rel=0.02)
+    # wrong prior, no features in the expected overlap match
+    box = shapely.geometry.box(0, 0, 50, 50)
+    assert stitcher.stitch_pair(f0, f1, overlaps=(box, box)) is None
+
+
+def test_match_guided():
+    stitcher = Stitcher(detector='sift', lowe_ratio=0.7)
+    rng = np.random.RandomState(0)
+    kp1 = np.zeros((100, 7), dtype=np.float32)
+    kp1[:, 0:2] = rng.rand(100, 2) * 1000
+    des1 = rng.rand(100, 64).astype(np.float32)
+    # query keypoints are translated by (-10, 5)
+    kp0 = kp1[0:50].copy()
+    kp0[:, 0:2] -= [10, -5]
+    des0 = des1[0:50] + rng.normal(0, 1e-3, (50, 64)).astype(np.float32)
+    # decoys identical to the queries are far from predicted locations
+    kp1 = np.vstack([kp1, kp1[0:50] + [[500, 500, 0, 0, 0, 0, 0]]])
+    des1 = np.vstack([des1, des1[0:50]])
+    prior = rasterio.transform.Affine.translation(10, -5)
+    idx0, idx1 = stitcher.match_guided(kp0, des0, kp1, des1, prior)
+    np.testing.assert_array_equal(idx0, np.arange(50))
+    np.testing.assert_array_equal(idx1, np.arange(50))
+    # wrong prior, no candidates
+    idx0, _ = stitcher.match_guided(
+        kp0, des0, kp1, des1, rasterio.transform.Affine.translation(0, 2000))
+    assert len(idx0) == 0
+
+
+def test_stitch_pair_prior(raw_img, tmp_path, cache_dir):
+    stitcher = Stitcher(scales=[0.5], cache_dir=str(cache_dir),
+                        detector='sift', min_inliers=50)
+    trans0 = rasterio.transform.Affine(0.9, 0, 0, 0, 0.9, 50)
+    trans1 = rasterio.transform.Affine(1.1, -0.1, 200, 0.1, 1.1, 10)
+    f0 = str(tmp_path / 'test_stitch_img0.png')
+    cv.imwrite(f0, sub_img(trans0, 500, 700, raw_img))
+    f1 = str(tmp_path / 'test_stitch_img1.png')
+    cv.imwrite(f1, sub_img(trans1, 400, 800, raw_img))
+    expected = ~trans0 * trans1
+    # approximate prior
+    prior = rasterio.transform.Affine.translation(8, -6) * expected
+    trans, diag = stitcher.stitch_pair(f0, f1, verbose=True, prior=prior)
+    assert diag['guided']
+    assert diag['t_estimate'] > 0
+    assert trans == pytest.approx(expected, rel=0.02)
+    # wrong prior, falls back to global matching
+    prior = rasterio.transform.Affine.translation(300, 300) * expected
+    trans, diag = stitcher.stitch_pair(f0, f1, verbose=True, prior=prior)
+    assert not diag['guided']
+    assert trans == pytest.approx(expected, rel=0.02)
+
+
+def test_stitch_pair_coarse_to_fine(raw_img, tmp_path, cache_dir):
+    stitcher = Stitcher(scales=[0.25, 1], cache_dir=str(cache_dir),
+                        detector='sift', min_inliers=30, coarse_to_fine=True)
+    trans0 = rasterio.transform.Affine(0.9, 0, 0, 0, 0.9, 50)
+    trans1 = rasterio.transform.Affine(1.1, -0.1, 200, 0.1, 1.1, 10)
+    f0 = str(tmp_path / 'test_stitch_img0.png')
+    cv.imwrite(f0, sub_img(trans0, 500, 700, raw_img))
+    f1 = str(tmp_path / 'test_stitch_img1.png')
+    cv.imwrite(f1, sub_img(trans1, 400, 800, raw_img))
+    trans, diag = stitcher.stitch_pair(f0, f1, verbose=True)
+    assert diag['scale'] == 0.25
+    assert diag['refined_scale'] == 1
+    assert trans == pytest.approx(~trans0 * trans1, rel=0.02)
+    # only coarse scale images are cached, overlaps are read on the fly
+    assert all('_s0.25' in f.name for f in cache_dir.glob('*.tif'))
+    # no overlap predicted
+    assert stitcher.refine_pair(
+        f0, f1, rasterio.transform.Affine.translation(1000, 0), 1) is None
+
+
+@pytest.mark.parametrize('coarse_to_fine,tol', [(False, 5), (True, 1)])
+def test_stitch_pair_phase_correlation(raw_img, tmp_path, cache_dir,
+                                       coarse_to_fine, tol):
+    stitcher = Stitcher(scales=[1], cache_dir=str(cache_dir),
+                        detector='sift', min_inliers=30,
+                        coarse_to_fine=coarse_to_fine,
+                        phase_correlation_scale=0.25)
+    trans0 = rasterio.transform.Affine(1, 0, 0, 0, 1, 50)
+    f0 = str(tmp_path / 'test_stitch_img0.png')
+    cv.imwrite(f0, sub_img(trans0, 500, 700, raw_img))
+    # translated
+    trans1 = rasterio.transform.Affine(1, 0, 100, 0, 1, 250)
+    f1 = str(tmp_path / 'test_stitch_img1.png')
+    cv.imwrite(f1, sub_img(trans1, 500, 700, raw_img))
+    trans, diag = stitcher.stitch_pair(f0, f1, verbose=True)
+    assert diag['phase_correlation'] >= 0.3
+    # verified by guided matching
+    assert diag['n_inlier'] >= 30
+    assert trans == pytest.approx(~trans0 * trans1, abs=tol)
+    # slightly rotated, the translation is only a seed
+    trans1 = (rasterio.transform.Affine.translation(100, 250) *
+              rasterio.transform.Affine.rotation(3))
+    f1 = str(tmp_path / 'test_stitch_img3.png')
+    cv.imwrite(f1, sub_img(trans1, 500, 700, raw_img))
+    trans, diag = stitcher.stitch_pair(f0, f1, verbose=True)
+    assert diag['phase_correlation'] >= 0.3
+    assert diag['n_inlier'] >= 30
+    assert trans == pytest.approx(~trans0 * trans1, abs=tol)
+    # the rotation is estimated
+    assert trans[0:2] == pytest.approx((~trans0 * trans1)[0:2], abs=0.005)
+    # rotated and scaled, falls back to feature matching
+    trans1 = rasterio.transform.Affine(1.1, -0.1, 200, 0.1, 1.1, 10)
+    f1 = str(tmp_path / 'test_stitch_img2.png')
+    cv.imwrite(f1, sub_img(trans1, 400, 800, raw_img))
+    trans, diag = stitcher.stitch_pair(f0, f1, verbose=True)
+    assert 'phase_correlation' not in diag
+    assert trans == pytest.approx(~trans0 * trans1, rel=0.02)
+
+
+@pytest.mark.parametrize(
+    'estimator', ['ransac', 'lmeds', 'usac_magsac', 'usac_accurate'])
+def test_fit_affine(estimator):
+    if ESTIMATORS[estimator] is None:
+        pytest.skip('{} requires OpenCV >= 4.5'.format(estimator))
+    stitcher = Stitcher(detector='sift', estimator=estimator, max_iters=500)
+    rng = np.random.RandomState(0)
+    expected = np.array([[0.99, -0.1, 20], [0.1, 0.99, -5]])
+    pts1 = rng.rand(500, 2).astype(np.float32) * 500
+    pts0 = (pts1.dot(expected[:, 0:2].T) + expected[:, 2]).astype(np.float32)
+    # outliers
+    pts0[0:150] = rng.rand(150, 2) * 500
+    transform, inliers = stitcher.fit_affine(pts1, pts0, 3)
+    np.testing.assert_allclose(transform, expected, atol=1e-3)
+    assert inliers.dtype == bool
+    assert inliers[150:].all()
+    assert inliers[0:150].sum() < 5
+    with pytest.raises(ValueError):
+        Stitcher(detector='sift', estimator='unknown')
+
+
+def test_estimator_unavailable(monkeypatch):
+    # USAC flags are missing in OpenCV < 4.5
+    monkeypatch.setitem(ESTIMATORS, 'usac_magsac', None)
+    with pytest.raises(ValueError, match='not available'):
+        Stitcher(detector='sift', estimator='usac_magsac')
+
+
+def test_max_keypoints(raw_img):
+    stitcher = Stitcher(detector='sift', max_keypoints=300)
+    kps, des = stitcher.detect_and_compute(raw_img)
+    assert 0 < len(kps) == len(des) <= 300
+    # keypoints are spread over the image
+    assert kps[:, 0].min() < raw_img.shape[1] / 4
+    assert kps[:, 0].max() > raw_img.shape[1] * 3 / 4
+    assert kps[:, 1].min() < raw_img.shape[0] / 4
+    assert kps[:, 1].max() > raw_img.shape[0] * 3 / 4
+    assert len(Stitcher(detector='sift').detect_and_compute(raw_img)[0]) > 300
+
+
+def test_pickle(stitcher):
+    output = pickle.loads(pickle.dumps(stitcher))
+    assert output.scales == stitcher.scales
+    assert output.cache_dir == stitcher.cache_dir
+    # detector is rebuilt
+    assert output.fd is not stitcher.fd
+    assert output.index_params == stitcher.index_params
+
+
+def test_memory_cache(raw_img, tmp_path, cache_dir):
+    stitcher = Stitcher(scales=[0.9, 1], cache_dir=str(cache_dir),
+                        memory_cache_bytes=10 ** 8)
+    f0 = str(tmp_path / 'test_stitch_img0.png')
+    cv.imwrite(f0, raw_img)
+    img, trans = stitcher.load_image(f0, scale=0.9)
+    # served from memory
+    output = stitcher.load_image(f0, scale=0.9)
+    assert output[0] is img
+    kps, des, _ = stitcher.get_features(f0, scale=0.9)
+    assert stitcher.get_features(f0, scale=0.9)[1] is des
+    # features are extracted from the image cached in memory
+    assert stitcher.memory_cache.hits == 3
+    # scales are cached separately
+    assert stitcher.load_image(f0, scale=1)[0].shape != img.shape
+    # cached arrays are not pickled
+    assert len(pickle.loads(pickle.dumps(stitcher)).memory_cache) == 0
+
+
+def test_match_descriptors(stitcher):
+    rng = np.random.RandomState(0)
+    des1 = rng.rand(200, 64).astype(np.float32)
+    perm = rng.permutation(200)[0:50]
+    des0 = des1[perm] + rng.normal(0, 1e-3, (50, 64)).astype(np.float32)
+    # ambiguous query: halfway between two train descriptors
+    des0 = np.vstack([des0, (des1[0:1] + des1[1:2]) / 2])
+    idx0, idx1 = stitcher.match_descriptors(des0, des1)
+    np.testing.assert_array_equal(idx0, np.arange(50))
+    np.testing.assert_array_equal(idx1, perm)
+    # no descriptors
+    for d0, d1 in [(None, des1), (des0, None), (des0, des1[0:1])]:
+        idx0, idx1 = stitcher.match_descriptors(d0, d1)
+        assert len(idx0) == len(idx1) == 0
+    # reuse a trained index
+    index = cv.flann_Index(des1, stitcher.index_params)
+    output = stitcher.match_descriptors(des0, des1, index=index)
+    np.testing.assert_array_equal(output[1], perm)
+
+
+@pytest.mark.parametrize('persist_index', [False, True])
+def test_get_index(raw_img, tmp_path, cache_dir, persist_index):
+    stitcher = Stitcher(scales=[1], cache_dir=str(cache_dir),
+                        memory_cache_bytes=10 ** 8,
+                        persist_index=persist_index)
+    f0 = str(tmp_path / 'test_stitch_img0.png')
+    cv.imwrite(f0, raw_img)
+    index = stitcher.get_index(f0, scale=1)
+    # served from memory
+    assert stitcher.get_index(f0, scale=1) is index
+    assert len(list(cache_dir.glob('*.flann'))) == int(persist_index)
+    # loaded from disk by another process
+    output = pickle.loads(pickle.dumps(stitcher)).get_index(f0, scale=1)
+    assert output is not index
+    _, des, _ = stitcher.get_features(f0, scale=1)
+    np.testing.assert_array_equal(
+        stitcher.match_descriptors(des[0:100], des, index=output)[1],
+        np.arange(100))
+
+
+def test_stitch_many(raw_img, tmp_path, cache_dir):
+    stitcher = Stitcher(scales=[0.5, 1], cache_dir=str(cache_dir),
+                        memory_cache_bytes=10 ** 8)
+    trans0 = rasterio.transform.Affine(0.9, 0, 0, 0, 0.9, 50)
+    f0 = str(tmp_path / 'test_stitch_img0.png')
+    cv.imwrite(f0, sub_img(trans0, 500, 700, raw_img))
+    transforms1 = [rasterio.transform.Affine(1.1, -0.1, 200, 0.1, 1.1, 10),
+                   rasterio.transform.Affine(1, 0, 100, 0, 1, 100)]
+    files1 = []
+    for i, trans1 in enumerate(transforms1):
+        files1.append(str(tmp_path / 'test_stitch_img{}.png'.format(i + 1)))
+        cv.imwrite(files1[-1], sub_img(trans1, 400, 800, raw_img))
+    output = stitcher.stitch_many(f0, files1)
+    for trans, trans1 in zip(output, transforms1):
+        assert trans == pytest.approx(~trans0 * trans1, rel=0.02, abs=0.01)
+    # index of img0 is built once and reused
+    assert [k[1] for k in stitcher.memory_cache._data
+            if k[0] == 'index'] == [f0]
+
+
+def test_stitch_many_uncached(raw_img, tmp_path, monkeypatch):
+    # no memory or disk cache, img0 is still processed once
+    stitcher = Stitcher(scales=[1], detector='sift', min_inliers=50)
+    f0 = str(tmp_path / 'test_stitch_img0.png')
+    cv.imwrite(f0, sub_img(rasterio.transform.Affine.identity(), 500, 500,
+                           raw_img))
+    transforms1 = [rasterio.transform.Affine.translation(100, 50),
+                   rasterio.transform.Affine.translation(50, 150)]
+    files1 = []
+    for i, trans1 in enumerate(transforms1):
+        files1.append(str(tmp_path / 'test_stitch_img{}.png'.format(i + 1)))
+        cv.imwrite(files1[-1], sub_img(trans1, 500, 500, raw_img))
+    calls = []
+    get_features = stitcher.get_features
+    monkeypatch.setattr(stitcher, 'get_features', lambda file, scale: (
+        calls.append(file) or get_features(file, scale=scale)))
+    output = stitcher.stitch_many(f0, files1)
+    for trans, trans1 in zip(output, transforms1):
+        assert trans == pytest.approx(trans1, abs=1)
+    assert calls == [f0] + files1
+    # the index is kept by the dedicated index cache
+    assert list(stitcher._index_cache) == [('index', f0, 1, None)]
+    monkeypatch.undo()
+    assert pickle.loads(pickle.dumps(stitcher))._index_cache == {}
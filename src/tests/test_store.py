@@ -0,0 +1,44 @@
+import pytest
+
+import numpy as np
+import rasterio.transform
+
+from ..store import LinkStore
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    return str(tmp_path / 'cache' / 'links.sqlite')
+
+
+def test_link_store(db_file):
+    params = {'hessian_threshold': 100, 'min_inliers': 50}
+    store = LinkStore(db_file, params=params)
+    assert len(store) == 0
+    assert store.get('a.jpg', 'b.jpg') == (False, None)
+    # record links
+    trans = rasterio.transform.Affine(1, 0, 10, 0, 1, -5)
+    store.put('a.jpg', 'b.jpg', trans,
+              {'n_match': 300, 'n_inlier': np.int64(120), 'scale': 0.5})
+    store.put('a.jpg', 'c.jpg', None, {'n_match': 3})
+    assert store.get('a.jpg', 'b.jpg') == (True, trans)
+    assert store.get('a.jpg', 'c.jpg') == (True, None)
+    assert store.get('b.jpg', 'a.jpg') == (False, None)
+    assert len(store) == 2
+    store.close()
+
+    # records persist
+    store = LinkStore(db_file, params=params)
+    assert store.get('a.jpg', 'b.jpg') == (True, trans)
+    n_inlier, scale = store.conn.execute(
+        'SELECT n_inlier, scale FROM links '
+        'WHERE img0 = ? AND img1 = ?', ('a.jpg', 'b.jpg')).fetchone()
+    assert n_inlier == 120
+    assert scale == pytest.approx(0.5)
+    store.close()
+
+    # changing params invalidates records
+    store = LinkStore(db_file, params={**params, 'min_inliers': 100})
+    assert store.get('a.jpg', 'b.jpg') == (False, None)
+    assert len(store) == 0
+    store.close()
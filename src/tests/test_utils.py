@@ -14,6 +14,8 @@ from ..utils import (transform_coord,
                      create_batch_symlink,
                      convert_to_bbox,
                      get_centroid_dist,
+                     get_affine_init,
+                     get_overlap_polygons,
                      prepare_folder,
                      snap_to_grid,
                      grid_to_bounds,
@@ -136,6 +138,37 @@ def test_get_centroid_dist(transforms, widths, heights, expected):
             pytest.approx(expected))
 
 
+@pytest.mark.parametrize(
+    'x,y,theta,scale,width,height',
+    [(0, 0, 0, 1, 40, 20), (10, -5, np.pi / 6, 0.5, 40, 20)],
+)
+def test_get_affine_init(x, y, theta, scale, width, height):
+    trans = get_affine_init(x, y, theta, scale, width, height)
+    # image center is at (x, y)
+    assert trans * (width / 2, height / 2) == pytest.approx((x, y))
+    assert trans.determinant == pytest.approx(scale ** 2)
+    # columns are rotated by theta
+    assert np.subtract(trans * (1, 0), trans * (0, 0)) == pytest.approx(
+        (scale * np.cos(theta), scale * np.sin(theta)))
+
+
+def test_get_overlap_polygons():
+    transforms = (get_affine_init(0, 0, 0, 1, 40, 20),
+                  get_affine_init(20, 0, 0, 1, 40, 40))
+    poly0, poly1 = get_overlap_polygons(transforms, (40, 40), (20, 40))
+    assert poly0.equals(shapely.geometry.box(20, 0, 40, 20))
+    assert poly1.equals(shapely.geometry.box(0, 10, 20, 30))
+    # dilated and clipped to the images
+    poly0, poly1 = get_overlap_polygons(
+        transforms, (40, 40), (20, 40), dilation=0.1)
+    assert poly0.bounds == pytest.approx((20 - 0.1 * np.sqrt(2000), 0, 40, 20))
+    assert poly1.contains(shapely.geometry.box(0, 10, 20, 30))
+    # no overlap
+    transforms = (get_affine_init(0, 0, 0, 1, 40, 20),
+                  get_affine_init(100, 0, 0, 1, 40, 20))
+    assert get_overlap_polygons(transforms, (40, 40), (20, 20)) is None
+
+
 def test_prepare_folder(tmp_path):
     (tmp_path / 'test0').mkdir()
     prepare_folder([
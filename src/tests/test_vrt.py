@@ -12,7 +12,9 @@ import geopandas.testing
 import shapely
 import shapely.geometry
 
+from .. import vrt
 from ..vrt import VirtualRaster
+from ..store import LinkStore
 
 
 @pytest.fixture
@@ -399,6 +401,192 @@ def test_build_links(f, graph, expected, v_from_csv):
     assert v_from_csv.links == expected
 
 
+def basenames(i, j, **kwargs):
+    return [os.path.basename(i), os.path.basename(j)]
+
+
+@pytest.mark.parametrize('n_workers', [None, 2])
+def test_build_links_parallel(n_workers, v_from_csv):
+    v_from_csv.graph = {(10, 3): [(10, 4), (11, 61)],
+                        (10, 4): [(10, 3), (11, 61)]}
+    v_from_csv.links = {((10, 3), (10, 4)): None}
+    v_from_csv.build_links(f=basenames, n_workers=n_workers)
+    assert list(v_from_csv.links.keys())[0:3] == [
+        ((10, 3), (10, 4)), ((10, 3), (11, 61)), ((10, 4), (11, 61))]
+    assert v_from_csv.links[((10, 3), (11, 61))] == [
+        'TEST_0010_0003.jpg', 'TEST_0011_0061.jpg']
+    assert v_from_csv.links[((10, 4), (11, 61))] == [
+        'TEST_0010_0004.jpg', 'TEST_0011_0061.jpg']
+    assert v_from_csv.links[((10, 4), (10, 3))] is None
+
+
+class CountedCalls(object):
+    """Counts calls made with the same instance (in a process)."""
+
+    def __init__(self):
+        self.n_calls = 0
+
+    def __call__(self, i, j, **kwargs):
+        self.n_calls += 1
+        return os.getpid(), self.n_calls
+
+
+def test_build_links_parallel_state(v_from_csv):
+    graph = {(10, 3): [(10, 4), (11, 61)], (10, 4): [(11, 61)]}
+    v_from_csv.build_links(f=CountedCalls(), graph=graph, n_workers=2)
+    calls = {}
+    for pid, n_calls in v_from_csv.links.values():
+        calls.setdefault(pid, []).append(n_calls)
+    # f is sent once to each worker, its state persists across chunks
+    for n_calls in calls.values():
+        assert sorted(n_calls) == list(range(1, len(n_calls) + 1))
+
+
+def counted_identity(i, j, verbose=False, **kwargs):
+    counted_identity.n_calls += 1
+    trans = rasterio.transform.Affine.identity()
+    return (trans, {'n_inlier': 10, 'scale': 1}) if verbose else trans
+
+
+def test_build_links_store(v_from_csv, tmp_path):
+    graph = {(10, 3): [(10, 4), (11, 61)], (10, 4): [(11, 61)]}
+    store = LinkStore(str(tmp_path / 'links.sqlite'))
+    store.put(v_from_csv.df.at[(10, 3), 'img_file'],
+              v_from_csv.df.at[(10, 4), 'img_file'], None)
+    counted_identity.n_calls = 0
+    v_from_csv.build_links(f=counted_identity, graph=graph, store=store)
+    # recorded pair is skipped
+    assert counted_identity.n_calls == 2
+    assert v_from_csv.links == {
+        ((10, 3), (10, 4)): None,
+        ((10, 3), (11, 61)): rasterio.transform.Affine.identity(),
+        ((10, 4), (11, 61)): rasterio.transform.Affine.identity()}
+    assert len(store) == 3
+    # resume with no links in memory
+    v_from_csv.links = {}
+    v_from_csv.build_links(f=counted_identity, graph=graph, store=store)
+    assert counted_identity.n_calls == 2
+    assert len(v_from_csv.links) == 3
+    store.close()
+
+
+@pytest.mark.parametrize(
+    'n_links,budget,expected',
+    [
+        # the spanning tree
+        (1, None, {(10, 3): [(10, 4)], (10, 4): [(10, 3), (11, 61)],
+                   (11, 61): [(10, 4)]}),
+        # with loop closure
+        (2, None, {(10, 3): [(10, 4), (11, 61)],
+                   (10, 4): [(10, 3), (11, 61)],
+                   (11, 61): [(10, 3), (10, 4)]}),
+        (None, 1, {(10, 3): [(10, 4)], (10, 4): [(10, 3)], (11, 61): []}),
+    ],
+)
+def test_build_links_schedule(n_links, budget, expected, v_from_csv):
+    # overlap fractions: 0.75 for (10, 4) with the others, 0.5 otherwise
+    v_from_csv.df.loc[:, 'x_init'] = [0, 10, 20]
+    v_from_csv.df.loc[:, 'y_init'] = [0, 0, 0]
+    v_from_csv.graph = {(10, 3): [(10, 4), (11, 61)],
+                        (10, 4): [(10, 3), (11, 61)],
+                        (11, 61): [(10, 3), (10, 4)]}
+    assert v_from_csv.get_overlap_fractions(
+        [((10, 3), (10, 4)), ((10, 3), (11, 61)), ((10, 4), (11, 61))]
+    ) == pytest.approx([0.75, 0.5, 0.75])
+    counted_identity.n_calls = 0
+    v_from_csv.build_links(f=counted_identity, n_links=n_links, budget=budget)
+    assert v_from_csv.graph == expected
+    assert counted_identity.n_calls == len(v_from_csv.links) // 2
+
+
+def test_segment_swaths(v_from_csv):
+    v_from_csv.df = v_from_csv.df.drop(columns='swath_id')
+    v_from_csv.df.loc[:, 'x_init'] = [0, 10, 20]
+    v_from_csv.df.loc[:, 'y_init'] = [0, 0, 0]
+    v_from_csv.df.loc[:, 'yaw'] = [0, 0, np.pi / 2]
+    v_from_csv.segment_swaths(heading_col='yaw')
+    assert v_from_csv.df['swath_id'].tolist() == [0, 0, 1]
+    assert v_from_csv.df['swath_order'].tolist() == [0, 1, 0]
+
+
+@pytest.mark.parametrize('yaw,expected', [
+    # flight yaw from metadata, in degrees
+    ([0, 0, 90], [0, 0, 1]),
+    # metadata unavailable, headings estimated from positions
+    (None, [0, 0, 0])])
+def test_segment_swaths_metadata(v_from_csv, monkeypatch, yaw, expected):
+    v_from_csv.df = v_from_csv.df.drop(columns='swath_id')
+    v_from_csv.df.loc[:, 'x_init'] = [0, 10, 20]
+    v_from_csv.df.loc[:, 'y_init'] = [0, 0, 0]
+    monkeypatch.setattr(
+        vrt, '_load_flight_yaw',
+        lambda img_files: None if yaw is None else np.radians(yaw))
+    v_from_csv.segment_swaths()
+    assert v_from_csv.df['swath_id'].tolist() == expected
+
+
+def test_load_flight_yaw(v_from_csv):
+    # utils.metadata is unavailable or the images have no metadata
+    assert vrt._load_flight_yaw(v_from_csv.df['img_file'].tolist()) is None
+
+
+def test_build_graph_links_swath_order(v_from_csv):
+    v_from_csv.df.loc[:, 'swath_id'] = [0, 0, 0]
+    v_from_csv.df.loc[:, 'swath_order'] = [0, 2, 1]
+    counted_identity.n_calls = 0
+    v_from_csv.build_graph_links(
+        f=counted_identity, method='within', neighbor_within_swath=1)
+    assert v_from_csv.graph == {
+        (10, 3): [(11, 61)], (11, 61): [(10, 3), (10, 4)],
+        (10, 4): [(11, 61)]}
+
+
+def test_get_overlap(v_from_csv):
+    v_from_csv.df.loc[:, 'x_init'] = [0, 20, 500]
+    v_from_csv.df.loc[:, 'y_init'] = [0, 0, 500]
+    poly0, poly1 = v_from_csv.get_overlap((10, 3), (10, 4))
+    assert poly0.equals(shapely.geometry.box(20, 0, 40, 20))
+    assert poly1.equals(shapely.geometry.box(0, 10, 20, 30))
+    assert v_from_csv.get_overlap((10, 3), (11, 61)) is None
+
+
+def test_get_relative_init(v_from_csv):
+    v_from_csv.df.loc[:, 'x_init'] = [0, 20, 500]
+    v_from_csv.df.loc[:, 'y_init'] = [0, 0, 500]
+    trans = v_from_csv.get_relative_init((10, 3), (10, 4))
+    # pixel (0, 0) of (10, 4) is at pixel (20, -10) of (10, 3)
+    assert trans == pytest.approx(
+        rasterio.transform.Affine.translation(20, -10))
+
+
+def prior_offsets(i, j, prior=None, **kwargs):
+    return None if prior is None else (prior.c, prior.f)
+
+
+def test_build_links_guided(v_from_csv):
+    v_from_csv.df.loc[:, 'x_init'] = [0, 20, 500]
+    v_from_csv.df.loc[:, 'y_init'] = [0, 0, 500]
+    graph = {(10, 3): [(10, 4)]}
+    v_from_csv.build_links(f=prior_offsets, graph=graph, guided=True)
+    assert v_from_csv.links[((10, 3), (10, 4))] == pytest.approx((20, -10))
+
+
+def overlap_bounds(i, j, overlaps=None, **kwargs):
+    # pairs predicted not to overlap are not matched
+    assert overlaps is not None
+    return [p.bounds for p in overlaps]
+
+
+def test_build_links_overlap(v_from_csv):
+    v_from_csv.df.loc[:, 'x_init'] = [0, 20, 500]
+    v_from_csv.df.loc[:, 'y_init'] = [0, 0, 500]
+    graph = {(10, 3): [(10, 4), (11, 61)]}
+    v_from_csv.build_links(f=overlap_bounds, graph=graph, overlap_dilation=0)
+    assert v_from_csv.links == {
+        ((10, 3), (10, 4)): [(20, 0, 40, 20), (0, 10, 20, 30)],
+        ((10, 3), (11, 61)): None}
+
+
 def test_build_graph_links(v_from_csv):
     # test across
     v_from_csv.df.loc[:, 'x_init'] = [350, 250, -5]
@@ -413,6 +601,79 @@ def test_build_graph_links(v_from_csv):
         ((11, 61), (10, 4)): rasterio.transform.Affine.identity()}
 
 
+@pytest.mark.parametrize('swath', [True, False])
+def test_build_graph_links_overlap(swath, v_from_csv):
+    v_from_csv.df.loc[:, 'x_init'] = [0, 20, 500]
+    v_from_csv.df.loc[:, 'y_init'] = [0, 0, 500]
+    if not swath:
+        v_from_csv.df = v_from_csv.df.drop(columns='swath_id')
+    counted_identity.n_calls = 0
+    v_from_csv.build_graph_links(
+        f=counted_identity, method='overlap', min_overlap=0.1)
+    assert v_from_csv.graph == {
+        (10, 3): [(10, 4)], (10, 4): [(10, 3)]}
+    assert set(v_from_csv.links.keys()) == {
+        ((10, 3), (10, 4)), ((10, 4), (10, 3))}
+    assert counted_identity.n_calls == 1
+
+
+def scene_descriptors(file):
+    """Images of the same flight (directory) see the same scene."""
+    seed = int(os.path.basename(os.path.dirname(file)).split('_')[-1])
+    return np.random.RandomState(seed).uniform(
+        size=(50, 64)).astype(np.float32)
+
+
+@pytest.mark.parametrize('n_workers', [None, 2])
+def test_build_graph_links_retrieval(v_from_csv, n_workers):
+    v_from_csv.df.loc[:, 'x_init'] = [0, 20, 500]
+    v_from_csv.df.loc[:, 'y_init'] = [0, 0, 500]
+    # a second image of the scene of (11, 61)
+    df = v_from_csv.df
+    v_from_csv.df = pd.concat([df, df.loc[[(11, 61)]].set_axis(
+        pd.MultiIndex.from_tuples([(11, 62)], names=df.index.names))])
+    counted_identity.n_calls = 0
+    v_from_csv.build_graph_links(
+        f=counted_identity, method='retrieval', neighbor_retrieval=1,
+        retrieval_words=20, descriptor_fn=scene_descriptors,
+        n_workers=n_workers)
+    assert v_from_csv.graph == {
+        (10, 3): [(10, 4)], (10, 4): [(10, 3)],
+        (11, 61): [(11, 62)], (11, 62): [(11, 61)]}
+
+
+class DescribingStitcher(object):
+    """Records the images it described (in a process)."""
+    def __init__(self):
+        self.described = set()
+
+    def get_descriptors(self, file):
+        self.described.add(file)
+        return scene_descriptors(file)
+
+    def stitch_pair(self, img0, img1, **kwargs):
+        return rasterio.transform.Affine.translation(len(self.described), 0)
+
+
+def test_build_graph_links_worker_state(v_from_csv):
+    df = v_from_csv.df
+    v_from_csv.df = pd.concat([df, df.loc[[(11, 61)]].set_axis(
+        pd.MultiIndex.from_tuples([(11, 62)], names=df.index.names))])
+    stitcher = DescribingStitcher()
+    fs = [stitcher.stitch_pair, stitcher.get_descriptors]
+    with vrt._WorkerPool(fs, 1) as pool:
+        v_from_csv.build_graph_links(
+            f=stitcher.stitch_pair, method='retrieval', neighbor_retrieval=1,
+            retrieval_words=20, descriptor_fn=stitcher.get_descriptors,
+            executor=pool)
+    # descriptors were computed by the stitcher installed in the worker
+    assert len(v_from_csv.links) == 4
+    n_files = v_from_csv.df['img_file'].nunique()
+    for trans in v_from_csv.links.values():
+        assert abs(trans.c) == n_files
+    assert stitcher.described == set()
+
+
 def test_global_optimize(v_from_csv):
     v_from_csv.graph = {(10, 3): [(10, 4)], (10, 4): [(10, 3)]}
     v_from_csv.links = {
@@ -433,6 +694,24 @@ def test_global_optimize(v_from_csv):
             rasterio.transform.Affine.translation(0, -50))
 
 
+def test_global_optimize_trf(v_from_csv):
+    v_from_csv.graph = {(10, 3): [(10, 4)], (10, 4): [(10, 3)]}
+    v_from_csv.links = {
+        ((10, 3), (10, 4)): rasterio.transform.Affine.translation(0, -50),
+        ((10, 4), (10, 3)): rasterio.transform.Affine.translation(0, 50)}
+    v_from_csv.df = v_from_csv.df.astype({'theta_init': float})
+    v_from_csv.df.loc[:, 'x_init'] = [350, 250, -5]
+    v_from_csv.df.loc[:, 'y_init'] = [50, 50, -5]
+    v_from_csv.df.loc[:, 'theta_init'] = [np.pi * 3 / 2, np.pi * 3 / 2, 0]
+    v_from_csv.global_optimize(solver='trf', verbose=False)
+    relative_trans = (~v_from_csv.df.at[(10, 3), 'relative_trans'] *
+                      v_from_csv.df.at[(10, 4), 'relative_trans'])
+    assert v_from_csv.optim_losses[-1] == pytest.approx(0, abs=1e-6)
+    assert v_from_csv.optim_stop[0] == v_from_csv.optim_iters[-1]
+    assert (pytest.approx(relative_trans, abs=1e-3) ==
+            rasterio.transform.Affine.translation(0, -50))
+
+
 def test_georef_joint(v_from_csv, mosaic_gcp_dir, ind_gcp_dir):
     v_from_csv.graph = {
         (10, 3): [(10, 4)],
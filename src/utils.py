@@ -6,6 +6,7 @@ import rasterio.transform
 import rasterio.control
 import shapely
 import shapely.geometry
+import shapely.affinity
 import cv2 as cv
 
 assert rasterio.__version__ >= '1.1.0'
@@ -165,6 +166,74 @@ def get_centroid_dist(transforms, widths, heights):
                    (centroid1_h - centroid0_h) ** 2)
 
 
+def get_affine_init(x, y, theta, scale, width, height):
+    """Gets the affine transform of an image from its initial pose.
+
+    This mirrors the parametrization used in src.optim.optimize, where
+    (x, y) is the position of the image center.
+
+    Args:
+        x, y (float): position of the image center (in world crs)
+        theta (float): rotation angle (in radians)
+        scale (float): size of a pixel (in world crs units)
+        width, height (int): in pixels
+
+    Returns:
+        affine.Affine: from pixel space to world crs space
+    """
+    cos, sin = np.cos(theta) * scale, np.sin(theta) * scale
+    return rasterio.transform.Affine(
+        cos, -sin, x - width / 2 * cos + height / 2 * sin,
+        sin, cos, y - width / 2 * sin - height / 2 * cos)
+
+
+def get_overlap_fraction(polygons0, polygons1):
+    """Gets the overlap fractions between pairs of polygons.
+
+    The overlap fraction is the area of the intersection over the area of
+    the smaller polygon.
+
+    Args:
+        polygons0, polygons1 (numpy.ndarray [N,] of shapely.geometry.Polygon):
+            pairs of polygons
+
+    Returns:
+        numpy.ndarray [N,]: overlap fractions in [0, 1]
+    """
+    areas = np.minimum(shapely.area(polygons0), shapely.area(polygons1))
+    return (shapely.area(shapely.intersection(polygons0, polygons1)) /
+            np.maximum(areas, np.finfo(float).tiny))
+
+
+def get_overlap_polygons(transforms, widths, heights, dilation=0):
+    """Gets the expected overlap between two images in their pixel spaces.
+
+    Args:
+        transforms (iterable of affine.Affine [2,]): corresponds to image 0/1
+        widths, heights (iterable of int [2,]): corresponds to image 0/1
+        dilation (float): the overlap is dilated by this proportion of the
+            image diagonal to account for errors in transforms
+
+    Returns:
+        tuple of shapely.geometry.Polygon [2,] or NoneType: overlap in the
+            pixel space of image 0/1 (clipped to the image), None if the
+            images are not expected to overlap
+    """
+    boxes = [convert_to_bbox(trans, w, h)
+             for trans, w, h in zip(transforms, widths, heights)]
+    overlap = boxes[0].intersection(boxes[1])
+    if overlap.is_empty or overlap.area == 0:
+        return None
+    output = []
+    for trans, w, h in zip(transforms, widths, heights):
+        t = ~trans
+        poly = shapely.affinity.affine_transform(
+            overlap, [t.a, t.b, t.d, t.e, t.c, t.f])
+        poly = poly.buffer(dilation * np.sqrt(w ** 2 + h ** 2))
+        output.append(poly.intersection(shapely.geometry.box(0, 0, w, h)))
+    return tuple(output)
+
+
 def prepare_folder(files):
     """Make folders for files, if necessary.
 
@@ -4,7 +4,8 @@ import math
 import tqdm
 import glob
 import warnings
-import collections
+import itertools
+import concurrent.futures
 import numpy as np
 import pandas as pd
 import geopandas as gpd
@@ -17,13 +18,112 @@ import rasterio.warp
 from .utils import (create_batch_symlink,
                     convert_affine,
                     convert_to_bbox,
+                    get_affine_init,
+                    get_overlap_fraction,
+                    get_overlap_polygons,
                     prepare_folder)
-from .graph import get_links, build_graph, get_subgraphs
-from .optim import optimize
+from .graph import (Graph, get_links, build_graph, get_subgraphs,
+                    order_pairs, get_spanning_tree, select_loop_closures)
+from .optim import optimize, optimize_least_squares
+from .initialize import segment_swaths
 from .preprocess import preprocess, show_preprocess
 from .georef import mosaic_to_individual, georef_by_gcp
 
 
+def _load_flight_yaw(img_files):
+    """Loads the flight yaw of images from their metadata.
+
+    Args:
+        img_files (list of str): image file paths
+
+    Returns:
+        numpy.ndarray [N,] or NoneType: flight yaw (in radians) of images,
+            None if the metadata is unavailable for any image
+    """
+    try:
+        from utils.metadata import get_metadata
+    except ImportError:
+        return None
+    yaws = {}
+    for img_dir in set(os.path.dirname(file) for file in img_files):
+        try:
+            metadata = get_metadata(img_dir)
+        except (OSError, KeyError, TypeError, ValueError):
+            return None
+        # yaws are only aligned with names if every image has one
+        if len(metadata['flight yaw']) != len(metadata['name']):
+            return None
+        yaws.update({os.path.join(img_dir, name): yaw for name, yaw in
+                     zip(metadata['name'], metadata['flight yaw'])})
+    if not all(file in yaws for file in img_files):
+        return None
+    # compass angles in degrees, only their differences are used
+    return np.radians([yaws[file] for file in img_files])
+
+
+def _apply(f, args, kwargs):
+    """Calls f(*args, **kwargs), used for mapping over executors."""
+    return f(*args, **kwargs)
+
+
+# functions installed once per worker process by _WorkerPool
+_worker_fs = None
+
+
+def _init_worker(fs):
+    global _worker_fs
+    _worker_fs = fs
+
+
+def _apply_worker(k, args, kwargs):
+    """Calls the k-th function installed in the worker, see _WorkerPool."""
+    return _worker_fs[k](*args, **kwargs)
+
+
+class _WorkerPool(concurrent.futures.ProcessPoolExecutor):
+    """Process pool whose workers receive functions once, when they start.
+
+    The functions (e.g., src.stitch.Stitcher.stitch_pair and
+    get_descriptors bound methods) are not pickled with every chunk, so
+    their state (e.g., the in-memory caches of the Stitcher) persists in
+    each worker across chunks. They are pickled together, so that bound
+    methods of the same object share one copy of it in each worker.
+
+    Args:
+        fs (list of function): picklable functions
+        n_workers (int): number of worker processes
+    """
+
+    def __init__(self, fs, n_workers):
+        super().__init__(n_workers, initializer=_init_worker, initargs=(fs,))
+        self.fs = fs
+
+
+def _map(f, args, kwargs, executor=None, chunksize=1):
+    """Maps f over args and kwargs, in order.
+
+    Args:
+        f (function): mapped function
+        args (iterable of tuple): positional arguments of each call
+        kwargs (iterable of dict): keyword arguments of each call
+        executor (concurrent.futures.Executor): executor used to process
+            calls, in the current process if None. If f is installed in a
+            _WorkerPool, it is not pickled with the calls
+        chunksize (int): passed to executor.map()
+
+    Returns:
+        iterator: outputs of f
+    """
+    if executor is None:
+        return map(_apply, itertools.repeat(f), args, kwargs)
+    if isinstance(executor, _WorkerPool) and f in executor.fs:
+        return executor.map(
+            _apply_worker, itertools.repeat(executor.fs.index(f)), args,
+            kwargs, chunksize=chunksize)
+    return executor.map(_apply, itertools.repeat(f), args, kwargs,
+                        chunksize=chunksize)
+
+
 class VirtualRaster(object):
     """Virtual raster.
 
@@ -47,8 +147,8 @@ class VirtualRaster(object):
         wld_dir (str): directory to metadata (georef info)
         img_suffix, wld_suffix (str): suffix for image or world files
             including the leading dot
-        graph (collections.defaultdict): {node index (idx0, idx1): [neighbors'
-            indices (idx0, idx1)]}
+        graph (src.graph.Graph or dict of list): {node index (idx0, idx1):
+            [neighbors' indices (idx0, idx1)]}
         links (dict {((int, int), (int, int)): affine.Affine}):
             recording affine transforms estimated between pairs of
             images; links[((idx0_i, idx1_i), (idx0_j, idx1_j))] is the
@@ -68,7 +168,7 @@ class VirtualRaster(object):
         self.img_suffix = img_suffix
         self.wld_suffix = wld_suffix
         # initialize graph and links
-        self.graph = collections.defaultdict(list) if graph is None else graph
+        self.graph = Graph() if graph is None else graph
         self.links = {} if links is None else links
         # parse crs
         self.crs = rasterio.crs.CRS.from_string(crs)
@@ -388,16 +488,97 @@ class VirtualRaster(object):
 
         return np.round(outputs).astype(np.uint8), dst_transform
 
-    def build_links(self, f, max_dist=None, graph=None, show_file=None, verbose=False):
+    def build_links(self, f, max_dist=None, graph=None, show_file=None,
+                    verbose=False, n_workers=None, executor=None,
+                    store=None, order=None, overlap_dilation=None,
+                    guided=False, n_links=None, budget=None):
         """Build links between nodes.
 
+        If n_links or budget is not None, pairs are scheduled by expected
+        overlap (see self.get_overlap_fractions()): the maximum spanning tree
+        is matched first, then loop closures are added by priority until each
+        image has n_links verified (not None) links, or budget pairs are
+        matched. Pairs that are not matched are dropped from the graph.
+
         Args:
             f (function): takes in two image file paths, img0 and img1
                 returns an affine transformation from img1 to img0
-            graph (collections.defaultdict(list)): if None, use self.graph
+                needs to be picklable if pairs are processed in parallel
+                (e.g., src.stitch.Stitcher.stitch_pair)
+            graph (src.graph.Graph or dict of list): if None, use self.graph
                 {k: [v0, v1, ...]} indicating the images' neighbors
             verbose (bool)
+            n_workers (int): number of worker processes used to process
+                pairs in parallel, if None or 1, pairs are processed serially
+            executor (concurrent.futures.Executor): executor used to process
+                pairs, overrides n_workers if not None
+            store (src.store.LinkStore): durable store of links, pairs
+                recorded in the store are skipped, newly estimated links are
+                recorded as soon as they are available. If not None, f is
+                called with verbose=True and should return a tuple
+                (affine.Affine, dict of diagnostics)
+            order (str): order in which pairs are processed, passed to
+                src.graph.order_pairs, 'locality' maximizes reuse of images
+                cached in memory by consecutive pairs
+            overlap_dilation (float): if not None, the expected overlap of
+                each pair is computed from initial positions (see
+                self.get_overlap()) and passed to f as overlaps=(polygon0,
+                polygon1), dilated by this proportion of the image diagonal.
+                Pairs predicted not to overlap are not matched, their link
+                is None
+            guided (bool): if True, the relative transform predicted by
+                initial positions (see self.get_relative_init()) is passed to
+                f as prior=affine.Affine for guided matching
+            n_links (int): number of verified links wanted for each image
+            budget (int): max number of pairs matched
         """
+        if executor is None and n_workers is not None and n_workers > 1:
+            with _WorkerPool([f], n_workers) as pool:
+                return self.build_links(f, max_dist=max_dist, graph=graph,
+                                        show_file=show_file, verbose=verbose,
+                                        n_workers=n_workers, executor=pool,
+                                        store=store, order=order,
+                                        overlap_dilation=overlap_dilation,
+                                        guided=guided, n_links=n_links,
+                                        budget=budget)
+        if n_links is not None or budget is not None:
+            update_graph = graph is None
+            graph = Graph.from_dict(self.graph if graph is None else graph)
+            edges = graph.get_edges()
+            weights = self.get_overlap_fractions(
+                [(graph.nodes[i], graph.nodes[j]) for i, j in edges])
+            in_tree = get_spanning_tree(len(graph), edges, weights)
+            kwargs = {'max_dist': max_dist, 'show_file': show_file,
+                      'verbose': verbose, 'executor': executor,
+                      'store': store, 'order': order,
+                      'overlap_dilation': overlap_dilation, 'guided': guided}
+            # match the spanning tree first, by priority within the budget
+            tree = np.flatnonzero(in_tree)
+            tree = tree[np.argsort(-weights[tree], kind='stable')][:budget]
+            self.build_links(f, graph=Graph(graph.nodes, edges[tree]),
+                             **kwargs)
+            matched = tree.tolist()
+            # add loop closures until images have enough verified links
+            closures = np.flatnonzero(~in_tree)
+            while (len(closures) > 0 and
+                   (budget is None or len(matched) < budget)):
+                degrees = np.zeros(len(graph), dtype=int)
+                for i, j in edges[matched]:
+                    link = self.links[(graph.nodes[i], graph.nodes[j])]
+                    if link is not None:
+                        degrees[[i, j]] += 1
+                selected = closures[select_loop_closures(
+                    edges[closures], weights[closures], degrees, n_links,
+                    budget=None if budget is None else budget - len(matched))]
+                if len(selected) == 0:
+                    break
+                self.build_links(f, graph=Graph(graph.nodes, edges[selected]),
+                                 **kwargs)
+                matched += selected.tolist()
+                closures = np.setdiff1d(closures, selected)
+            if update_graph:
+                self.graph = Graph(graph.nodes, edges[matched])
+            return
         graph = self.graph if graph is None else graph
 
         # prepare pairs of indices
@@ -406,14 +587,59 @@ class VirtualRaster(object):
                  for i, js in graph.items() for j in js
                  # use tuple comparisons
                  if i < j and (i, j) not in self.links.keys()]
+        # skip pairs that are already recorded in the store
+        if store is not None:
+            todo = []
+            for i, j, i_file, j_file in pairs:
+                found, trans = store.get(i_file, j_file)
+                if found:
+                    self.links[(i, j)] = trans
+                else:
+                    todo.append((i, j, i_file, j_file))
+            pairs = todo
+        pairs = [pairs[k] for k in order_pairs(
+            [(i, j) for i, j, _, _ in pairs], method=order)]
+        if overlap_dilation is not None:
+            overlaps = [self.get_overlap(i, j, dilation=overlap_dilation)
+                        for i, j, _, _ in pairs]
+            # pairs predicted not to overlap are not matched
+            for (i, j, _, _), overlap in zip(pairs, overlaps):
+                if overlap is None:
+                    self.links[(i, j)] = None
+            pairs = [pair for pair, overlap in zip(pairs, overlaps)
+                     if overlap is not None]
+            overlaps = [overlap for overlap in overlaps if overlap is not None]
+        args = [(i_file, j_file) for _, _, i_file, j_file in pairs]
+        kwargs = [{'max_dist': max_dist,
+                   'dist': self.get_distance(i, j),
+                   'show_file': '{}/{}_{}'.format(show_file, str(i), str(j))}
+                  for i, j, _, _ in pairs]
+        if store is not None:
+            for kw in kwargs:
+                kw['verbose'] = True
+        if overlap_dilation is not None:
+            for overlap, kw in zip(overlaps, kwargs):
+                kw['overlaps'] = overlap
+        if guided:
+            for (i, j, _, _), kw in zip(pairs, kwargs):
+                kw['prior'] = self.get_relative_init(i, j)
 
         # estimate transforms for every pair
-        result = [((i, j), f(i_file, j_file, max_dist=max_dist, dist=self.get_distance(i, j), show_file="{}/{}_{}".format(show_file, str(i), str(j))))
-                  for i, j, i_file, j_file in
-                  tqdm.tqdm(pairs, desc='Building links.')]
-
-        # collect into dictionary
-        self.links.update(dict(result))
+        # results are yielded in the order of pairs
+        # contiguous chunks of pairs keep consecutive pairs in the same
+        # worker (which benefits from the order of pairs)
+        chunksize = (1 if n_workers is None else
+                     max(1, len(pairs) // (n_workers * 4)))
+        results = _map(f, args, kwargs, executor=executor,
+                       chunksize=chunksize)
+        # collect into dictionary as results become available
+        for (i, j, i_file, j_file), result in tqdm.tqdm(
+                zip(pairs, results), total=len(pairs),
+                desc='Building links.'):
+            if store is not None:
+                result, diag = result
+                store.put(i_file, j_file, result, diag)
+            self.links[(i, j)] = result
 
         # make links symmetric
         for i, js in graph.items():
@@ -425,6 +651,9 @@ class VirtualRaster(object):
             print('Links: ', self.links)
 
     def build_graph_links(self, f, position_cols=['x_init', 'y_init'], show_file = None, max_dist=None,
+                          n_workers=None, executor=None, store=None,
+                          order=None, overlap_dilation=None, guided=False,
+                          descriptor_fn=None, n_links=None, budget=None,
                           **kwargs):
         """Builds graph and corresponding links.
 
@@ -435,23 +664,108 @@ class VirtualRaster(object):
                 passed to self.build_links
             position_cols (list of str [2,]): names of columns that indicate
                 x, y coordinates of images
-            **kwargs: passed to src.graph.build_graph
+            n_workers (int): number of worker processes, used for computing
+                descriptors and passed to self.build_links
+            executor (concurrent.futures.Executor): executor used to compute
+                descriptors and links, overrides n_workers if not None
+            store (src.store.LinkStore): durable store of links, passed to
+                self.build_links
+            order (str): order in which pairs are processed, passed to
+                self.build_links
+            overlap_dilation (float): dilation of expected overlaps, passed
+                to self.build_links
+            guided (bool): whether to guide matching by initial positions,
+                passed to self.build_links
+            descriptor_fn (function): takes in an image file path, returns
+                its local descriptors, cannot be None if method = 'retrieval'
+            n_links (int): number of verified links wanted for each image,
+                passed to self.build_links
+            budget (int): max number of pairs matched, passed to
+                self.build_links
+            **kwargs: passed to src.graph.build_graph, along with max_dist
         """
-        indices = (self.df.groupby('swath_id')
-                   .apply(lambda g: g.index.tolist()).values.tolist())
-        if kwargs['method'] == 'across':
+        if executor is None and n_workers is not None and n_workers > 1:
+            # the stitcher installed in each worker computes descriptors
+            # and links, its memory cache is shared by both
+            fs = [f] if descriptor_fn is None else [f, descriptor_fn]
+            with _WorkerPool(fs, n_workers) as pool:
+                return self.build_graph_links(
+                    f, position_cols=position_cols, show_file=show_file,
+                    max_dist=max_dist, store=store, order=order,
+                    overlap_dilation=overlap_dilation, guided=guided,
+                    descriptor_fn=descriptor_fn, n_links=n_links,
+                    budget=budget, executor=pool, n_workers=n_workers,
+                    **kwargs)
+        # without swath annotations, all images are on a single swath
+        if 'swath_id' in self.df.columns:
+            swaths = [g for _, g in self.df.groupby('swath_id')]
+            # order images within swaths
+            if 'swath_order' in self.df.columns:
+                swaths = [g.sort_values('swath_order') for g in swaths]
+                kwargs.setdefault('ordered', True)
+        else:
+            swaths = [self.df]
+        indices = [g.index.tolist() for g in swaths]
+        if kwargs['method'] in ['across', 'knn', 'radius']:
             assert position_cols is not None
-            kwargs['positions'] = (
-                self.df.groupby('swath_id')
-                .apply(lambda g: g.loc[:, position_cols].values).tolist())
+            kwargs['positions'] = [g.loc[:, position_cols].values
+                                   for g in swaths]
+        if kwargs['method'] == 'retrieval':
+            assert descriptor_fn is not None
+            files = [file for g in swaths for file in g['img_file']]
+            descriptors = _map(
+                descriptor_fn, [(file,) for file in files],
+                itertools.repeat({}), executor=executor,
+                chunksize=(1 if n_workers is None else
+                           max(1, len(files) // (n_workers * 4))))
+            kwargs['descriptors'] = [
+                [next(descriptors) for _ in range(len(g))] for g in swaths]
+        if kwargs['method'] == 'overlap':
+            kwargs['footprints'] = [
+                [convert_to_bbox(self.get_affine_init(i),
+                                 g.at[i, 'width'], g.at[i, 'height'])
+                 for i in g.index]
+                for g in swaths]
         # build graph
-        graph = build_graph(indices, **kwargs)
+        graph = build_graph(indices, max_dist=max_dist, **kwargs)
         # update graph
-        for k in graph.keys():
-            self.graph[k] += graph[k]
+        self.graph = Graph.from_dict(self.graph).union(graph)
         # build links
-        self.build_links(f, max_dist=max_dist, show_file=show_file)
-    
+        self.build_links(f, max_dist=max_dist, show_file=show_file,
+                         n_workers=n_workers, executor=executor, store=store,
+                         order=order, overlap_dilation=overlap_dilation,
+                         guided=guided, n_links=n_links, budget=budget)
+
+    def segment_swaths(self, position_cols=['x_init', 'y_init'],
+                       heading_col=None, max_turn=np.pi / 4, max_gap=3):
+        """Segments images into swaths (flight lines).
+
+        Images are assumed to be captured in the order of self.df.index.
+        Writes 'swath_id' and 'swath_order' (order within the swath) columns
+        into self.df, used by self.build_graph_links.
+
+        Args:
+            position_cols (list of str [2,]): names of columns that indicate
+                x, y coordinates of images
+            heading_col (str): name of the column of image headings (yaw, in
+                radians), if None, the flight yaw is read from the image
+                metadata (see utils.metadata.get_metadata), and headings are
+                estimated from positions if it is unavailable
+            max_turn, max_gap (float): passed to
+                src.initialize.segment_swaths
+        """
+        df = self.df.sort_index()
+        if heading_col is None:
+            headings = _load_flight_yaw(df['img_file'].tolist())
+        else:
+            headings = df.loc[:, heading_col].values
+        swath_ids, orders = segment_swaths(
+            positions=df.loc[:, position_cols].values, headings=headings,
+            max_turn=max_turn, max_gap=max_gap)
+        self.df.loc[df.index, 'swath_id'] = swath_ids
+        self.df.loc[df.index, 'swath_order'] = orders
+        self.df = self.df.astype({'swath_id': int, 'swath_order': int})
+
     def get_distance(self, i, j): 
         """
         Get Distance between image at index i and j
@@ -470,15 +784,94 @@ class VirtualRaster(object):
         return dist
         
 
-    def global_optimize(self, **kwargs):
+    def get_affine_init(self, i):
+        """Gets the initial affine transform of an image.
+
+        Args:
+            i: index in self.df
+
+        Returns:
+            affine.Affine: from pixel space to world crs space, computed from
+                'x_init', 'y_init', 'theta_init', 'scale_init', 'width' and
+                'height' in self.df
+        """
+        row = self.df.loc[i, :]
+        return get_affine_init(
+            row['x_init'], row['y_init'], row['theta_init'],
+            row['scale_init'], row['width'], row['height'])
+
+    def get_relative_init(self, i, j):
+        """Gets the relative transform between two images from initial poses.
+
+        Args:
+            i, j: indices in self.df
+
+        Returns:
+            affine.Affine: the transform from image j to image i (in pixels),
+                same convention as self.links
+        """
+        return ~self.get_affine_init(i) * self.get_affine_init(j)
+
+    def get_overlap_fractions(self, pairs):
+        """Gets the expected overlap fractions of pairs of images.
+
+        Footprints are computed from the initial poses of the images, see
+        self.get_affine_init().
+
+        Args:
+            pairs (list of tuple [2,]): pairs of indices (i, j) in self.df
+
+        Returns:
+            numpy.ndarray [N,]: overlap area over the smaller footprint area
+        """
+        footprints = {}
+        for k in set(k for pair in pairs for k in pair):
+            footprints[k] = convert_to_bbox(
+                self.get_affine_init(k),
+                self.df.at[k, 'width'], self.df.at[k, 'height'])
+        polygons = np.array([[footprints[i], footprints[j]]
+                             for i, j in pairs], dtype=object).reshape(-1, 2)
+        return get_overlap_fraction(polygons[:, 0], polygons[:, 1])
+
+    def get_overlap(self, i, j, dilation=0):
+        """Gets the expected overlap between two images.
+
+        The overlap is computed from the initial poses of the images, see
+        self.get_affine_init().
+
+        Args:
+            i, j: indices in self.df
+            dilation (float): proportion of the image diagonal by which the
+                overlap is dilated, passed to src.utils.get_overlap_polygons
+
+        Returns:
+            tuple of shapely.geometry.Polygon [2,] or NoneType: overlap in
+                the pixel space of image i/j, None if not expected to overlap
+        """
+        return get_overlap_polygons(
+            [self.get_affine_init(k) for k in (i, j)],
+            [self.df.at[k, 'width'] for k in (i, j)],
+            [self.df.at[k, 'height'] for k in (i, j)], dilation=dilation)
+
+    def global_optimize(self, solver='adam', **kwargs):
         """Globally optimize to fit all images together.
 
         Args:
-            **kwargs: passed to src.optim.optimize
+            solver (str): in ['adam', 'trf']
+                adam: gradient descent, see src.optim.optimize
+                trf: sparse nonlinear least squares (trust region
+                    reflective), see src.optim.optimize_least_squares
+            **kwargs: passed to the solver
         """
         print('Globally optimizing.')
+        if solver == 'adam':
+            f = optimize
+        elif solver == 'trf':
+            f = optimize_least_squares
+        else:
+            raise NotImplementedError
         # globally optimize
-        iters, losses, affines = optimize(
+        iters, losses, affines, stop = f(
             nodes=self.df.index.tolist(),
             links=get_links(graph=self.graph, links=self.links),
             thetas_init=self.df.loc[:, 'theta_init'].values.tolist(),
@@ -487,7 +880,7 @@ class VirtualRaster(object):
             ys_init=self.df.loc[:, 'y_init'].values.tolist(),
             width=self.df.loc[:, 'width'].values.tolist(),
             height=self.df.loc[:, 'height'].values.tolist(),
-            **kwargs)
+            return_stop=True, **kwargs)
         # update transform
         self.df.loc[:, 'relative_trans'] = pd.Series(
             affines[-1], index=self.df.index)
@@ -495,6 +888,7 @@ class VirtualRaster(object):
         self.optim_iters = iters
         self.optim_losses = losses
         self.optim_affines = affines
+        self.optim_stop = stop
 
     def georef(self, mosaic_gcp_dir=None, ind_gcp_dir=None):
         """Georeferences the raster by ground control points.